@@ -0,0 +1,87 @@
+"""Microbenchmark of per-request overhead: one-off requests calls vs the pooled ComfyClient.
+
+Both run against an in-process fake ComfyUI, so the numbers are client + loopback cost
+only (no GPU work): status checks, /history polls of a finished prompt, /queue reads and
+/prompt submissions. The fake server counts accepted TCP connections, which shows
+whether keep-alive is actually reused.
+
+    python benchmarks/client_overhead.py --requests 500
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+import replay
+from fake_comfyui import FakeComfyUI
+
+
+def percentile(values: list, q: float) -> float:
+    return replay.percentile(values, q) * 1e3
+
+
+def time_calls(call, count: int) -> list:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300, help="calls per endpoint and client")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler-client-") as workdir:
+        fake = FakeComfyUI(output_dir=os.path.join(workdir, "output"), gpu_seconds=0.0, video_bytes=0)
+        url = fake.start()
+        os.environ["COMFYUI_URL"] = url
+        os.environ["COST_MODEL_PATH"] = ""
+        for name in ("COMFYUI_INPUT_DIR", "COMFYUI_OUTPUT_DIR", "RESULT_CACHE_DIR"):
+            os.environ[name] = os.path.join(workdir, name.lower())
+        sys.path.insert(0, replay.SRC_DIR)
+        import handler
+
+        workflow = handler.create_comfyui_workflow("bench.png", {"resolution": "512x512", "duration": 1})
+        prompt_id = handler.COMFY.queue_prompt(workflow, "bench")
+        while handler.COMFY.history(prompt_id) is None:
+            time.sleep(0.01)
+
+        endpoints = {
+            "system_stats": (lambda: requests.get(f"{url}/system_stats", timeout=2),
+                             lambda: handler.COMFY.system_stats()),
+            "history": (lambda: requests.get(f"{url}/history/{prompt_id}", timeout=10),
+                        lambda: handler.COMFY.history(prompt_id)),
+            "queue": (lambda: requests.get(f"{url}/queue", timeout=5),
+                      lambda: handler.COMFY.queue()),
+            "prompt": (lambda: requests.post(f"{url}/prompt", json={"prompt": workflow, "client_id": "bench"}, timeout=30),
+                       lambda: handler.COMFY.queue_prompt(workflow, "bench")),
+        }
+        report = {}
+        for endpoint, clients in endpoints.items():
+            for label, call in zip(("requests", "pooled"), clients):
+                connections = fake.stats["connections"]
+                samples = time_calls(call, args.requests)
+                report[f"{endpoint}_{label}"] = {
+                    "mean_ms": round(sum(samples) / len(samples) * 1e3, 3),
+                    "p50_ms": round(percentile(samples, 0.5), 3),
+                    "p99_ms": round(percentile(samples, 0.99), 3),
+                    "connections": fake.stats["connections"] - connections,
+                }
+        fake.stop()
+
+    print(json.dumps(report, indent=2))
+    print("\nendpoint        requests p50   pooled p50   speedup")
+    for endpoint in endpoints:
+        before, after = report[f"{endpoint}_requests"]["p50_ms"], report[f"{endpoint}_pooled"]["p50_ms"]
+        print(f"{endpoint:14} {before:>10.3f}ms {after:>10.3f}ms {before / after:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+"""Local stand-in for the ComfyUI server used by the offline benchmarks.
+
+Implements the parts of ComfyUI's API the handler talks to (/prompt, /history,
+/queue, /interrupt, /free, /system_stats, /object_info and the /ws event stream) with only the
+standard library. Prompts run one at a time on a simulated GPU thread that sleeps
+for a configurable time, emits the same websocket events ComfyUI does and writes
+a dummy mp4 for every VHS_VideoCombine node (or a copy of --video-template, a real
+clip, when the output has to be playable, e.g. for segment concatenation) and a
+tiny PNG for every SaveImage node. --crash-on-prompt makes the process die mid-prompt
+like a ComfyUI killed by a CUDA error or the OOM killer.
+
+Run standalone:
+    python benchmarks/fake_comfyui.py --port 8188 --output-dir /tmp/fake_output --gpu-seconds 2
+"""
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import os
+import queue
+import random
+import shutil
+import struct
+import sys
+import threading
+import time
+import uuid
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + b"\0" * 2048 + b"\xff\xd9"
+FAKE_PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 64
+
+# Share of a prompt's simulated run time spent in each node class
+NODE_TIME_SHARE = {
+    "CheckpointLoaderSimple": 0.03,
+    "CLIPVisionLoader": 0.01,
+    "CLIPVisionEncode": 0.02,
+    "CLIPTextEncode": 0.02,
+    "WanImageToVideo": 0.02,
+    "KSampler": 0.75,
+    "VAEDecode": 0.10,
+    "VHS_VideoCombine": 0.05,
+}
+
+# /object_info for the node types the handler's workflows use (required inputs only)
+OBJECT_INFO = {
+    "LoadImage": {"image": [[], {"image_upload": True}]},
+    "CheckpointLoaderSimple": {"ckpt_name": [["wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"]]},
+    "CLIPVisionLoader": {"clip_name": [["clip_vision_vit_h.safetensors"]]},
+    "CLIPVisionEncode": {"clip_vision": ["CLIP_VISION"], "image": ["IMAGE"], "crop": [["center", "none"]]},
+    "CLIPTextEncode": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]},
+    "ModelSamplingSD3": {"model": ["MODEL"], "shift": ["FLOAT", {"default": 3.0}]},
+    "WanImageToVideo": {"positive": ["CONDITIONING"], "negative": ["CONDITIONING"], "vae": ["VAE"],
+                        "width": ["INT"], "height": ["INT"], "length": ["INT"], "batch_size": ["INT"]},
+    "KSampler": {"model": ["MODEL"], "seed": ["INT"], "steps": ["INT"], "cfg": ["FLOAT"],
+                 "sampler_name": [["euler", "euler_ancestral", "dpmpp_2m", "sa_solver", "uni_pc"]],
+                 "scheduler": [["normal", "karras", "simple", "beta"]],
+                 "positive": ["CONDITIONING"], "negative": ["CONDITIONING"], "latent_image": ["LATENT"],
+                 "denoise": ["FLOAT"]},
+    "VAEDecode": {"samples": ["LATENT"], "vae": ["VAE"]},
+    "ImageFromBatch": {"image": ["IMAGE"], "batch_index": ["INT"], "length": ["INT"]},
+    "SaveImage": {"images": ["IMAGE"], "filename_prefix": ["STRING"]},
+    "VHS_VideoCombine": {"images": ["IMAGE"], "frame_rate": ["FLOAT"], "loop_count": ["INT"],
+                         "filename_prefix": ["STRING"], "format": [["image/gif", "image/webp", "video/h264-mp4"]],
+                         "pingpong": ["BOOLEAN"], "save_output": ["BOOLEAN"]},
+}
+
+
+class WebSocketClient:
+    """Server side of one websocket connection (text frames out, close/ping handled in)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.open = True
+
+    def send_json(self, payload: dict):
+        self.send_frame(0x1, json.dumps(payload).encode())
+
+    def send_frame(self, opcode: int, data: bytes):
+        header = bytearray([0x80 | opcode])
+        if len(data) < 126:
+            header.append(len(data))
+        elif len(data) < 65536:
+            header.append(126)
+            header += struct.pack("!H", len(data))
+        else:
+            header.append(127)
+            header += struct.pack("!Q", len(data))
+        self._send(bytes(header) + data)
+
+    def _send(self, frame: bytes):
+        with self.lock:
+            if not self.open:
+                return
+            try:
+                self.connection.sendall(frame)
+            except OSError:
+                self.open = False
+
+    def close(self):
+        self._send(b"\x88\x00")
+        self.open = False
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+    def read_until_closed(self, rfile):
+        """Consume client frames until the client goes away"""
+        try:
+            while self.open:
+                head = rfile.read(2)
+                if len(head) < 2:
+                    break
+                opcode, length = head[0] & 0x0F, head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", rfile.read(8))[0]
+                mask = rfile.read(4) if head[1] & 0x80 else b""
+                payload = rfile.read(length)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    if mask:
+                        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                    self._send(bytes([0x8A, len(payload)]) + payload)
+        except OSError:
+            pass
+        self.close()
+
+
+class FakeComfyUI:
+    """Simulated ComfyUI server.
+
+    gpu_seconds is the fixed run time of each KSampler in a prompt (a prompt without one
+    takes it once); gpu_seconds_per_gpx adds time per giga (pixel * frame * step) of the
+    sampler's latent, so bigger jobs take longer and every sampler of a prompt is paid
+    for. fail_rate makes prompts end in execution_error, reject_rate makes /prompt
+    answer 400, and drop_ws_rate closes a client's websocket while its prompt runs. video_template, if
+    set, is copied as every video output instead of writing video_bytes of zeros.
+    crash_on_prompt, if set, exits the whole process halfway through that prompt's
+    sampling (1-based), so only use it when the server runs in its own process.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, output_dir="/tmp/fake_comfyui_output", gpu_seconds=0.5,
+                 gpu_seconds_per_gpx=0.0, video_bytes=1024 * 1024, fail_rate=0.0, reject_rate=0.0,
+                 drop_ws_rate=0.0, seed=0, video_template=None, crash_on_prompt=0):
+        self.output_dir = output_dir
+        self.gpu_seconds = gpu_seconds
+        self.gpu_seconds_per_gpx = gpu_seconds_per_gpx
+        self.video_bytes = video_bytes
+        self.video_template = video_template
+        self.fail_rate = fail_rate
+        self.reject_rate = reject_rate
+        self.drop_ws_rate = drop_ws_rate
+        self.crash_on_prompt = crash_on_prompt
+        self.executed = 0
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.queue_items = {}  # prompt_id -> (number, prompt, client_id), pending or running
+        self.deleted = set()
+        self.running = None
+        self.interrupted = threading.Event()
+        self.history = {}
+        self.completed_at = {}  # prompt_id -> time.perf_counter() when its history entry was written
+        self.clients = {}  # client_id -> WebSocketClient
+        self.counter = 0
+        self.stats = {"prompts": 0, "frees": 0, "interrupts": 0, "requests": 0, "connections": 0}
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    # Lifecycle
+
+    def start(self) -> str:
+        threading.Thread(target=self.server.serve_forever, name="fake-comfyui-http", daemon=True).start()
+        threading.Thread(target=self._gpu_worker, name="fake-comfyui-gpu", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.pending.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Simulated execution
+
+    def _send(self, client_id, event_type, data):
+        client = self.clients.get(client_id)
+        if client is not None and client.open:
+            client.send_json({"type": event_type, "data": data})
+
+    def _send_preview(self, client_id):
+        """Binary PREVIEW_IMAGE frame (event 1, JPEG) like ComfyUI sends after each sampler step"""
+        client = self.clients.get(client_id)
+        if client is not None and client.open:
+            client.send_frame(0x2, struct.pack(">II", 1, 1) + FAKE_JPEG)
+
+    def _sampler_seconds(self, prompt: dict, sampler: dict) -> float:
+        """Simulated time of one KSampler, sized by the WanImageToVideo latent it samples"""
+        seconds = self.gpu_seconds
+        link = sampler["inputs"].get("latent_image")
+        latent = prompt.get(str(link[0])) if isinstance(link, list) else None
+        if latent is not None and latent.get("class_type") == "WanImageToVideo":
+            inputs = latent["inputs"]
+            units = inputs.get("width", 0) * inputs.get("height", 0) * inputs.get("length", 1)
+            seconds += self.gpu_seconds_per_gpx * units * sampler["inputs"].get("steps", 1) / 1e9
+        return seconds
+
+    def _node_times(self, prompt: dict) -> dict:
+        """Simulated seconds per node: every KSampler is charged its own run, as on a real GPU
+        (samplers in one prompt run one after another), and each node class's share of the
+        total is split evenly between that class's nodes"""
+        samplers = {node_id: self._sampler_seconds(prompt, node) for node_id, node in prompt.items()
+                    if node.get("class_type") == "KSampler"}
+        run_time = sum(samplers.values()) if samplers else self.gpu_seconds
+        counts = {}
+        for node in prompt.values():
+            counts[node.get("class_type")] = counts.get(node.get("class_type"), 0) + 1
+        times = {}
+        for node_id, node in prompt.items():
+            class_type = node.get("class_type")
+            if node_id in samplers:
+                times[node_id] = samplers[node_id] * NODE_TIME_SHARE["KSampler"]
+            else:
+                times[node_id] = run_time * NODE_TIME_SHARE.get(class_type, 0.01) / counts[class_type]
+        return times
+
+    def _sleep(self, seconds: float) -> bool:
+        """Sleep unless interrupted; returns False when /interrupt was called"""
+        return not self.interrupted.wait(seconds)
+
+    def _write_video(self, inputs: dict) -> dict:
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        filename = f"{inputs.get('filename_prefix', 'ComfyUI')}_{counter:05}.mp4"
+        if not inputs.get("save_output", True):
+            return {"filename": filename, "subfolder": "", "type": "temp", "format": "video/h264-mp4"}
+        path = os.path.join(self.output_dir, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.video_template:
+            shutil.copyfile(self.video_template, path)
+            return {"filename": filename, "subfolder": "", "type": "output", "format": "video/h264-mp4", "fullpath": path}
+        chunk = b"\0" * min(self.video_bytes, 1024 * 1024) or b""
+        with open(path, "wb") as f:
+            remaining = self.video_bytes
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+        return {"filename": filename, "subfolder": "", "type": "output", "format": "video/h264-mp4", "fullpath": path}
+
+    def _write_image(self, inputs: dict) -> dict:
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        filename = f"{inputs.get('filename_prefix', 'ComfyUI')}_{counter:05}_.png"
+        with open(os.path.join(self.output_dir, filename), "wb") as f:
+            f.write(FAKE_PNG)
+        return {"filename": filename, "subfolder": "", "type": "output"}
+
+    def _gpu_worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            prompt_id, prompt, client_id = item
+            with self.lock:
+                if prompt_id in self.deleted:
+                    self.queue_items.pop(prompt_id, None)
+                    continue
+                self.running = prompt_id
+            self.interrupted.clear()
+            self.executed += 1
+            self._execute(prompt_id, prompt, client_id)
+            with self.lock:
+                self.running = None
+                self.queue_items.pop(prompt_id, None)
+
+    def _execute(self, prompt_id, prompt, client_id):
+        node_times = self._node_times(prompt)
+        fail = self.random.random() < self.fail_rate
+        drop_ws = self.random.random() < self.drop_ws_rate
+        messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}]]
+        outputs = {}
+        status = "success"
+
+        self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+        for node_id, node in prompt.items():
+            class_type = node.get("class_type")
+            self._send(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+            node_time = node_times[node_id]
+
+            if class_type == "KSampler":
+                steps = max(1, int(node["inputs"].get("steps", 1)))
+                for step in range(1, steps + 1):
+                    if self.executed == self.crash_on_prompt and step > steps // 2:
+                        self._crash(node_id)
+                    if not self._sleep(node_time / steps):
+                        break
+                    self._send(client_id, "progress", {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id})
+                    self._send_preview(client_id)
+                if drop_ws and client_id in self.clients:
+                    self.clients[client_id].close()
+                if fail:
+                    status = "error"
+                    error = {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type,
+                             "exception_message": "Injected failure", "exception_type": "RuntimeError"}
+                    messages.append(["execution_error", error])
+                    self._send(client_id, "execution_error", error)
+                    break
+            else:
+                self._sleep(node_time)
+
+            if self.interrupted.is_set():
+                status = "error"
+                interrupted = {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type}
+                messages.append(["execution_interrupted", interrupted])
+                self._send(client_id, "execution_interrupted", interrupted)
+                break
+
+            if class_type == "VHS_VideoCombine":
+                outputs[node_id] = {"gifs": [self._write_video(node["inputs"])]}
+                self._send(client_id, "executed", {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id})
+            elif class_type == "SaveImage":
+                outputs[node_id] = {"images": [self._write_image(node["inputs"])]}
+                self._send(client_id, "executed", {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id})
+
+        if status == "success":
+            messages.append(["execution_success", {"prompt_id": prompt_id}])
+            self._send(client_id, "execution_success", {"prompt_id": prompt_id})
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {"client_id": client_id}, []],
+                "outputs": outputs,
+                "status": {"status_str": status, "completed": status == "success", "messages": messages},
+            }
+            self.completed_at[prompt_id] = time.perf_counter()
+        self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    def _crash(self, node_id):
+        """Die the way ComfyUI does on a fatal CUDA error, leaving a traceback on stderr"""
+        sys.stderr.write(f"!!! Exception during processing !!! node {node_id} at {time.time():.3f}\n"
+                         "Traceback (most recent call last):\n"
+                         "torch.OutOfMemoryError: CUDA out of memory. Tried to allocate 2.50 GiB\n")
+        sys.stderr.flush()
+        os._exit(1)
+
+    # HTTP
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # like aiohttp; keep-alive responses otherwise stall on delayed ACKs
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                fake.stats["connections"] += 1
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                fake.stats["requests"] += 1
+                path = self.path.split("?", 1)[0]
+                if path == "/ws":
+                    return self._websocket()
+                if path == "/system_stats":
+                    return self._json({
+                        "system": {"os": "posix", "python_version": "fake", "comfyui_version": "fake"},
+                        "devices": [{"name": "fake-gpu", "type": "cuda", "index": 0,
+                                     "vram_total": 80 * 1024**3, "vram_free": 60 * 1024**3,
+                                     "torch_vram_total": 80 * 1024**3, "torch_vram_free": 60 * 1024**3}],
+                    })
+                if path == "/object_info":
+                    return self._json({name: {"input": {"required": required}, "output_node": name == "VHS_VideoCombine"}
+                                       for name, required in OBJECT_INFO.items()})
+                if path.startswith("/history/"):
+                    prompt_id = path[len("/history/"):]
+                    with fake.lock:
+                        entry = fake.history.get(prompt_id)
+                    return self._json({prompt_id: entry} if entry else {})
+                if path == "/history":
+                    with fake.lock:
+                        return self._json(dict(fake.history))
+                if path == "/queue":
+                    with fake.lock:
+                        running = [[0, fake.running]] if fake.running else []
+                        pending = [[number, prompt_id] for prompt_id, (number, _, _) in fake.queue_items.items()
+                                   if prompt_id != fake.running and prompt_id not in fake.deleted]
+                    return self._json({"queue_running": running, "queue_pending": pending})
+                self._json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                fake.stats["requests"] += 1
+                body = self._body()
+                if self.path == "/prompt":
+                    prompt = body.get("prompt")
+                    if not isinstance(prompt, dict) or fake.random.random() < fake.reject_rate:
+                        return self._json({"error": {"type": "prompt_outputs_failed_validation",
+                                                     "message": "Prompt outputs failed validation"},
+                                           "node_errors": {}}, 400)
+                    prompt_id = str(uuid.uuid4())
+                    with fake.lock:
+                        fake.stats["prompts"] += 1
+                        number = fake.stats["prompts"]
+                        fake.queue_items[prompt_id] = (number, prompt, body.get("client_id"))
+                    fake.pending.put((prompt_id, prompt, body.get("client_id")))
+                    return self._json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+                if self.path == "/queue":
+                    with fake.lock:
+                        if body.get("clear"):
+                            fake.deleted.update(pid for pid in fake.queue_items if pid != fake.running)
+                        for prompt_id in body.get("delete", []):
+                            if prompt_id != fake.running:
+                                fake.deleted.add(prompt_id)
+                    return self._json({})
+                if self.path == "/interrupt":
+                    # Like ComfyUI, a prompt_id only interrupts that prompt if it is the one running
+                    with fake.lock:
+                        if body.get("prompt_id") in (None, fake.running):
+                            fake.stats["interrupts"] += 1
+                            fake.interrupted.set()
+                    return self._json({})
+                if self.path == "/free":
+                    fake.stats["frees"] += 1
+                    return self._json({})
+                self._json({"error": "not found"}, 404)
+
+            def _websocket(self):
+                client_id = self.path.split("clientId=", 1)[1] if "clientId=" in self.path else uuid.uuid4().hex
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+                self.send_response(101, "Switching Protocols")
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                client = WebSocketClient(self.connection)
+                fake.clients[client_id] = client
+                with fake.lock:
+                    queue_remaining = len(fake.queue_items)
+                client.send_json({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": queue_remaining}},
+                                                             "sid": client_id}})
+                client.read_until_closed(self.rfile)
+                if fake.clients.get(client_id) is client:
+                    fake.clients.pop(client_id, None)
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output-dir", default="/tmp/fake_comfyui_output")
+    parser.add_argument("--gpu-seconds", type=float, default=0.5, help="fixed simulated run time per prompt")
+    parser.add_argument("--gpu-seconds-per-gpx", type=float, default=0.0,
+                        help="extra seconds per 1e9 pixel*frame*step")
+    parser.add_argument("--video-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--video-template", help="real video file copied as every output instead of zeros")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--drop-ws-rate", type=float, default=0.0)
+    parser.add_argument("--crash-on-prompt", type=int, default=0, help="exit the process during the Nth prompt")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeComfyUI(args.host, args.port, args.output_dir, args.gpu_seconds, args.gpu_seconds_per_gpx,
+                       args.video_bytes, args.fail_rate, args.reject_rate, args.drop_ws_rate, args.seed,
+                       args.video_template, args.crash_on_prompt)
+    print(f"Fake ComfyUI listening on {fake.start()}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Peak memory per job for large inputs and outputs, against the fake ComfyUI server.
+
+Each job gets a 20 MB input image (PNG header + filler, with resolution "auto" so the
+dimension lookup runs) and a 200 MB output video returned inline as base64; the input
+store is also measured on its own. The RSS high-water mark is reset before every
+measurement (Linux /proc/self/clear_refs), so each figure is what that call added on
+top of the process baseline.
+
+To compare against an older handler, point --handler-src at a copy of its src/ directory:
+
+    mkdir -p /tmp/before && git archive HEAD~1 src | tar -x -C /tmp/before --strip-components 1
+    python benchmarks/memory.py --handler-src /tmp/before --save before.json
+    python benchmarks/memory.py --compare before.json
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import replay
+
+MB = 1024 * 1024
+
+
+def read_status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} not in /proc/self/status")
+
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS"""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def large_png(size: int, width: int = 1920, height: int = 1080) -> bytes:
+    """A width x height PNG padded with a random IDAT to about `size` bytes (header-valid, not decodable)"""
+    header = b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    return header + png_chunk(b"IDAT", os.urandom(max(0, size - len(header) - 24))) + png_chunk(b"IEND", b"")
+
+
+def measure(fn) -> tuple:
+    """(result, bytes of RSS the call added at its peak)"""
+    gc.collect()
+    reset_peak_rss()
+    baseline = read_status_kb("VmRSS")
+    result = fn()
+    return result, (read_status_kb("VmHWM") - baseline) * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handler-src", default=replay.SRC_DIR, help="directory containing the handler.py to measure")
+    parser.add_argument("--jobs", type=int, default=3)
+    parser.add_argument("--input-mb", type=float, default=20)
+    parser.add_argument("--output-mb", type=float, default=200)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--save", help="write the report as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    args = parser.parse_args()
+
+    server_args = argparse.Namespace(
+        gpu_seconds=0.1, gpu_seconds_per_gpx=0.0, video_bytes=int(args.output_mb * MB), fail_rate=0.0,
+        reject_rate=0.0, drop_ws_rate=0.0, seed=0, concurrency=1, log_level=args.log_level,
+    )
+    with tempfile.TemporaryDirectory(prefix="handler-mem-") as workdir:
+        server, url, output_dir = replay.start_fake_server(server_args, workdir)
+        try:
+            replay.configure_handler_env(url, output_dir, workdir, server_args)
+            os.environ["COST_MODEL_PATH"] = os.path.join(workdir, "cost_model.json")
+            sys.path.insert(0, args.handler_src)
+            import handler
+
+            handler.start_comfyui()
+            input_peaks, job_peaks, latencies = [], [], []
+            for index in range(args.jobs):
+                # Input path alone: decode and store a payload the job below won't reuse
+                payload = "data:image/png;base64," + base64.b64encode(large_png(int(args.input_mb * MB))).decode()
+                _, peak = measure(lambda: handler.INPUT_STORE.put(payload, f"input{index}.png"))
+                input_peaks.append(peak)
+                del payload
+
+                job = {"id": f"memory-{index}", "input": {
+                    "images": [{"image_data": base64.b64encode(large_png(int(args.input_mb * MB))).decode(),
+                                "image_name": f"large{index}.png"}],
+                    "settings": {"resolution": "auto", "duration": 1, "steps": 1, "seed": index},
+                }}
+                start = time.perf_counter()
+                response, peak = measure(lambda: asyncio.run(handler.handler(job)))
+                latencies.append(time.perf_counter() - start)
+                job_peaks.append(peak)
+                if not response.get("success"):
+                    raise RuntimeError(f"job failed: {response.get('error')}")
+                if "calculated_resolution" not in response["debug"]:
+                    raise RuntimeError("auto resolution was not computed from the input header")
+                del job, response
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "handler": os.path.abspath(args.handler_src),
+        "input_bytes": int(args.input_mb * MB),
+        "output_bytes": int(args.output_mb * MB),
+        "input_store_peak_rss": max(input_peaks),
+        "input_store_peak_over_input": round(max(input_peaks) / (args.input_mb * MB), 2),
+        "job_peak_rss_max": max(job_peaks),
+        "job_peak_rss_min": min(job_peaks),
+        "job_peak_over_output": round(max(job_peaks) / (args.output_mb * MB), 2),
+        "latency_max": round(max(latencies), 3),
+    }
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            replay.compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
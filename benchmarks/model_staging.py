@@ -0,0 +1,151 @@
+"""Model staging: copy cost once per boot, against load time from the volume vs the staged copy.
+
+Stages a model file with stage_model() (the boot path) and records wall time, MB/s and
+how far resident memory rose during the copy. Then it reads the file end to end from
+the volume and from the staged copy, the way ComfyUI loads a checkpoint, each time
+after dropping the file from the page cache (posix_fadvise DONTNEED, best effort), and
+once more warm.
+
+With both directories on the same local disk the volume and staged loads come out
+equal; point --volume-dir at the network volume (e.g. /runpod-volume) to measure what
+staging saves on every model load after the first boot.
+
+    python benchmarks/model_staging.py --volume-dir /runpod-volume/bench --size-mb 4096
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import replay
+
+READ_BUFFER_BYTES = 16 * 1024**2
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    """Sample resident memory every few ms while the block runs"""
+
+    def __enter__(self):
+        self.baseline = self.peak = rss_bytes()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.done.wait(0.005):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+
+
+def drop_cache(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())  # Dirty pages can't be dropped
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def load_seconds(path: str, cold: bool) -> float:
+    """Read the whole file sequentially, like a checkpoint load"""
+    if cold:
+        drop_cache(path)
+    buffer = memoryview(bytearray(READ_BUFFER_BYTES))
+    start = time.perf_counter()
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+    return time.perf_counter() - start
+
+
+def write_model(path: str, size: int):
+    with open(path, "wb") as f:
+        for offset in range(0, size, 8 * 1024**2):
+            f.write(os.urandom(min(8 * 1024**2, size - offset)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--volume-dir", help="where the model lives (default: a temp dir on local disk)")
+    parser.add_argument("--staging-dir", help="local staging dir (default: a temp dir)")
+    parser.add_argument("--model", help="existing model file on the volume (default: write --size-mb of random data)")
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--workers", type=int, help="MODEL_STAGING_WORKERS")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler-staging-") as workdir:
+        volume_dir = args.volume_dir or os.path.join(workdir, "volume")
+        staging_dir = args.staging_dir or os.path.join(workdir, "staged")
+        os.makedirs(volume_dir, exist_ok=True)
+        os.environ["MODEL_STAGING_DIR"] = staging_dir
+        os.environ["COMFYUI_OUTPUT_DIR"] = os.path.join(workdir, "output")
+        os.environ["COST_MODEL_PATH"] = ""
+        for name in ("COMFYUI_INPUT_DIR", "RESULT_CACHE_DIR"):
+            os.environ[name] = os.path.join(workdir, name.lower())
+        if args.workers:
+            os.environ["MODEL_STAGING_WORKERS"] = str(args.workers)
+        sys.path.insert(0, replay.SRC_DIR)
+        import handler
+
+        source = args.model
+        written = source is None
+        if written:
+            source = os.path.join(volume_dir, f"bench_model_{os.getpid()}.safetensors")
+            write_model(source, args.size_mb * 1024**2)
+        try:
+            size = os.path.getsize(source)
+            model = {"name": "bench", "path": source, "comfy_path": "checkpoints/bench.safetensors", "size": size}
+            drop_cache(source)
+            with PeakRSS() as memory:
+                start = time.perf_counter()
+                staged, status = handler.stage_model(model)
+                stage_seconds = time.perf_counter() - start
+            if staged == source:
+                raise RuntimeError(f"model was not staged: {status}")
+
+            loads = {}
+            for label, path in (("volume", source), ("staged", staged)):
+                cold = [load_seconds(path, cold=True) for _ in range(args.repeat)]
+                warm = [load_seconds(path, cold=False) for _ in range(args.repeat)]
+                loads[label] = {
+                    "cold_seconds": round(replay.percentile(cold, 0.5), 3),
+                    "warm_seconds": round(replay.percentile(warm, 0.5), 3),
+                    "cold_mb_per_second": round(size / 1024**2 / replay.percentile(cold, 0.5), 1),
+                }
+        finally:
+            if written:
+                os.remove(source)
+            if args.staging_dir is None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    report = {
+        "bytes": size,
+        "workers": handler.MODEL_STAGING_WORKERS,
+        "chunk_bytes": handler.MODEL_STAGING_CHUNK_BYTES,
+        "buffer_bytes": handler.MODEL_STAGING_BUFFER_BYTES,
+        "stage_seconds": round(stage_seconds, 3),
+        "stage_mb_per_second": round(size / 1024**2 / stage_seconds, 1),
+        "stage_rss_increase_bytes": memory.peak - memory.baseline,
+        "load": loads,
+    }
+    print(json.dumps(report, indent=2))
+    print(f"\nstaging: {report['stage_seconds']:.2f}s ({report['stage_mb_per_second']:.0f} MB/s), "
+          f"RSS +{report['stage_rss_increase_bytes'] / 1024**2:.0f} MiB")
+    for label, entry in loads.items():
+        print(f"load from {label:7} cold {entry['cold_seconds']:>7.3f}s ({entry['cold_mb_per_second']:.0f} MB/s)"
+              f"  warm {entry['warm_seconds']:>7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
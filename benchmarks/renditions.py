@@ -0,0 +1,106 @@
+"""CPU cost of each output rendition, and of the whole set on the handler's ffmpeg pool.
+
+Every rendition is encoded alone --repeat times (wall and ffmpeg CPU seconds, output
+size), then all of them are started together through start_renditions()/
+finish_renditions(), the path a job takes, to show what the pool saves over running
+them one by one. The source defaults to a synthetic 832x480, 16 fps, 81-frame h264 clip
+at crf 19, like a 5 s WAN output; pass --source to use a real one.
+
+    FFMPEG_PATH=/usr/bin/ffmpeg python benchmarks/renditions.py --workers 2
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import replay
+
+DEFAULT_RENDITIONS = [
+    {"name": "remux", "codec": "h264"},
+    {"name": "h264_480", "codec": "h264", "crf": 28, "scale": 480},
+    {"name": "webm_preview", "codec": "webm", "crf": 36, "scale": 480},
+    {"name": "webp_preview", "codec": "webp", "scale": 320, "fps": 8, "quality": 70},
+    {"name": "poster", "codec": "jpeg", "frame": 40},
+    {"name": "thumbnail", "codec": "png", "scale": 256},
+]
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_source(ffmpeg: str, path: str):
+    subprocess.run([
+        ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=size=832x480:rate=16",
+        "-frames:v", "81", "-c:v", "libx264", "-crf", "19", "-pix_fmt", "yuv420p", path,
+    ], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="video to make renditions of (default: synthetic WAN-sized clip)")
+    parser.add_argument("--renditions", help="JSON list of rendition specs (default: a typical preview set)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, help="RENDITION_WORKERS for the pooled run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler-renditions-") as workdir:
+        os.environ["COMFYUI_OUTPUT_DIR"] = os.path.join(workdir, "output")
+        os.environ["COST_MODEL_PATH"] = ""
+        for name in ("COMFYUI_INPUT_DIR", "RESULT_CACHE_DIR"):
+            os.environ[name] = os.path.join(workdir, name.lower())
+        if args.workers:
+            os.environ["RENDITION_WORKERS"] = str(args.workers)
+        sys.path.insert(0, replay.SRC_DIR)
+        import handler
+
+        os.makedirs(handler.OUTPUT_DIR, exist_ok=True)
+        source = args.source or os.path.join(workdir, "source.mp4")
+        if not args.source:
+            make_source(handler.FFMPEG_PATH, source)
+        renditions = handler.parse_renditions(json.loads(args.renditions) if args.renditions else DEFAULT_RENDITIONS)
+
+        report = {"source_bytes": os.path.getsize(source), "workers": handler.RENDITION_WORKERS,
+                  "threads_per_ffmpeg": handler.RENDITION_THREADS, "cpus": os.cpu_count(), "renditions": {}}
+        for rendition in renditions:
+            walls, cpus = [], []
+            output = os.path.join(handler.OUTPUT_DIR, f"alone_{rendition['name']}")
+            output += "." + handler.RENDITION_FORMATS[rendition["codec"]][0]
+            for _ in range(args.repeat):
+                cpu = children_cpu()
+                start = time.perf_counter()
+                timing = handler.encode_rendition(source, output, rendition)
+                walls.append(time.perf_counter() - start)
+                cpus.append(children_cpu() - cpu)
+            report["renditions"][rendition["name"]] = {
+                "codec": rendition["codec"],
+                "stream_copy": timing["stream_copy"],
+                "wall_seconds": round(replay.percentile(walls, 0.5), 3),
+                "cpu_seconds": round(replay.percentile(cpus, 0.5), 3),
+                "bytes": os.path.getsize(output),
+            }
+
+        cpu = children_cpu()
+        start = time.perf_counter()
+        results = handler.finish_renditions(handler.start_renditions(source, renditions), "bench")
+        report["pooled_wall_seconds"] = round(time.perf_counter() - start, 3)
+        report["pooled_cpu_seconds"] = round(children_cpu() - cpu, 3)
+        report["sequential_wall_seconds"] = round(sum(r["wall_seconds"] for r in report["renditions"].values()), 3)
+        report["pooled_errors"] = [r["error"] for r in results if "error" in r]
+
+    print(json.dumps(report, indent=2))
+    print("\nrendition        codec  copy   wall s    cpu s      bytes")
+    for name, entry in report["renditions"].items():
+        print(f"{name:16} {entry['codec']:6} {'yes' if entry['stream_copy'] else 'no':5} "
+              f"{entry['wall_seconds']:>7.3f} {entry['cpu_seconds']:>8.3f} {entry['bytes']:>10}")
+    print(f"all {len(renditions)}: {report['sequential_wall_seconds']:.3f}s one by one, "
+          f"{report['pooled_wall_seconds']:.3f}s on the pool ({report['workers']} workers, {report['cpus']} CPUs)")
+
+
+if __name__ == "__main__":
+    main()
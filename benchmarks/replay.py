@@ -0,0 +1,251 @@
+"""Offline load test: drive handler() against the fake ComfyUI server, no GPU needed.
+
+Jobs come from a JSONL file of RunPod payloads ({"input": {...}} per line, lines
+without an "input" object are skipped) and/or a synthetic mix of payload sizes,
+resolutions and client-provided vs generated workflows. The report covers
+throughput, latency percentiles, peak RSS, bytes moved per job and the handler's
+own per-stage percentiles, and can be saved as a baseline and compared later:
+
+    python benchmarks/replay.py --jobs 40 --concurrency 3 --gpu-seconds 0.5 --save baseline.json
+    python benchmarks/replay.py --jobs 40 --concurrency 3 --gpu-seconds 0.5 --compare baseline.json
+    python benchmarks/replay.py --replay requests.jsonl --jobs 0
+
+Requires the handler's own dependencies (runpod, requests, websocket-client).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+RESOLUTIONS = ["768x512", "512x768", "512x512", "720p", "1080p", "832x480"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def start_fake_server(args, workdir: str) -> tuple:
+    """Run the fake ComfyUI in its own process so it doesn't count towards the handler's RSS"""
+    port = free_port()
+    output_dir = os.path.join(workdir, "output")
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_comfyui.py"),
+        "--port", str(port), "--output-dir", output_dir,
+        "--gpu-seconds", str(args.gpu_seconds), "--gpu-seconds-per-gpx", str(args.gpu_seconds_per_gpx),
+        "--video-bytes", str(args.video_bytes), "--fail-rate", str(args.fail_rate),
+        "--reject-rate", str(args.reject_rate), "--drop-ws-rate", str(args.drop_ws_rate),
+        "--seed", str(args.seed),
+        *(["--video-template", args.video_template] if getattr(args, "video_template", None) else []),
+    ], stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()  # "Fake ComfyUI listening on ..."
+    return process, f"http://127.0.0.1:{port}", output_dir
+
+
+def configure_handler_env(url: str, output_dir: str, workdir: str, args):
+    """Point the handler at the fake server and throwaway directories before importing it"""
+    volume = os.path.join(workdir, "volume")
+    os.makedirs(volume, exist_ok=True)
+    manifest = []
+    for name, comfy_path in (("wan_model", "checkpoints/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"),
+                             ("clip_vision", "clip_vision/clip_vision_vit_h.safetensors")):
+        path = os.path.join(volume, os.path.basename(comfy_path))
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1024)
+        manifest.append({"name": name, "path": path, "comfy_path": comfy_path})
+    with open(os.path.join(workdir, "manifest.json"), "w") as f:
+        json.dump({"models": manifest}, f)
+
+    os.environ.update({
+        "COMFYUI_URL": url,
+        "COMFYUI_INPUT_DIR": os.path.join(workdir, "input"),
+        "COMFYUI_OUTPUT_DIR": output_dir,
+        "COMFYUI_MODELS_DIR": os.path.join(workdir, "models"),
+        "RESULT_CACHE_DIR": os.path.join(workdir, "result_cache"),
+        "MODEL_MANIFEST": os.path.join(workdir, "manifest.json"),
+        "MODEL_STAGING_DIR": "",
+        "COST_MODEL_PATH": os.path.join(workdir, "cost_model.json"),
+        "OUTPUT_MODE": "base64",
+        "JOB_CONCURRENCY": str(args.concurrency),
+        "LOG_LEVEL": args.log_level,
+    })
+
+
+def load_replay_jobs(path: str) -> list:
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry.get("input"), dict):
+                print(f"skipping {path}:{line_number}: not a RunPod job payload", file=sys.stderr)
+                continue
+            jobs.append({"id": entry.get("id", f"replay-{line_number}"), "input": entry["input"]})
+    return jobs
+
+
+def synthetic_jobs(handler, count: int, args) -> list:
+    """Mix of payload sizes, resolutions and client-provided vs generated workflows"""
+    rng = random.Random(args.seed)
+    payload_sizes = [int(kb) * 1024 for kb in args.payload_kb.split(",")]
+    jobs = []
+    for index in range(count):
+        images = [{"image_data": base64.b64encode(rng.randbytes(rng.choice(payload_sizes))).decode(),
+                   "image_name": f"job{index}_{image}.png"} for image in range(args.images_per_job)]
+        settings = {
+            "resolution": rng.choice(RESOLUTIONS),
+            "duration": rng.choice([2, 3, 5]),
+            "fps": 16,
+            "steps": 4,
+            "seed": index,
+            "prompt": f"synthetic job {index}",
+        }
+        job_input = {"images": images, "settings": settings}
+        if rng.random() < args.client_workflow_ratio:
+            job_input["workflow"] = handler.create_comfyui_workflow(f"job{index}.png", settings)
+        jobs.append({"id": f"synthetic-{index}", "input": job_input})
+    return jobs
+
+
+async def run_jobs(handler, jobs: list, concurrency: int, trace_alloc: bool) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def run_one(job):
+        async with semaphore:
+            payload_bytes = len(json.dumps(job["input"]))
+            if trace_alloc:
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            response = await handler.handler(job)
+            latency = time.perf_counter() - start
+            results.append({
+                "id": job["id"],
+                "latency": latency,
+                "ok": bool(response.get("success")),
+                "error": response.get("error"),
+                "payload_bytes": payload_bytes,
+                "response_bytes": len(json.dumps(response)),
+                "alloc_peak_bytes": tracemalloc.get_traced_memory()[1] if trace_alloc else None,
+            })
+
+    await asyncio.gather(*(run_one(job) for job in jobs))
+    return results
+
+
+def summarize(results: list, wall_seconds: float, handler) -> dict:
+    latencies = [r["latency"] for r in results if r["ok"]]
+    n = max(len(results), 1)
+    report = {
+        "jobs": len(results),
+        "succeeded": len(latencies),
+        "failed": len(results) - len(latencies),
+        "wall_seconds": round(wall_seconds, 3),
+        "jobs_per_hour": round(len(latencies) / wall_seconds * 3600, 1) if wall_seconds else 0.0,
+        "latency_p50": round(percentile(latencies, 0.5), 4),
+        "latency_p95": round(percentile(latencies, 0.95), 4),
+        "latency_p99": round(percentile(latencies, 0.99), 4),
+        "latency_max": round(max(latencies, default=0.0), 4),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "payload_bytes_per_job": sum(r["payload_bytes"] for r in results) // n,
+        "response_bytes_per_job": sum(r["response_bytes"] for r in results) // n,
+        "stage_percentiles": handler.METRICS.percentiles(),
+    }
+    alloc = [r["alloc_peak_bytes"] for r in results if r["alloc_peak_bytes"] is not None]
+    if alloc:
+        report["alloc_peak_bytes_per_job"] = max(alloc)
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"][:80]] = errors.get(r["error"][:80], 0) + 1
+    if errors:
+        report["errors"] = errors
+    return report
+
+
+def compare(report: dict, baseline: dict):
+    print("\nmetric                          baseline       current     change")
+    for key, value in report.items():
+        if not isinstance(value, (int, float)) or not isinstance(baseline.get(key), (int, float)):
+            continue
+        before = baseline[key]
+        change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{key:28} {before:>13} {value:>13} {change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", help="JSONL file of RunPod job payloads to replay")
+    parser.add_argument("--jobs", type=int, default=20, help="number of synthetic jobs")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--payload-kb", default="64,512,2048", help="comma-separated input image sizes")
+    parser.add_argument("--client-workflow-ratio", type=float, default=0.3)
+    parser.add_argument("--images-per-job", type=int, default=1, help="entries in each synthetic job's images array")
+    parser.add_argument("--gpu-seconds", type=float, default=0.2)
+    parser.add_argument("--gpu-seconds-per-gpx", type=float, default=0.0)
+    parser.add_argument("--video-bytes", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--video-template", help="real clip the fake server copies as every output (needed to "
+                                                 "exercise segment concatenation with FFMPEG_PATH)")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--drop-ws-rate", type=float, default=0.0)
+    parser.add_argument("--trace-alloc", action="store_true", help="track Python allocation peak per job (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--save", help="write the report as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler-bench-") as workdir:
+        server, url, output_dir = start_fake_server(args, workdir)
+        try:
+            configure_handler_env(url, output_dir, workdir, args)
+            sys.path.insert(0, SRC_DIR)
+            import handler
+
+            handler.start_comfyui()  # opens the readiness gate against the fake server
+            jobs = load_replay_jobs(args.replay) if args.replay else []
+            jobs += synthetic_jobs(handler, args.jobs, args)
+
+            if args.trace_alloc:
+                tracemalloc.start()
+            start = time.perf_counter()
+            results = asyncio.run(run_jobs(handler, jobs, args.concurrency, args.trace_alloc))
+            report = summarize(results, time.perf_counter() - start, handler)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Upload throughput of the S3 output sink against inlining the video as base64.
+
+Uploads a --size-mb file through upload_video(), the path a job takes in s3 mode, with
+several part size / concurrency settings, and encodes the same file with
+encode_file_base64() for reference. Each setting is timed --repeat times and reported
+as the median MB/s.
+
+By default the bucket is a local moto server (pip install "moto[server]"), so the
+numbers measure client-side cost over loopback: multipart bookkeeping, checksums and
+thread overhead, not network bandwidth. To measure a real link, point --endpoint at
+MinIO or the production bucket, with BUCKET_ACCESS_KEY_ID/BUCKET_SECRET_ACCESS_KEY set.
+
+    python benchmarks/s3_upload.py --size-mb 256 --repeat 3
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import replay
+
+DEFAULT_SETTINGS = [
+    # (label, part bytes, concurrency); a part size above the file size means a single PUT
+    ("single_put", None, 1),
+    ("multipart_8MiB_x1", 8 * 1024**2, 1),
+    ("multipart_16MiB_x4", 16 * 1024**2, 4),
+    ("multipart_16MiB_x8", 16 * 1024**2, 8),
+    ("multipart_32MiB_x8", 32 * 1024**2, 8),
+]
+
+
+def write_payload(path: str, size: int):
+    # Random bytes, like an encoded video: nothing along the way can compress them
+    with open(path, "wb") as f:
+        for offset in range(0, size, 8 * 1024**2):
+            f.write(os.urandom(min(8 * 1024**2, size - offset)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--endpoint", help="S3-compatible endpoint (default: a local moto server)")
+    parser.add_argument("--bucket", default="handler-bench")
+    args = parser.parse_args()
+
+    server = None
+    if args.endpoint is None:
+        from moto.server import ThreadedMotoServer
+
+        port = replay.free_port()
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        server.start()
+        args.endpoint = f"http://127.0.0.1:{port}"
+        os.environ.setdefault("BUCKET_ACCESS_KEY_ID", "bench")
+        os.environ.setdefault("BUCKET_SECRET_ACCESS_KEY", "bench")
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="handler-s3-") as workdir:
+            os.environ["BUCKET_ENDPOINT_URL"] = args.endpoint
+            os.environ["BUCKET_NAME"] = args.bucket
+            os.environ["COMFYUI_OUTPUT_DIR"] = os.path.join(workdir, "output")
+            os.environ["COST_MODEL_PATH"] = ""
+            for name in ("COMFYUI_INPUT_DIR", "RESULT_CACHE_DIR"):
+                os.environ[name] = os.path.join(workdir, name.lower())
+            sys.path.insert(0, replay.SRC_DIR)
+            import handler
+
+            client = handler.get_s3_client()
+            if server is not None:
+                client.create_bucket(Bucket=args.bucket)
+            size = args.size_mb * 1024**2
+            path = os.path.join(workdir, "video.mp4")
+            write_payload(path, size)
+
+            report = {"endpoint": args.endpoint, "bytes": size, "cpus": os.cpu_count(), "settings": {}}
+            for label, part_bytes, concurrency in DEFAULT_SETTINGS:
+                handler.S3_UPLOAD_CHUNK_BYTES = part_bytes or size + 1
+                handler.S3_UPLOAD_CONCURRENCY = concurrency
+                seconds = []
+                for attempt in range(args.repeat):
+                    start = time.perf_counter()
+                    result = handler.upload_video(path, f"bench/{label}/{attempt}")
+                    seconds.append(time.perf_counter() - start)
+                    if client.head_object(Bucket=args.bucket, Key=result["video_key"])["ContentLength"] != size:
+                        raise RuntimeError(f"{label}: uploaded object has the wrong size")
+                median = replay.percentile(seconds, 0.5)
+                report["settings"][label] = {
+                    "part_bytes": part_bytes, "concurrency": concurrency,
+                    "seconds": round(median, 3), "mb_per_second": round(size / 1024**2 / median, 1),
+                }
+
+            start = time.perf_counter()
+            encoded = handler.encode_file_base64(path)
+            seconds = time.perf_counter() - start
+            report["base64_inline"] = {"seconds": round(seconds, 3), "mb_per_second": round(size / 1024**2 / seconds, 1),
+                                       "response_bytes": len(encoded)}
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(json.dumps(report, indent=2))
+    print(f"\n{'setting':20} {'part':>9} {'threads':>8} {'seconds':>8} {'MB/s':>8}")
+    for label, entry in report["settings"].items():
+        part = f"{entry['part_bytes'] // 1024**2}MiB" if entry["part_bytes"] else "-"
+        print(f"{label:20} {part:>9} {entry['concurrency']:>8} {entry['seconds']:>8.3f} {entry['mb_per_second']:>8.1f}")
+    inline = report["base64_inline"]
+    print(f"{'base64 inline':20} {'-':>9} {'-':>8} {inline['seconds']:>8.3f} {inline['mb_per_second']:>8.1f}"
+          f"  ({inline['response_bytes'] / size:.2f}x response size)")
+
+
+if __name__ == "__main__":
+    main()
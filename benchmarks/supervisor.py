@@ -0,0 +1,94 @@
+"""Crash detection and restart latency of the ComfyUI supervisor.
+
+The handler's supervisor runs the fake ComfyUI as its child process, started with
+--crash-on-prompt 2 so every second prompt kills it halfway through sampling. Each
+round runs one job that succeeds and one that is in flight when the process dies. It
+then records:
+- how long after the crash (the timestamp the fake writes to stderr) the job returned
+  its error;
+- how long until ComfyUI was serving again;
+- whether the crash traceback reached the job's debug output.
+The first round waits on the websocket (if websocket-client is installed), the second
+on /history polling.
+
+    python benchmarks/supervisor.py --gpu-seconds 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import replay
+
+
+def run_job(handler, index: int) -> tuple:
+    job = {"id": f"supervisor-{index}", "input": {
+        "images": [{"image_data": "iVBORw0KGgo=", "image_name": f"job{index}.png"}],
+        "settings": {"resolution": "512x512", "duration": 1, "steps": 4, "seed": index},
+    }}
+    response = asyncio.run(handler.handler(job))
+    return response, time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gpu-seconds", type=float, default=4.0)
+    parser.add_argument("--restart-backoff", type=float, default=0.5)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler-supervisor-") as workdir:
+        port = replay.free_port()
+        url = f"http://127.0.0.1:{port}"
+        output_dir = os.path.join(workdir, "output")
+        replay.configure_handler_env(url, output_dir, workdir, argparse.Namespace(concurrency=1, log_level=args.log_level))
+        os.environ["COMFYUI_RESTART_BACKOFF"] = str(args.restart_backoff)
+        sys.path.insert(0, replay.SRC_DIR)
+        import handler
+
+        handler.SUPERVISOR.command = [
+            sys.executable, os.path.join(replay.BENCH_DIR, "fake_comfyui.py"), "--port", str(port),
+            "--output-dir", output_dir, "--gpu-seconds", str(args.gpu_seconds), "--video-bytes", "1024",
+            "--crash-on-prompt", "2",
+        ]
+        handler.SUPERVISOR.cwd = replay.BENCH_DIR
+        rounds = []
+        try:
+            if not handler.start_comfyui():
+                raise RuntimeError("fake ComfyUI did not start under the supervisor")
+            for mode in ("websocket", "polling") if handler.websocket is not None else ("polling",):
+                if mode == "polling":
+                    handler.websocket = None
+                ok, _ = run_job(handler, len(rounds) * 2)
+                crashed, returned_at = run_job(handler, len(rounds) * 2 + 1)
+                handler.COMFYUI_READY.wait(60)
+                ready_at = time.time()
+
+                process = crashed.get("debug", {}).get("comfyui_process", {})
+                crash_times = re.findall(r"at (\d+\.\d+)", process.get("log_tail", ""))
+                if ok.get("success") is not True or crashed.get("success") or not crash_times:
+                    raise RuntimeError(f"unexpected round: {json.dumps([ok.get('error'), crashed.get('error')])}")
+                crash_at = float(crash_times[-1])
+                rounds.append({
+                    "mode": mode,
+                    "detection_seconds": round(returned_at - crash_at, 3),
+                    "restart_seconds": round(ready_at - crash_at, 3),
+                    "error": crashed["error"],
+                    "exit": process.get("last_exit"),
+                    "traceback_in_debug": "OutOfMemoryError" in process.get("log_tail", ""),
+                })
+            after, _ = run_job(handler, len(rounds) * 2)
+        finally:
+            if handler.SUPERVISOR.process is not None:
+                handler.SUPERVISOR.process.kill()
+
+    print(json.dumps({"rounds": rounds, "job_after_restarts_ok": bool(after.get("success")),
+                      "supervisor": handler.SUPERVISOR.stats}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
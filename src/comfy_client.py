@@ -0,0 +1,179 @@
+"""HTTP client for ComfyUI's API, shared by every job of the handler."""
+import logging
+import random
+import threading
+import time
+from typing import Optional, Dict
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+log = logging.getLogger("handler")
+
+
+class ComfyClient:
+    """ComfyUI's HTTP API over one pooled keep-alive session.
+
+    Every endpoint has its own (connect, read) timeout. Idempotent calls are retried on
+    connection errors, timeouts and 5xx with jittered exponential backoff; /prompt is only
+    retried when the connection was never established, so a prompt can't be queued twice.
+    /object_info is fetched once and used to validate client workflows locally.
+    """
+    
+    TIMEOUTS = {
+        "/prompt": (3.05, 30),
+        "/history": (3.05, 10),
+        "/queue": (3.05, 5),
+        "/interrupt": (3.05, 5),
+        "/free": (3.05, 30),
+        "/system_stats": (2, 2),
+        "/object_info": (3.05, 60),
+    }
+    DEFAULT_TIMEOUT = (3.05, 10)
+    
+    def __init__(self, base_url: str, retries: int, backoff: float, pool_size: int):
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.node_info = None
+    
+    def request(self, method: str, path: str, retries: Optional[int] = None, **kwargs) -> requests.Response:
+        """Send one request with the endpoint's timeout and retry policy"""
+        endpoint = "/" + path.lstrip("/").split("/", 1)[0]
+        timeout = self.TIMEOUTS.get(endpoint, self.DEFAULT_TIMEOUT)
+        idempotent = not (method == "POST" and endpoint == "/prompt")
+        attempts = 1 + (self.retries if retries is None else retries)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                response = self.session.request(method, self.base_url + path, timeout=timeout, **kwargs)
+                if response.status_code < 500 or not idempotent or last_attempt:
+                    return response
+                log.debug(f"ComfyUI {method} {endpoint} returned {response.status_code}, retrying")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last_attempt or not (idempotent or self._never_sent(e)):
+                    raise
+                log.debug(f"ComfyUI {method} {endpoint} failed ({e}), retrying")
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+    
+    @staticmethod
+    def _never_sent(error: Exception) -> bool:
+        """True if the request failed before reaching the server (safe to resend anything)"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    
+    def responding(self) -> bool:
+        try:
+            return self.request("GET", "/system_stats", retries=0).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    
+    def system_stats(self) -> Dict:
+        response = self.request("GET", "/system_stats")
+        response.raise_for_status()
+        return response.json()
+    
+    def queue_prompt(self, workflow: Dict, client_id: str) -> str:
+        """Queue a workflow; returns its prompt_id or raises RuntimeError with ComfyUI's reason"""
+        response = self.request("POST", "/prompt", json={"prompt": workflow, "client_id": client_id})
+        if not response.ok:
+            raise RuntimeError(f"Failed to queue workflow: {response.text}")
+        prompt_id = response.json().get("prompt_id")
+        if not prompt_id:
+            raise RuntimeError("No prompt_id returned")
+        return prompt_id
+    
+    def history(self, prompt_id: str, retries: Optional[int] = None) -> Optional[Dict]:
+        """History entry for prompt_id, or None if it has not finished yet"""
+        response = self.request("GET", f"/history/{prompt_id}", retries=retries)
+        return response.json().get(prompt_id) if response.ok else None
+    
+    def queue(self) -> Dict:
+        response = self.request("GET", "/queue")
+        response.raise_for_status()
+        return response.json()
+    
+    def delete_queued(self, prompt_ids: list):
+        self.request("POST", "/queue", json={"delete": prompt_ids})
+    
+    def interrupt(self, prompt_id: Optional[str] = None):
+        """Interrupt the running prompt; with prompt_id, only if that prompt is the one running"""
+        self.request("POST", "/interrupt", json={"prompt_id": prompt_id} if prompt_id else {})
+    
+    def free(self, unload_models: bool = True, free_memory: bool = True):
+        self.request("POST", "/free", json={"unload_models": unload_models, "free_memory": free_memory})
+    
+    def object_info(self) -> Optional[Dict]:
+        """Node definitions, fetched once per ComfyUI process; None if they can't be loaded"""
+        with self.lock:
+            if self.node_info is None:
+                try:
+                    response = self.request("GET", "/object_info")
+                    response.raise_for_status()
+                    self.node_info = response.json()
+                    log.debug(f"📚 Cached /object_info ({len(self.node_info)} node types)")
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    log.warning(f"⚠️ Could not load /object_info, skipping workflow validation: {e}")
+            return self.node_info
+    
+    def reset(self):
+        """Forget everything tied to the current ComfyUI process (called when it exits)"""
+        with self.lock:
+            self.node_info = None
+        self.session.close()  # drop keep-alive connections to the dead server
+    
+    def validate_workflow(self, workflow: Dict) -> list:
+        """Problems ComfyUI would reject the workflow for, checked against /object_info.
+
+        Covers unknown node types, missing required inputs, links to missing nodes and
+        values outside a combo's options (except upload lists such as LoadImage's, which
+        change as files arrive). Returns [] when /object_info is unavailable.
+        """
+        node_info = self.object_info()
+        if not node_info:
+            return []
+        errors = []
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or "class_type" not in node:
+                errors.append(f"Node {node_id}: missing class_type")
+                continue
+            class_type = node["class_type"]
+            if class_type not in node_info:
+                errors.append(f"Node {node_id}: unknown node type {class_type}")
+                continue
+            specs = node_info[class_type].get("input", {})
+            required = specs.get("required", {})
+            inputs = node.get("inputs", {})
+            for name in required:
+                if name not in inputs:
+                    errors.append(f"Node {node_id} ({class_type}): missing required input '{name}'")
+            for name, value in inputs.items():
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                    if str(value[0]) not in workflow:
+                        errors.append(f"Node {node_id} ({class_type}): input '{name}' links to missing node {value[0]}")
+                    continue
+                options = self._combo_options(required.get(name) or specs.get("optional", {}).get(name))
+                if options and value not in options:
+                    errors.append(f"Node {node_id} ({class_type}): '{name}' value {value!r} is not one of {options[:10]}")
+        return errors
+    
+    @staticmethod
+    def _combo_options(spec) -> Optional[list]:
+        """Allowed values of a combo input spec (old list form or "COMBO" with options)"""
+        if not isinstance(spec, list) or not spec:
+            return None
+        extra = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+        if extra.get("image_upload"):
+            return None
+        if isinstance(spec[0], list):
+            return spec[0]
+        if spec[0] == "COMBO":
+            return extra.get("options")
+        return None
@@ -8,86 +8,1068 @@ import time
 import subprocess
 import hashlib
 import shutil
-import glob
 import random
-from typing import Optional, Dict, Any
+import math
+import mmap
+import struct
+import threading
+import asyncio
+import logging
+import http.server
+import contextlib
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from queue import SimpleQueue
+from typing import Optional, Dict, Any, Callable
+
+from runpod.http_client import AsyncClientSession
+from runpod.serverless.modules.rp_http import send_result
+
+from comfy_client import ComfyClient
+
+try:
+    import websocket  # websocket-client; optional, we fall back to polling without it
+except ImportError:
+    websocket = None
+
+try:
+    import boto3  # optional, only needed for the S3 output sink
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+
+# Leveled logging; set LOG_LEVEL=WARNING in production to silence per-job chatter
+log = logging.getLogger("handler")
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log.addHandler(_log_handler)
+    log.propagate = False
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Progress streaming: sampler steps and latent previews are sent as RunPod progress updates
+PREVIEW_METHOD = os.environ.get("PREVIEW_METHOD", "auto")  # ComfyUI --preview-method; "none" disables previews
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", 1.0))
+PREVIEW_MIN_INTERVAL = float(os.environ.get("PREVIEW_MIN_INTERVAL", 3.0))
+PROGRESS_FLUSH_TIMEOUT = float(os.environ.get("PROGRESS_FLUSH_TIMEOUT", 10))  # wait for queued updates before returning
+
+# Per-stage latency metrics, exposed in Prometheus text format on METRICS_PORT and/or METRICS_FILE
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", 2048))  # samples kept per stage for percentiles
+
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://localhost:8188")
+COMFYUI_WS_URL = COMFYUI_URL.replace("http", "ws", 1)
+
+# ComfyUI HTTP client: one keep-alive pool, per-endpoint timeouts, jittered retries
+COMFYUI_HTTP_RETRIES = int(os.environ.get("COMFYUI_HTTP_RETRIES", 3))
+COMFYUI_HTTP_BACKOFF = float(os.environ.get("COMFYUI_HTTP_BACKOFF", 0.2))  # seconds before the first retry
+WORKFLOW_VALIDATION = os.environ.get("WORKFLOW_VALIDATION", "1") == "1"  # check client workflows against /object_info
+
+# Completion polling (only used when the websocket is unavailable or drops)
+POLL_INITIAL_INTERVAL = 0.25
+POLL_MAX_INTERVAL = 3.0
+
+# Model residency: keep weights (and ComfyUI's node cache) loaded between jobs
+RESIDENCY_IDLE_TTL = float(os.environ.get("RESIDENCY_IDLE_TTL", 900))  # seconds idle before unloading
+RESIDENCY_MIN_FREE_VRAM_GB = float(os.environ.get("RESIDENCY_MIN_FREE_VRAM_GB", 2.0))
+
+# Content-addressed input images
+INPUT_DIR = os.environ.get("COMFYUI_INPUT_DIR", "/ComfyUI/input")
+INPUT_STORE_MAX_BYTES = int(os.environ.get("INPUT_STORE_MAX_BYTES", 2 * 1024**3))
+INPUT_DECODE_CHUNK_CHARS = 4 * 1024**2  # base64 characters decoded at a time (multiple of 4)
+
+# Deterministic result cache (only jobs with an explicit seed)
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/ComfyUI/result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 5 * 1024**3))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 24 * 3600))
+
+# Delivered outputs are kept within a size/age budget, then deleted or archived
+OUTPUT_DIR = os.environ.get("COMFYUI_OUTPUT_DIR", "/ComfyUI/output")
+OUTPUT_RETENTION_MAX_BYTES = int(os.environ.get("OUTPUT_RETENTION_MAX_BYTES", 2 * 1024**3))
+OUTPUT_RETENTION_MAX_AGE = float(os.environ.get("OUTPUT_RETENTION_MAX_AGE", 3600))
+OUTPUT_ARCHIVE_DIR = os.environ.get("OUTPUT_ARCHIVE_DIR")  # move instead of delete when set
+
+# Output sink: "base64" inlines the video, "s3" uploads it, "auto" inlines only small files
+BUCKET_ENDPOINT_URL = os.environ.get("BUCKET_ENDPOINT_URL")
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "auto" if BUCKET_ENDPOINT_URL else "base64")
+OUTPUT_INLINE_MAX_BYTES = int(os.environ.get("OUTPUT_INLINE_MAX_BYTES", 8 * 1024**2))
+OUTPUT_ENCODE_CHUNK_BYTES = 3 * 1024**2  # multiple of 3 (whole base64 groups) and of the page size
+S3_UPLOAD_CHUNK_BYTES = int(os.environ.get("S3_UPLOAD_CHUNK_BYTES", 16 * 1024**2))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", 8))
+S3_PRESIGN_EXPIRY = int(os.environ.get("S3_PRESIGN_EXPIRY", 7 * 24 * 3600))
+
+# Resolution bucketing: snap sizes/frame counts to a small set of shapes so kernel caches stay warm
+RESOLUTION_BUCKETING = os.environ.get("RESOLUTION_BUCKETING", "0") == "1"
+RESOLUTION_BUCKETS = os.environ.get(
+    "RESOLUTION_BUCKETS", "512x512,640x640,768x512,512x768,832x480,480x832,1024x1024,1280x720,720x1280"
+)
+RESOLUTION_BUCKET_PREWARM = os.environ.get("RESOLUTION_BUCKET_PREWARM", "0") == "1"
+# Frame counts to prewarm per bucket (snapped to 4k + 1); the default is a 5 s, 24 fps job,
+# which is also the length of a segment. Each entry costs one full-length 1-step run per
+# bucket at startup (seconds per bucket on a large GPU), so list only the lengths jobs use
+RESOLUTION_BUCKET_PREWARM_FRAMES = os.environ.get("RESOLUTION_BUCKET_PREWARM_FRAMES", str(5 * 24))
+WAN_TEMPORAL_STRIDE = 4  # WAN's VAE compresses time by 4, valid lengths are 4k + 1
+
+# Model staging: copy weights from the network volume to local disk once per boot
+MODEL_MANIFEST = os.environ.get("MODEL_MANIFEST", "/runpod-volume/models_manifest.json")
+MODEL_STAGING_DIR = os.environ.get("MODEL_STAGING_DIR", "/models-local")  # empty = use the volume directly
+MODEL_STAGING_CHUNK_BYTES = int(os.environ.get("MODEL_STAGING_CHUNK_BYTES", 64 * 1024**2))
+MODEL_STAGING_WORKERS = int(os.environ.get("MODEL_STAGING_WORKERS", 8))
+MODEL_STAGING_BUFFER_BYTES = int(os.environ.get("MODEL_STAGING_BUFFER_BYTES", 8 * 1024**2))  # per thread, reused
+COMFYUI_MODELS_DIR = os.environ.get("COMFYUI_MODELS_DIR", "/ComfyUI/models")
+
+# Used when no manifest file exists; size/sha256 are then taken from the first copy
+DEFAULT_MODEL_MANIFEST = [
+    {
+        "name": "wan_model",
+        "path": "/runpod-volume/checkpoints/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors",
+        "comfy_path": "checkpoints/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors",
+    },
+    # VAE is built into the checkpoint, no separate file needed
+    {
+        "name": "clip_vision",
+        "path": "/runpod-volume/clip_vision/clip_vision_vit_h.safetensors",
+        "comfy_path": "clip_vision/clip_vision_vit_h.safetensors",
+    },
+]
+
+# Jobs accepted at once; CPU stages run on worker threads while ComfyUI's queue keeps the GPU busy
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 3))
+
+# Segmented generation: long videos are rendered as fixed-length segments chained on the last frame
+SEGMENT_SECONDS = float(os.environ.get("SEGMENT_SECONDS", 5))  # 0 disables segmenting
+SEGMENT_THRESHOLD_SECONDS = float(os.environ.get("SEGMENT_THRESHOLD_SECONDS", 10))  # longer requests are segmented
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+
+# Renditions: extra encodes of the finished video (web previews, posters) made with ffmpeg
+RENDITION_WORKERS = int(os.environ.get("RENDITION_WORKERS", max(1, (os.cpu_count() or 1) // 2)))  # ffmpeg processes at once
+RENDITION_THREADS = max(1, (os.cpu_count() or 1) // RENDITION_WORKERS)  # encoder threads per ffmpeg process
+RENDITIONS_MAX = int(os.environ.get("RENDITIONS_MAX", 8))
+
+# Multi-image jobs: every entry of the images array becomes its own prompt
+MAX_IMAGES_PER_JOB = int(os.environ.get("MAX_IMAGES_PER_JOB", 16))
+
+# Runtime prediction: a cost model fitted on finished jobs drives admission control and per-job deadlines
+COST_MODEL_PATH = os.environ.get("COST_MODEL_PATH", "/runpod-volume/cost_model.json")  # empty = don't persist
+COST_MODEL_MIN_SAMPLES = int(os.environ.get("COST_MODEL_MIN_SAMPLES", 5))  # predictions are ignored below this
+COST_MODEL_DECAY = float(os.environ.get("COST_MODEL_DECAY", 0.98))  # weight kept by older observations
+JOB_TIME_BUDGET = float(os.environ.get("JOB_TIME_BUDGET", 600))  # seconds; match the endpoint's execution timeout
+DEADLINE_FACTOR = float(os.environ.get("DEADLINE_FACTOR", 2.0))  # deadline = prediction * factor, within budget
+DEADLINE_MIN_SECONDS = float(os.environ.get("DEADLINE_MIN_SECONDS", 60))
+CANCEL_CHECK_INTERVAL = 1.0  # seconds between cancellation checks while waiting on a prompt
+
+# Cold start: ComfyUI is launched and warmed up in the background; jobs wait on COMFYUI_READY
+COMFYUI_START_TIMEOUT = float(os.environ.get("COMFYUI_START_TIMEOUT", 120))
+COMFYUI_READY = threading.Event()
+PROCESS_START = time.time()
+COLD_START = {}  # stage -> seconds since the worker process started
+
+# Process supervision: a ComfyUI crash fails in-flight jobs at once and ComfyUI is restarted
+COMFYUI_LOG_BUFFER_BYTES = int(os.environ.get("COMFYUI_LOG_BUFFER_BYTES", 64 * 1024))  # output kept for error reports
+COMFYUI_RESTART_BACKOFF = float(os.environ.get("COMFYUI_RESTART_BACKOFF", 1.0))  # seconds before a restart, doubling
+COMFYUI_RESTART_BACKOFF_MAX = float(os.environ.get("COMFYUI_RESTART_BACKOFF_MAX", 60))
 
 # Global model cache for preloading
 PRELOADED_MODELS = {}
 
+def mark_cold_start(stage: str):
+    """Record when a cold-start stage finished"""
+    COLD_START[stage] = round(time.time() - PROCESS_START, 3)
+    log.info(f"⏱️ Cold start: {stage} at {COLD_START[stage]}s")
+
+MODEL_STATUS = {}  # model name -> status string, filled once by ensure_models()
+MODEL_STATUS_LOCK = threading.Lock()
+MODELS_READY = False
+
+def load_model_manifest() -> list:
+    """Read the model manifest (list of {name, path, comfy_path, size, sha256})"""
+    if os.path.exists(MODEL_MANIFEST):
+        with open(MODEL_MANIFEST) as f:
+            manifest = json.load(f)
+        return manifest.get("models", manifest) if isinstance(manifest, dict) else manifest
+    return DEFAULT_MODEL_MANIFEST
+
+class ChecksumMismatch(ValueError):
+    """A model on the volume doesn't match its manifest entry"""
+
+def copy_and_verify(source: str, target: str, size: int, expected_sha256: Optional[str]) -> str:
+    """Copy source to target in parallel chunks and hash the copy; returns the sha256.
+
+    Workers copy MODEL_STAGING_CHUNK_BYTES chunks through their own reused buffer, and
+    each finished chunk is hashed in order by reading it back from the target (still in
+    the page cache), so memory stays at (workers + 1) buffers however large the model is.
+    """
+    partial = f"{target}.partial"
+    digest = hashlib.sha256()
+    buffers = threading.local()
+    
+    def read_into(fd: int, view: memoryview, offset: int, path: str) -> int:
+        read = os.preadv(fd, [view], offset)
+        if not read:
+            raise IOError(f"{path} is shorter than expected ({offset} < {size})")
+        return read
+    
+    try:
+        with open(source, "rb") as src, open(partial, "w+b") as dst:
+            dst.truncate(size)
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            
+            def copy_chunk(offset):
+                if not hasattr(buffers, "view"):
+                    buffers.view = memoryview(bytearray(MODEL_STAGING_BUFFER_BYTES))
+                end = min(offset + MODEL_STAGING_CHUNK_BYTES, size)
+                while offset < end:
+                    read = read_into(src_fd, buffers.view[:end - offset], offset, source)
+                    written = 0
+                    while written < read:
+                        written += os.pwrite(dst_fd, buffers.view[written:read], offset + written)
+                    offset += read
+            
+            hash_view = memoryview(bytearray(MODEL_STAGING_BUFFER_BYTES))
+            offsets = range(0, size, MODEL_STAGING_CHUNK_BYTES)
+            with ThreadPoolExecutor(max_workers=MODEL_STAGING_WORKERS) as pool:
+                futures = [pool.submit(copy_chunk, offset) for offset in offsets]
+                try:
+                    for offset, future in zip(offsets, futures):
+                        future.result()
+                        end = min(offset + MODEL_STAGING_CHUNK_BYTES, size)
+                        while offset < end:
+                            read = read_into(dst_fd, hash_view[:end - offset], offset, partial)
+                            digest.update(hash_view[:read])
+                            offset += read
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        
+        sha256 = digest.hexdigest()
+        if expected_sha256 and sha256 != expected_sha256:
+            raise ChecksumMismatch(f"Checksum mismatch for {source}: {sha256} != {expected_sha256}")
+        os.replace(partial, target)
+        return sha256
+    except BaseException:
+        # Short source, I/O error or bad checksum: never leave a half-written copy behind
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+
+def stage_model(model: Dict) -> tuple:
+    """Make one model available locally if possible; returns (path ComfyUI should use, status)"""
+    source = model["path"]
+    size = model.get("size") or os.path.getsize(source)
+    if model.get("size") and os.path.getsize(source) != size:
+        raise ChecksumMismatch(f"{source} is {os.path.getsize(source)} bytes, manifest says {size}")
+    if not MODEL_STAGING_DIR:
+        return source, "volume"
+    
+    target = os.path.join(MODEL_STAGING_DIR, model["comfy_path"])
+    marker = f"{target}.verified"
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    
+    # A previous boot on this disk may already have staged and verified it
+    if os.path.exists(target) and os.path.exists(marker):
+        with open(marker) as f:
+            verified = json.load(f)
+        stat = os.stat(target)
+        if verified.get("size") == size == stat.st_size and verified.get("mtime") == stat.st_mtime \
+                and (not model.get("sha256") or verified.get("sha256") == model["sha256"]):
+            return target, "staged (verified earlier)"
+    
+    if shutil.disk_usage(MODEL_STAGING_DIR).free < size:
+        log.warning(f"⚠️ Not enough local disk to stage {model['name']}, using the volume copy")
+        return source, "volume (no local space)"
+    
+    copy_start = time.time()
+    sha256 = copy_and_verify(source, target, size, model.get("sha256"))
+    seconds = time.time() - copy_start
+    with open(marker, "w") as f:
+        json.dump({"size": size, "sha256": sha256, "mtime": os.stat(target).st_mtime}, f)
+    log.info(f"📦 Staged {model['name']} ({size / (1024**3):.2f} GB in {seconds:.1f}s, {size / (1024**2) / max(seconds, 1e-6):.0f} MB/s)")
+    return target, f"staged in {seconds:.1f}s"
+
+def point_comfyui_at(comfy_path: str, model_path: str):
+    """Atomically (re)point ComfyUI's model entry at model_path"""
+    link = os.path.join(COMFYUI_MODELS_DIR, comfy_path)
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    if os.path.islink(link) and os.readlink(link) == model_path:
+        return
+    tmp_link = f"{link}.{uuid.uuid4().hex}.tmp"
+    os.symlink(model_path, tmp_link)
+    os.replace(tmp_link, link)
+    log.info(f"🔗 {link} -> {model_path}")
+
+def ensure_models() -> list:
+    """Stage and link every manifest model once per process; returns the missing ones.
+
+    The result is cached, so after the first successful call jobs skip every filesystem check.
+    """
+    global MODELS_READY
+    if MODELS_READY:
+        return []
+    
+    with MODEL_STATUS_LOCK:
+        if MODELS_READY:
+            return []
+        missing = []
+        for model in load_model_manifest():
+            if not os.path.exists(model["path"]):
+                missing.append(f"{model['name']} ({model['path']})")
+                MODEL_STATUS[model["name"]] = "NOT FOUND"
+                log.error(f"❌ Missing model: {model['path']}")
+                continue
+            try:
+                try:
+                    model_path, status = stage_model(model)
+                except ChecksumMismatch as e:
+                    # Could be a torn read off the network volume: copy once more before giving up
+                    log.warning(f"⚠️ {e}, copying {model['name']} again")
+                    model_path, status = stage_model(model)
+            except ChecksumMismatch as e:
+                # A corrupt model must fail jobs like a missing one, not be loaded anyway
+                missing.append(f"{model['name']} ({e})")
+                MODEL_STATUS[model["name"]] = "INVALID"
+                log.error(f"❌ Invalid model: {e}")
+                continue
+            except Exception as e:
+                log.warning(f"⚠️ Staging {model['name']} failed, using the volume copy: {e}")
+                model_path, status = model["path"], f"volume (staging failed: {e})"
+            point_comfyui_at(model["comfy_path"], model_path)
+            MODEL_STATUS[model["name"]] = status
+        
+        if not missing:
+            MODELS_READY = True
+            mark_cold_start("models_staged")
+        return missing
+
+def store_placeholder_image() -> str:
+    """Put a small grey PNG in the input store for warm-up runs; returns its stored name"""
+    from PIL import Image
+    import io
+    
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (127, 127, 127)).save(buffer, format="PNG")
+    return INPUT_STORE.put(base64.b64encode(buffer.getvalue()).decode(), "placeholder.png")[0]
+
+def warm_up():
+    """Run a tiny generation so the checkpoint and CLIP vision are really loaded before the first job"""
+    stored_name = store_placeholder_image()
+    workflow = create_comfyui_workflow(stored_name, {
+        "resolution": "256x256", "duration": 1, "fps": 1, "steps": 1, "seed": 0
+    })
+    workflow["11"]["inputs"]["save_output"] = False
+    
+    loader_nodes = {"1", "2", "3"}
+    
+    def on_event(event_type, data):
+        node = data.get("node")
+        if event_type == "executing" and node is not None and node not in loader_nodes and "weights_loaded" not in COLD_START:
+            mark_cold_start("weights_loaded")
+        elif event_type == "executing" and node == "10":
+            mark_cold_start("first_sample")
+    
+    _, result = queue_and_wait(workflow, COMFYUI_START_TIMEOUT * 5, on_event=on_event)
+    if result is None or result.get("status", {}).get("status_str") == "error":
+        log.warning("⚠️ Warm-up generation failed, first job will load the models")
+        return
+    for stage in ("weights_loaded", "first_sample"):
+        COLD_START.setdefault(stage, round(time.time() - PROCESS_START, 3))
+    OUTPUT_RETENTION.add(output_files_from_history(result.get("outputs", {}), workflow)[1])
+    MODEL_RESIDENCY.mark_loaded(workflow)
+
 def preload_models():
-    """Preload models into memory during container startup for instant access"""
+    """Start ComfyUI and load models during container startup; runs on a background thread"""
     global PRELOADED_MODELS
     
     if PRELOADED_MODELS:
-        print("✅ Models already preloaded!")
+        log.info("✅ Models already preloaded!")
         return
         
-    print("🔥 Preloading models for instant job processing...")
+    log.info("🔥 Preloading models for instant job processing...")
     
     try:
-        # Check if models exist first
-        wan_path = "/runpod-volume/checkpoints/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"
-        clip_path = "/runpod-volume/clip_vision/clip_vision_vit_h.safetensors"
-        
-        if not os.path.exists(wan_path):
-            print(f"⚠️ WAN model not found at {wan_path}, skipping preload")
-            return
-            
-        if not os.path.exists(clip_path):
-            print(f"⚠️ CLIP model not found at {clip_path}, skipping preload")
+        # Copy models to local disk and point ComfyUI at them
+        missing_models = ensure_models()
+        if missing_models:
+            log.warning(f"⚠️ Missing models {missing_models}, skipping preload")
             return
         
-        # Note: We don't actually load the safetensors here because ComfyUI handles that
-        # Instead, we'll just trigger ComfyUI to start and load models once
-        print("🚀 Starting ComfyUI to preload models...")
+        log.info("🚀 Starting ComfyUI to preload models...")
+        if not start_comfyui():
+            log.error("❌ Failed to preload models")
+            return
         
-        # Start ComfyUI which will load models into its memory
-        if start_comfyui():
-            print("✅ ComfyUI started with models preloaded!")
-            PRELOADED_MODELS["status"] = "loaded"
-        else:
-            print("❌ Failed to preload models")
+        # start_comfyui() has already opened the readiness gate, so jobs may queue
+        # alongside the warm-up instead of waiting for it
+        warm_up()
+        COMFY.object_info()  # cache node definitions for client workflow validation
+        log.info("✅ ComfyUI started with models preloaded!")
+        PRELOADED_MODELS["status"] = "loaded"
+        if RESOLUTION_BUCKETING and RESOLUTION_BUCKET_PREWARM:
+            prewarm_buckets()
             
     except Exception as e:
-        print(f"⚠️ Model preloading failed: {e}")
+        log.warning(f"⚠️ Model preloading failed: {e}")
+    finally:
+        PRELOADED_MODELS.setdefault("status", "failed")
+        STARTUP_DONE.set()
+
+STARTUP_DONE = threading.Event()
+
+def wait_for_comfyui() -> bool:
+    """Readiness gate for jobs: wait for the background startup instead of probing the server each job"""
+    if COMFYUI_READY.is_set():
+        return True
+    STARTUP_DONE.wait(COMFYUI_START_TIMEOUT)
+    if COMFYUI_READY.is_set():
+        return True
+    # Background startup was skipped or failed; try once more from this job
+    return start_comfyui()
+
+def prewarm_buckets():
+    """Run a 1-step generation per bucket and prewarm frame count so each shape's kernels are
+    tuned before the first job.
+
+    The latent's time axis is part of the shape, so a short run would leave the kernels of
+    real-length jobs cold; every run uses the full frame count.
+    """
+    stored_name = store_placeholder_image()
+    frame_counts = sorted({snap_frame_count(int(n)) for n in RESOLUTION_BUCKET_PREWARM_FRAMES.split(",") if n.strip()})
+    
+    for width, height in BUCKET_TABLE:
+        for frames in frame_counts:
+            bucket_start = time.time()
+            workflow = create_comfyui_workflow(stored_name, {
+                "resolution": f"{width}x{height}", "frames": frames, "steps": 1, "seed": 0
+            })
+            workflow["11"]["inputs"]["save_output"] = False
+            try:
+                _, result = queue_and_wait(workflow, 300)
+                if result is not None:
+                    OUTPUT_RETENTION.add(output_files_from_history(result.get("outputs", {}), workflow)[1])
+                log.info(f"🪣 Prewarmed bucket {width}x{height}, {frames} frames in {time.time() - bucket_start:.1f}s")
+            except Exception as e:
+                log.warning(f"⚠️ Failed to prewarm bucket {width}x{height}, {frames} frames: {e}")
+
+COMFY = ComfyClient(COMFYUI_URL, COMFYUI_HTTP_RETRIES, COMFYUI_HTTP_BACKOFF, max(10, JOB_CONCURRENCY * 4))
+
+class ModelResidency:
+    """Keeps the loaded checkpoint/CLIP vision warm across jobs and decides when to /free.
+
+    ComfyUI keeps weights and cached node outputs (text/CLIP vision encodings) as long as
+    we don't call /free, so we only unload when free VRAM drops below the threshold, the
+    worker has been idle for RESIDENCY_IDLE_TTL, a job needs a different set of models,
+    or a node raised while executing (to recover from OOMs). Timeouts, cancellations and
+    delivery failures leave the models loaded.
+    """
+    
+    def __init__(self, idle_ttl: float, min_free_vram_gb: float):
+        self.idle_ttl = idle_ttl
+        self.min_free_vram = min_free_vram_gb * (1024**3)
+        self.loaded_key = None
+        self.active_jobs = 0
+        self.lock = threading.Lock()
+        self.idle_timer = None
+        self.stats = {"warm": 0, "cold": 0, "warm_seconds": 0.0, "cold_seconds": 0.0, "unloads": {}}
+    
+    @staticmethod
+    def model_key(workflow: Dict) -> tuple:
+        """Identify the set of models a workflow loads"""
+        key = []
+        for node in workflow.values():
+            if not isinstance(node, dict):
+                continue
+            inputs = node.get("inputs", {})
+            for field in ("ckpt_name", "clip_name", "unet_name", "vae_name"):
+                if isinstance(inputs.get(field), str):
+                    key.append((node.get("class_type"), inputs[field]))
+        return tuple(sorted(key))
+    
+    def acquire(self, workflow: Dict) -> tuple:
+        """Register a job about to run; returns (model_key, warm)"""
+        key = self.model_key(workflow)
+        unload = False
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            if self.loaded_key is not None and self.loaded_key != key and self.active_jobs == 0:
+                unload = self._unload("checkpoint change")
+            warm = self.loaded_key == key
+            self.active_jobs += 1
+        if unload:
+            self._free()  # still before this job queues its prompt
+        return key, warm
+    
+    def release(self, key: tuple, warm: bool, seconds: float, success: bool, execution_error: bool = False):
+        """Record a finished job and unload if memory is tight or a node failed executing it"""
+        # Probe VRAM before taking the lock so concurrent acquire() calls never wait on HTTP
+        free_vram = self._free_vram() if success else None
+        unload = False
+        with self.lock:
+            self.active_jobs -= 1
+            label = "warm" if warm else "cold"
+            self.stats[label] += 1
+            self.stats[f"{label}_seconds"] += seconds
+            
+            if execution_error:
+                if self.active_jobs == 0:
+                    unload = self._unload("execution error")
+            elif success:
+                self.loaded_key = key
+                if free_vram is not None and free_vram < self.min_free_vram and self.active_jobs == 0:
+                    unload = self._unload("memory threshold")
+            
+            if self.active_jobs == 0 and self.loaded_key is not None and self.idle_ttl > 0:
+                self.idle_timer = threading.Timer(self.idle_ttl, self._expire)
+                self.idle_timer.daemon = True
+                self.idle_timer.start()
+        if unload:
+            self._free()
+    
+    def mark_loaded(self, workflow: Dict):
+        """Record models loaded outside a job (startup warm-up)"""
+        with self.lock:
+            self.loaded_key = self.model_key(workflow)
+    
+    def forget(self, reason: str):
+        """Record that the models are gone without calling /free (ComfyUI exited)"""
+        with self.lock:
+            self.loaded_key = None
+            self.stats["unloads"][reason] = self.stats["unloads"].get(reason, 0) + 1
+    
+    def summary(self) -> Dict[str, Any]:
+        """Hit rate and warm/cold latency for the debug block"""
+        warm, cold = self.stats["warm"], self.stats["cold"]
+        total = warm + cold
+        return {
+            "jobs": total,
+            "hit_rate": round(warm / total, 3) if total else None,
+            "avg_warm_seconds": round(self.stats["warm_seconds"] / warm, 2) if warm else None,
+            "avg_cold_seconds": round(self.stats["cold_seconds"] / cold, 2) if cold else None,
+            "unloads": dict(self.stats["unloads"]),
+        }
+    
+    def _expire(self):
+        with self.lock:
+            unload = self.active_jobs == 0 and self.loaded_key is not None and self._unload("idle ttl")
+        if unload:
+            self._free()
+    
+    def _free_vram(self) -> Optional[float]:
+        try:
+            devices = COMFY.system_stats().get("devices", [])
+            if devices:
+                return devices[0].get("vram_free")
+        except Exception:
+            pass
+        return None
+    
+    def _unload(self, reason: str) -> bool:
+        """Record the unload; must be called with self.lock held, and the caller then sends
+        /free with _free() after releasing it, so acquire() never waits on HTTP. Returns True.
+        """
+        log.info(f"🧹 Unloading models ({reason})")
+        self.loaded_key = None
+        self.stats["unloads"][reason] = self.stats["unloads"].get(reason, 0) + 1
+        return True
+    
+    def _free(self):
+        """POST /free; must be called without self.lock held"""
+        try:
+            if SUPERVISOR.alive():  # a dead ComfyUI has nothing loaded
+                COMFY.free()
+        except requests.exceptions.RequestException as e:
+            log.warning(f"⚠️ Failed to free models: {e}")
+
+MODEL_RESIDENCY = ModelResidency(RESIDENCY_IDLE_TTL, RESIDENCY_MIN_FREE_VRAM_GB)
+
+class ComfyUIExited(RuntimeError):
+    """ComfyUI's process exited while a prompt was waiting on it"""
+
+class ComfyUISupervisor:
+    """Owns the ComfyUI process this worker starts.
+
+    Its stdout/stderr are drained into a ring buffer holding the last `log_bytes` bytes,
+    so failures can be reported with ComfyUI's own output. A watcher thread blocks on the
+    process, so an exit is noticed immediately: events registered with watch() are set
+    (in-flight jobs fail instead of polling a dead port until their deadline), state
+    cached about the old process is dropped and ComfyUI is restarted after an
+    exponential backoff, which resets once a process has stayed up for `max_backoff`.
+    A ComfyUI that was already running when the worker started is not supervised.
+    """
+    
+    def __init__(self, command: list, cwd: str, log_bytes: int, backoff: float, max_backoff: float):
+        self.command = command
+        self.cwd = cwd
+        self.log_bytes = log_bytes
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.next_backoff = backoff
+        self.process = None
+        self.started_at = None
+        self.generation = 0  # bumped on every exit
+        self.output = deque()
+        self.output_bytes = 0
+        self.waiters = set()
+        self.lock = threading.Lock()
+        self.stats = {"starts": 0, "exits": 0, "last_exit": None}
+    
+    def spawn(self) -> subprocess.Popen:
+        """Start ComfyUI with its output reader and exit watcher"""
+        process = subprocess.Popen(self.command, cwd=self.cwd, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        with self.lock:
+            self.process = process
+            self.started_at = time.time()
+            self.stats["starts"] += 1
+        drain = threading.Thread(target=self._drain, args=(process,), name="comfyui-output", daemon=True)
+        drain.start()
+        threading.Thread(target=self._watch, args=(process, drain), name="comfyui-watch", daemon=True).start()
+        return process
+    
+    @contextlib.contextmanager
+    def watch(self, event: threading.Event):
+        """Set event if ComfyUI exits inside the block; yields the generation for exited_since()"""
+        with self.lock:
+            self.waiters.add(event)
+            generation = self.generation
+        try:
+            yield generation
+        finally:
+            with self.lock:
+                self.waiters.discard(event)
+    
+    def exited_since(self, generation: int) -> bool:
+        return self.generation != generation
+    
+    def alive(self) -> bool:
+        """False while a supervised ComfyUI is dead (exited and not restarted yet)"""
+        process = self.process
+        return process is None or process.poll() is None
+    
+    def tail(self) -> str:
+        """The last log_bytes of ComfyUI's output"""
+        with self.lock:
+            data = b"".join(self.output)[-self.log_bytes:]
+        return data.decode("utf-8", errors="replace")
+    
+    def report(self) -> Dict[str, Any]:
+        """Exit status and recent output for a failed job's debug block"""
+        return {**self.stats, "log_tail": self.tail()}
+    
+    def _drain(self, process: subprocess.Popen):
+        """Copy ComfyUI's output into the ring buffer until the pipe closes"""
+        with process.stdout:
+            for chunk in iter(lambda: process.stdout.read1(64 * 1024), b""):
+                with self.lock:
+                    self.output.append(chunk)
+                    self.output_bytes += len(chunk)
+                    while len(self.output) > 1 and self.output_bytes - len(self.output[0]) >= self.log_bytes:
+                        self.output_bytes -= len(self.output.popleft())
+    
+    def _watch(self, process: subprocess.Popen, drain: threading.Thread):
+        """Wait for the process to exit, fail the prompts waiting on it and restart it"""
+        code = process.wait()
+        # Let the last output (the crash traceback) reach the buffer before jobs report it;
+        # bounded, since a leftover child can hold the pipe open
+        drain.join(0.5)
+        with self.lock:
+            uptime = time.time() - self.started_at
+            self.generation += 1
+            self.stats["exits"] += 1
+            self.stats["last_exit"] = {"code": code, "uptime_seconds": round(uptime, 1)}
+            waiters = list(self.waiters)
+            if uptime >= self.max_backoff:
+                self.next_backoff = self.backoff
+            delay = self.next_backoff
+            self.next_backoff = min(self.next_backoff * 2, self.max_backoff)
+        log.error(f"💥 ComfyUI exited with code {code} after {uptime:.0f}s, restarting in {delay:.0f}s")
+        COMFYUI_READY.clear()
+        for event in waiters:
+            event.set()
+        COMFY.reset()
+        MODEL_RESIDENCY.forget("comfyui exited")
+        
+        # Holding the start lock makes jobs wait for this restart instead of racing the backoff
+        with COMFYUI_START_LOCK:
+            time.sleep(delay)
+            if not start_comfyui():
+                log.error("❌ ComfyUI restart failed")
+
+SUPERVISOR = ComfyUISupervisor(
+    ["python", "main.py", "--listen", "--force-fp16", "--disable-xformers", "--enable-cors-header",
+     "--preview-method", PREVIEW_METHOD],
+    "/ComfyUI", COMFYUI_LOG_BUFFER_BYTES, COMFYUI_RESTART_BACKOFF, COMFYUI_RESTART_BACKOFF_MAX
+)
+
+COMFYUI_START_LOCK = threading.RLock()
+
+def comfyui_responding() -> bool:
+    return COMFY.responding()
 
 def start_comfyui():
     """Start ComfyUI server if not already running"""
-    try:
+    # Concurrent jobs must not race to spawn a second server
+    with COMFYUI_START_LOCK:
         # First check if ComfyUI is already running
-        response = requests.get("http://localhost:8188/system_stats", timeout=2)
-        if response.status_code == 200:
-            print("ComfyUI server is already running!")
+        if comfyui_responding():
+            log.info("ComfyUI server is already running!")
+            COMFYUI_READY.set()
             return True
-    except requests.exceptions.RequestException:
-        pass
-
-    print("Starting ComfyUI server...")
-    
-    # Start ComfyUI with same flags as local (no VRAM flags = smart management)
-    process = subprocess.Popen([
-        "python", "main.py", "--listen", "--force-fp16", "--disable-xformers", "--enable-cors-header"
-    ], 
-        cwd="/ComfyUI",
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
+
+        log.info("Starting ComfyUI server...")
     
-    # Wait for ComfyUI to be ready
-    for i in range(30):  # Wait up to 30 seconds
-        try:
-            response = requests.get("http://localhost:8188/system_stats", timeout=2)
-            if response.status_code == 200:
-                print("ComfyUI server is ready!")
+        # Start ComfyUI with same flags as local (no VRAM flags = smart management)
+        process = SUPERVISOR.spawn()
+        mark_cold_start("process_spawn")
+    
+        # Wait for ComfyUI to be ready, polling quickly at first
+        deadline = time.time() + COMFYUI_START_TIMEOUT
+        interval = 0.1
+        while time.time() < deadline:
+            if comfyui_responding():
+                mark_cold_start("http_ready")
+                log.info("ComfyUI server is ready!")
+                COMFYUI_READY.set()
                 return True
-        except requests.exceptions.RequestException:
-            pass
+            if process.poll() is not None:
+                log.error(f"❌ ComfyUI exited during startup (code {process.returncode}):\n{SUPERVISOR.tail()[-2000:]}")
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 1.0)
+    
+        return False
+
+class InputImageStore:
+    """Content-addressed store for input images in ComfyUI's input directory.
+
+    Files are named after the sha256 of their bytes, so resent images are reused and two
+    jobs can never overwrite each other's input. A second index keyed on the hash of the
+    base64 payload lets a repeated image skip the decode as well as the write. Least
+    recently used files are evicted once the store exceeds max_bytes, except files pinned
+    by a job whose prompt may still read them (put(..., pin=True) until unpin()).
+    """
+    
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # filename -> size, least recently used first
+        self.payload_index = {}  # sha256 of base64 payload -> filename
+        self.pins = {}  # filename -> number of jobs still using it
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._scan()
+    
+    def _scan(self):
+        """Rebuild the LRU order from files already on disk (e.g. after a restart)"""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)  # Left over from an interrupted write
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+    
+    def put(self, image_data: str, image_name: str, timer: Optional["StageTimer"] = None, pin: bool = False) -> tuple:
+        """Store a base64 (or data URI) image; returns (filename, path, size, cache_hit).
+
+        The payload is hashed and decoded in INPUT_DECODE_CHUNK_CHARS slices straight into
+        a temp file, so memory stays bounded no matter how large the image is.
+        """
+        timer = timer or StageTimer()
+        start = image_data.index(',') + 1 if image_data.startswith('data:image') else 0
+        payload_digest = hashlib.sha256()
+        for offset in range(start, len(image_data), INPUT_DECODE_CHUNK_CHARS):
+            payload_digest.update(image_data[offset:offset + INPUT_DECODE_CHUNK_CHARS].encode())
+        payload_hash = payload_digest.hexdigest()
+        ext = os.path.splitext(image_name)[1].lower() or ".png"
+        
+        with self.lock:
+            filename = self.payload_index.get(payload_hash)
+            if filename is not None and filename in self.entries:
+                return self._touch(filename, pin) + (True,)
         
-        print(f"Waiting for ComfyUI... ({i+1}/30)")
-        time.sleep(1)
+        # Write under a temp name so a concurrent reader never sees a partial file
+        tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.tmp")
+        try:
+            with timer.stage("image_decode"):
+                digest, size = self._decode_to(image_data, start, tmp_path)
+            filename = digest + ext
+            path = os.path.join(self.directory, filename)
+            
+            with self.lock:
+                self.payload_index[payload_hash] = filename
+                if filename in self.entries:
+                    return self._touch(filename, pin) + (True,)
+                with timer.stage("input_write"):
+                    os.replace(tmp_path, path)
+                self.entries[filename] = size
+                self.total_bytes += size
+                self.stats["misses"] += 1
+                if pin:
+                    self._pin(filename)
+                self._evict(keep=filename)
+                return filename, path, size, False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def put_file(self, source: str, pin: bool = False) -> tuple:
+        """Store a copy of an existing image file; returns (filename, path, size, cache_hit)"""
+        digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(8 * 1024**2), b""):
+                digest.update(chunk)
+        filename = digest.hexdigest() + (os.path.splitext(source)[1].lower() or ".png")
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            if filename in self.entries:
+                return self._touch(filename, pin) + (True,)
+            tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.tmp")
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self.entries[filename] = size
+            self.total_bytes += size
+            self.stats["misses"] += 1
+            if pin:
+                self._pin(filename)
+            self._evict(keep=filename)
+            return filename, path, size, False
+    
+    def unpin(self, filename: str):
+        """Release a pin taken by put(..., pin=True) once the job's prompt has finished"""
+        with self.lock:
+            count = self.pins.get(filename, 0) - 1
+            if count > 0:
+                self.pins[filename] = count
+            else:
+                self.pins.pop(filename, None)
+                self._evict()
+    
+    @staticmethod
+    def _decode_to(image_data: str, start: int, path: str) -> tuple:
+        """Decode base64 from image_data[start:] into path chunk by chunk; returns (sha256, size)"""
+        digest = hashlib.sha256()
+        size = 0
+        carry = b""
+        with open(path, 'wb') as f:
+            for offset in range(start, len(image_data), INPUT_DECODE_CHUNK_CHARS):
+                # Line breaks would shift the 4-character groups, so strip them and carry the remainder
+                chunk = carry + image_data[offset:offset + INPUT_DECODE_CHUNK_CHARS].encode().translate(None, b" \t\r\n")
+                usable = len(chunk) - len(chunk) % 4
+                carry = chunk[usable:]
+                decoded = base64.b64decode(chunk[:usable])
+                digest.update(decoded)
+                f.write(decoded)
+                size += len(decoded)
+            if carry:
+                decoded = base64.b64decode(carry + b"=" * (-len(carry) % 4))
+                digest.update(decoded)
+                f.write(decoded)
+                size += len(decoded)
+        return digest.hexdigest(), size
+    
+    def _pin(self, filename: str):
+        self.pins[filename] = self.pins.get(filename, 0) + 1
     
-    return False
+    def _touch(self, filename: str, pin: bool = False) -> tuple:
+        if pin:
+            self._pin(filename)
+        self.entries.move_to_end(filename)
+        self.stats["hits"] += 1
+        path = os.path.join(self.directory, filename)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return filename, path, self.entries[filename]
+    
+    def _evict(self, keep: Optional[str] = None):
+        # Pinned files are skipped, so the store can run over max_bytes while jobs hold them
+        for filename in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if filename == keep or filename in self.pins:
+                continue
+            size = self.entries.pop(filename)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+        self.payload_index = {k: v for k, v in self.payload_index.items() if v in self.entries}
+
+INPUT_STORE = InputImageStore(INPUT_DIR, INPUT_STORE_MAX_BYTES)
+
+def point_load_images_at(workflow: Dict, filename: str) -> int:
+    """Rewrite every LoadImage node to read the stored input; returns the number of nodes changed"""
+    changed = 0
+    for node in workflow.values():
+        if isinstance(node, dict) and node.get("class_type") == "LoadImage":
+            node.setdefault("inputs", {})["image"] = filename
+            changed += 1
+    return changed
+
+class ResultCache:
+    """Disk cache of finished videos keyed on (input image hash, normalized workflow).
+
+    The seed is part of the workflow, so only jobs whose seed was chosen explicitly are
+    cacheable; callers must not cache jobs where create_comfyui_workflow drew a random seed.
+    Entries expire after ttl seconds and are evicted least recently used beyond max_bytes.
+    A hit is served through a private hard link in `serving/`, so evicting or replacing
+    the entry can't pull the file out from under a job that is still delivering it.
+    """
+    
+    SEED_FIELDS = ("seed", "noise_seed")
+    
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (size, created), least recently used first
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+        self.serving_dir = os.path.join(directory, "serving")
+        shutil.rmtree(self.serving_dir, ignore_errors=True)  # links left by a previous worker
+        os.makedirs(self.serving_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp4"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for created, key, size in sorted(files):
+            self.entries[key] = (size, created)
+            self.total_bytes += size
+    
+    @classmethod
+    def make_key(cls, image_hash: str, workflow: Dict) -> Optional[str]:
+        """Canonical hash of the job, or None if any sampler has no fixed integer seed"""
+        for node in workflow.values():
+            inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+            for field in cls.SEED_FIELDS:
+                if field in inputs and not isinstance(inputs[field], int):
+                    return None
+        canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(f"{image_hash}:{canonical}".encode()).hexdigest()
+    
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp4")
+    
+    def get(self, key: str) -> Optional[str]:
+        """Path of a private link to the cached video for key, or None on a miss.
+
+        The caller owns the link and must hand it back to release() once delivered.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None or not os.path.exists(self.path(key)):
+                self.stats["misses"] += 1
+                return None
+            # Taken under the lock: put() and eviction only remove entries while holding it
+            private_path = os.path.join(self.serving_dir, f"{key}.{uuid.uuid4().hex}.mp4")
+            try:
+                os.link(self.path(key), private_path)
+            except OSError:
+                shutil.copyfile(self.path(key), private_path)
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += entry[0]
+            return private_path
+    
+    def release(self, private_path: str):
+        """Drop a link returned by get(); the cache entry itself is unaffected"""
+        try:
+            os.remove(private_path)
+        except OSError:
+            pass
+    
+    def put(self, key: str, video_path: str):
+        """Keep a copy of a finished video (hard link when on the same filesystem)"""
+        size = os.path.getsize(video_path)
+        if size > self.max_bytes:
+            return
+        tmp_path = f"{self.path(key)}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(video_path, tmp_path)
+        except OSError:
+            shutil.copyfile(video_path, tmp_path)
+        with self.lock:
+            os.replace(tmp_path, self.path(key))
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][0]
+            self.entries[key] = (size, time.time())
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+    
+    def summary(self) -> Dict[str, Any]:
+        return {**self.stats, "entries": len(self.entries), "bytes": self.total_bytes}
+    
+    def _remove(self, key: str):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+def read_image_size(path: str) -> Optional[tuple]:
+    """(width, height) from the image header (PNG, JPEG, WebP, GIF, BMP) without decoding pixels"""
+    with open(path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:2] == b"BM":
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            if head[12:16] == b"VP8X":
+                return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+            if head[12:16] == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF)
+            if head[12:16] == b"VP8 ":
+                f.seek(26)
+                width, height = struct.unpack("<HH", f.read(4))
+                return width & 0x3FFF, height & 0x3FFF
+        if head[:2] == b"\xff\xd8":
+            # Walk the JPEG segments up to the first start-of-frame marker
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length = f.read(2)
+                if len(length) < 2:
+                    return None
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(struct.unpack(">H", length)[0] - 2, os.SEEK_CUR)
+    return None
 
 def calculate_optimal_resolution(original_width: int, original_height: int, target_total_pixels: int = 512*512) -> tuple:
     """Calculate optimal resolution maintaining aspect ratio"""
@@ -106,6 +1088,32 @@ def calculate_optimal_resolution(original_width: int, original_height: int, targ
     
     return width, height
 
+def parse_buckets(spec: str) -> list:
+    """Parse "WxH,WxH,..." into a list of (width, height)"""
+    buckets = []
+    for item in spec.split(','):
+        if 'x' in item:
+            width_str, height_str = item.strip().split('x')
+            buckets.append((int(width_str), int(height_str)))
+    return buckets
+
+BUCKET_TABLE = parse_buckets(RESOLUTION_BUCKETS)
+
+def snap_to_bucket(width: int, height: int, buckets: list = None) -> tuple:
+    """Pick the bucket with the smallest combined aspect-ratio and pixel-count error"""
+    buckets = buckets or BUCKET_TABLE
+    
+    def error(bucket):
+        aspect_error = abs(math.log((bucket[0] / bucket[1]) / (width / height)))
+        pixel_error = abs(math.log((bucket[0] * bucket[1]) / (width * height)))
+        return aspect_error * 2 + pixel_error  # A wrong aspect ratio distorts the video, weigh it higher
+    
+    return min(buckets, key=error)
+
+def snap_frame_count(frames: int, stride: int = WAN_TEMPORAL_STRIDE) -> int:
+    """Round a frame count to the nearest valid length (stride * k + 1)"""
+    return max(1, int(round((frames - 1) / stride)) * stride + 1)
+
 def create_comfyui_workflow(image_name: str, settings: Dict[str, Any]) -> Dict:
     """Create ComfyUI workflow for WAN 2.2 video generation"""
     
@@ -128,7 +1136,11 @@ def create_comfyui_workflow(image_name: str, settings: Dict[str, Any]) -> Dict:
             target_width, target_height = 768, 512
     
     # Video generation parameters
-    length = (settings.get('duration', 5) * settings.get('fps', 24))  # frames
+    length = settings.get('frames') or (settings.get('duration', 5) * settings.get('fps', 24))  # frames
+    
+    if RESOLUTION_BUCKETING:
+        target_width, target_height = snap_to_bucket(target_width, target_height)
+        length = snap_frame_count(length)
     seed = settings.get('seed', random.randint(0, 1000000))
     
     # Workflow structure matching the working local version
@@ -236,306 +1248,1554 @@ def create_comfyui_workflow(image_name: str, settings: Dict[str, Any]) -> Dict:
     
     return workflow
 
-def handler(job):
-    """RunPod serverless handler for Video Generator App"""
+def connect_websocket(client_id: str):
+    """Open ComfyUI's event stream for client_id, or return None to fall back to polling"""
+    if websocket is None:
+        log.warning("⚠️ websocket-client not installed, falling back to polling")
+        return None
+    try:
+        return websocket.create_connection(f"{COMFYUI_WS_URL}/ws?clientId={client_id}", timeout=5)
+    except Exception as e:
+        log.warning(f"⚠️ Could not connect to ComfyUI websocket, falling back to polling: {e}")
+        return None
+
+def fetch_history(prompt_id: str) -> Optional[Dict]:
+    """Return the history entry for prompt_id, or None if it has not finished yet"""
     try:
-        print("🚀 Handler starting...")
+        # The polling loop is the retry: backing off inside the request would keep a
+        # crash from being noticed until every retry had failed
+        return COMFY.history(prompt_id, retries=0)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log.warning(f"⚠️ Error checking job status: {e}")
+    return None
+
+def parse_preview_frame(message: bytes, prompt_id: str) -> Optional[Dict]:
+    """Decode a binary websocket preview frame into {"image", "format"}, or None"""
+    if len(message) < 8:
+        return None
+    event_type, value = struct.unpack(">II", message[:8])
+    if event_type == 1:  # PREVIEW_IMAGE: value is 1 for JPEG, 2 for PNG
+        return {"image": message[8:], "format": "png" if value == 2 else "jpeg"}
+    if event_type == 4:  # PREVIEW_IMAGE_WITH_METADATA: value is the metadata length
+        metadata = json.loads(message[8:8 + value])
+        if metadata.get("prompt_id") not in (None, prompt_id):
+            return None
+        image_format = "png" if metadata.get("image_type") == "image/png" else "jpeg"
+        return {"image": message[8 + value:], "format": image_format, "node": metadata.get("node_id")}
+    return None
+
+def wait_for_prompt(prompt_id: str, ws, max_wait_time: float, on_event: Optional[Callable] = None,
+                    cancel_event: Optional[threading.Event] = None,
+                    exited: Optional[threading.Event] = None) -> Optional[Dict]:
+    """Block until ComfyUI finishes prompt_id and return its history entry (None on timeout
+    or once cancel_event or exited is set).
+
+    Completion is taken from the websocket events; if the socket is missing or drops,
+    /history is polled with exponential backoff instead. `exited` is set by the
+    supervisor when ComfyUI dies and wakes the polling loop at once.
+    """
+    start_time = time.time()
+    deadline = start_time + max_wait_time
+    finished = False
+    recv_timeout = CANCEL_CHECK_INTERVAL if cancel_event is not None or exited is not None else 30
+    
+    def cancelled():
+        return any(event is not None and event.is_set() for event in (cancel_event, exited))
+    
+    if ws is not None:
+        try:
+            while not finished and time.time() < deadline and not cancelled():
+                ws.settimeout(max(0.1, min(recv_timeout, deadline - time.time())))
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    log.debug(f"⏳ Generating... ({int(time.time() - start_time)}s)")
+                    continue
+                
+                if not message:
+                    raise ConnectionError("websocket closed by server")
+                # Binary frames are latent previews
+                if not isinstance(message, str):
+                    preview = parse_preview_frame(message, prompt_id)
+                    if preview is not None and on_event is not None:
+                        on_event("preview", preview)
+                    continue
+                
+                event = json.loads(message)
+                data = event.get("data") or {}
+                if data.get("prompt_id") != prompt_id:
+                    continue
+                
+                event_type = event.get("type")
+                if on_event is not None:
+                    on_event(event_type, data)
+                if event_type in ("execution_success", "execution_error", "execution_interrupted"):
+                    finished = True
+                elif event_type == "executing" and data.get("node") is None:
+                    finished = True
+        except Exception as e:
+            # A crash closes the socket first; give the supervisor a moment to see the exit
+            if exited is not None and exited.wait(0.1):
+                return None
+            log.warning(f"⚠️ Websocket dropped, falling back to polling: {e}")
+    
+    # History is written around the final event, so after completion we only
+    # need a few fast polls; without the socket we back off up to POLL_MAX_INTERVAL
+    interval = 0.02 if finished else POLL_INITIAL_INTERVAL
+    while True:
+        if exited is not None and exited.is_set():
+            return None
+        result = fetch_history(prompt_id)
+        if result is not None:
+            return result
+        
+        remaining = deadline - time.time()
+        if remaining <= 0 or cancelled():
+            return None
+        if exited is not None:
+            # Exits wake us at once; cancellation is checked every CANCEL_CHECK_INTERVAL
+            exited.wait(min(interval, remaining, CANCEL_CHECK_INTERVAL if cancel_event is not None else interval))
+        elif cancel_event is not None:
+            cancel_event.wait(min(interval, remaining))
+        else:
+            time.sleep(min(interval, remaining))
+        interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+def cancel_prompt(prompt_id: str) -> str:
+    """Stop prompt_id in ComfyUI: interrupt it if it is running, drop it if still queued.
+
+    Returns "interrupted", "dequeued" or "failed". /interrupt is scoped to the prompt id
+    so a prompt that finished in the meantime can't take the next job down with it.
+    """
+    try:
+        queue = COMFY.queue()
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            COMFY.interrupt(prompt_id)
+            log.info(f"🛑 Interrupted prompt {prompt_id}")
+            return "interrupted"
+        COMFY.delete_queued([prompt_id])
+        return "dequeued"
+    except (requests.exceptions.RequestException, ValueError, IndexError, TypeError) as e:
+        log.warning(f"⚠️ Failed to cancel prompt {prompt_id}: {e}")
+        return "failed"
+
+def queue_and_wait(workflow: Dict, max_wait_time: float, on_event: Optional[Callable] = None,
+                   cancel_event: Optional[threading.Event] = None) -> tuple:
+    """Queue a workflow and block until it finishes.
+
+    Returns (prompt_id, history entry or None on timeout/cancellation); raises
+    RuntimeError if ComfyUI refuses the prompt and ComfyUIExited if it dies meanwhile.
+    """
+    client_id = str(uuid.uuid4())
+    exited = threading.Event()
+    
+    # Subscribe before queuing so no completion event can be missed
+    ws = connect_websocket(client_id)
+    try:
+        with SUPERVISOR.watch(exited) as generation:
+            # Queue workflow to ComfyUI
+            log.debug("📤 Queuing workflow...")
+            prompt_id = COMFY.queue_prompt(workflow, client_id)
+            log.debug(f"✅ Queued with prompt_id: {prompt_id}")
+            
+            # Wait for completion
+            result = wait_for_prompt(prompt_id, ws, max_wait_time, on_event, cancel_event, exited)
+            if result is None and SUPERVISOR.exited_since(generation):
+                raise ComfyUIExited(f"ComfyUI exited (code {SUPERVISOR.stats['last_exit']['code']}) "
+                                    f"while running prompt {prompt_id}")
+            return prompt_id, result
+    finally:
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+class CostModel:
+    """Predicts ComfyUI execution time from width × height × frames × steps.
+
+    Fits seconds = base + rate * units (units = gigapixel-frame-steps) by least squares
+    with exponentially decayed weights, so the fit follows driver/GPU changes. Only warm
+    runs are observed, since cold runs include model loading. The sums are written to
+    `path` after every observation so a restarted worker (or the next worker on the same
+    volume) starts calibrated.
+    """
+    
+    def __init__(self, path: str, min_samples: int, decay: float):
+        self.path = path
+        self.min_samples = min_samples
+        self.decay = decay
+        self.lock = threading.Lock()
+        self.sums = {"w": 0.0, "x": 0.0, "y": 0.0, "xx": 0.0, "xy": 0.0}
+        self.samples = 0
+        self.in_flight = 0.0  # predicted seconds of jobs currently running on this worker
+        self._load()
+    
+    @staticmethod
+    def work_units(workflow: Dict) -> Optional[float]:
+        """Gigapixel-frame-steps requested by a workflow, or None if it has no WAN sampler"""
+        pixel_frames = 0
+        steps = 0
+        for node in workflow.values():
+            if not isinstance(node, dict):
+                continue
+            inputs = node.get("inputs", {})
+            if node.get("class_type") == "WanImageToVideo":
+                size = [inputs.get(k) for k in ("width", "height", "length")]
+                if not all(isinstance(v, (int, float)) for v in size):
+                    return None
+                pixel_frames += size[0] * size[1] * size[2]
+            elif node.get("class_type") == "KSampler":
+                if not isinstance(inputs.get("steps"), (int, float)):
+                    return None
+                steps = max(steps, inputs["steps"])
+        if not pixel_frames or not steps:
+            return None
+        return pixel_frames * steps / 1e9
+    
+    def predict(self, units: Optional[float]) -> Optional[float]:
+        """Expected execution seconds, or None until enough runs have been observed"""
+        if units is None:
+            return None
+        with self.lock:
+            if self.samples < self.min_samples:
+                return None
+            base, rate = self._fit()
+        if rate is None:
+            return None
+        return base + rate * units
+    
+    def observe(self, units: float, seconds: float):
+        """Fold a finished run into the fit and persist it"""
+        with self.lock:
+            for key in self.sums:
+                self.sums[key] *= self.decay
+            self.sums["w"] += 1
+            self.sums["x"] += units
+            self.sums["y"] += seconds
+            self.sums["xx"] += units * units
+            self.sums["xy"] += units * seconds
+            self.samples += 1
+            state = {"samples": self.samples, "sums": dict(self.sums)}
+        self._save(state)
+    
+    def begin(self, predicted: Optional[float]) -> float:
+        """Register a running job's prediction; returns the predicted backlog ahead of it"""
+        with self.lock:
+            backlog = self.in_flight
+            self.in_flight += predicted or 0.0
+        return backlog
+    
+    def end(self, predicted: Optional[float]):
+        with self.lock:
+            self.in_flight = max(0.0, self.in_flight - (predicted or 0.0))
+    
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            base, rate = self._fit()
+            return {
+                "samples": self.samples,
+                "base_seconds": round(base, 2) if rate is not None else None,
+                "seconds_per_unit": round(rate, 2) if rate is not None else None,
+            }
+    
+    def _fit(self) -> tuple:
+        """(base, rate) from the weighted sums; must be called with self.lock held"""
+        w, x, y, xx, xy = (self.sums[k] for k in ("w", "x", "y", "xx", "xy"))
+        if w <= 0 or x <= 0:
+            return 0.0, None
+        variance = w * xx - x * x
+        if variance > 1e-9 * w * xx:
+            rate = (w * xy - x * y) / variance
+            base = (y - rate * x) / w
+            if rate > 0 and base >= 0:
+                return base, rate
+        # All runs the same size (or a nonsensical slope): scale by the average instead
+        return 0.0, y / x
+    
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.sums.update({k: float(v) for k, v in state["sums"].items() if k in self.sums})
+            self.samples = int(state["samples"])
+            log.info(f"📈 Loaded cost model ({self.samples} samples)")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"⚠️ Ignoring unreadable cost model {self.path}: {e}")
+    
+    def _save(self, state: Dict):
+        if not self.path:
+            return
+        # Every worker is PID 1 on the shared volume, and threads save concurrently too
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.debug(f"Could not persist cost model: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+COST_MODEL = CostModel(COST_MODEL_PATH, COST_MODEL_MIN_SAMPLES, COST_MODEL_DECAY)
+
+class JobAdmission:
+    """Admits a job once, on the summed predictions of all its images.
+
+    Each image builds its workflow on its own thread, then submit()s its prediction (a
+    segmented image submits the sum of its segments) or withdraw()s if it never gets
+    that far (bad input, result cache hit). The last image to report decides for all:
+    the total is registered with COST_MODEL.begin() and the job is rejected when the
+    backlog plus the total exceeds the remaining budget. Images that were admitted end()
+    their own prediction when they finish; a rejected total is withdrawn at once.
+    """
+    
+    def __init__(self, images: int):
+        self.waiting = set(range(images))
+        self.predictions = []
+        self.budget = float("inf")
+        self.condition = threading.Condition()
+        self.decision = None  # (admitted, backlog, total prediction) once every image reported
+    
+    def submit(self, index: int, predicted: Optional[float], budget: float) -> tuple:
+        """Report an image's prediction and wait for the job's decision; returns (admitted, backlog, total)"""
+        with self.condition:
+            self.predictions.append(predicted)
+            self.budget = min(self.budget, budget)
+            self._report(index)
+            self.condition.wait_for(lambda: self.decision is not None)
+            return self.decision
+    
+    def withdraw(self, index: int):
+        """The image will not queue a prompt; a no-op once it has submitted"""
+        with self.condition:
+            if index in self.waiting:
+                self._report(index)
+    
+    def _report(self, index: int):
+        self.waiting.discard(index)
+        if self.waiting or self.decision is not None:
+            return
+        registered = sum(p for p in self.predictions if p is not None)
+        total = registered if all(p is not None for p in self.predictions) else None
+        backlog = COST_MODEL.begin(registered)
+        admitted = total is None or backlog + total <= self.budget
+        if not admitted:
+            COST_MODEL.end(registered)
+        self.decision = (admitted, backlog, total)
+        self.condition.notify_all()
+
+_S3_CLIENT = None
+_S3_CLIENT_LOCK = threading.Lock()
+
+def get_s3_client():
+    """Create the S3-compatible client once per worker"""
+    global _S3_CLIENT
+    with _S3_CLIENT_LOCK:
+        if _S3_CLIENT is not None:
+            return _S3_CLIENT
+        if boto3 is None:
+            raise RuntimeError("boto3 is not installed")
+        if not BUCKET_ENDPOINT_URL or not BUCKET_NAME:
+            raise RuntimeError("BUCKET_ENDPOINT_URL and BUCKET_NAME must be set for S3 output")
+        _S3_CLIENT = boto3.client(
+            "s3",
+            endpoint_url=BUCKET_ENDPOINT_URL,
+            aws_access_key_id=os.environ.get("BUCKET_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+            region_name=os.environ.get("BUCKET_REGION", "us-east-1"),
+        )
+    return _S3_CLIENT
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024**2) -> str:
+    """Hash a file without holding it in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_video(video_path: str, job_id: str, content_type: str = "video/mp4") -> Dict[str, Any]:
+    """Stream a video to the bucket with concurrent multipart upload and presign it"""
+    client = get_s3_client()
+    key = f"{os.environ.get('BUCKET_PREFIX', 'videos')}/{job_id}/{os.path.basename(video_path)}"
+    config = TransferConfig(
+        multipart_threshold=S3_UPLOAD_CHUNK_BYTES,
+        multipart_chunksize=S3_UPLOAD_CHUNK_BYTES,
+        max_concurrency=S3_UPLOAD_CONCURRENCY,
+        use_threads=True,
+    )
+    
+    upload_start = time.time()
+    client.upload_file(video_path, BUCKET_NAME, key, Config=config, ExtraArgs={"ContentType": content_type})
+    upload_seconds = time.time() - upload_start
+    
+    size = os.path.getsize(video_path)
+    url = client.generate_presigned_url(
+        "get_object", Params={"Bucket": BUCKET_NAME, "Key": key}, ExpiresIn=S3_PRESIGN_EXPIRY
+    )
+    log.info(f"☁️ Uploaded {key} ({size / (1024**2):.1f} MB in {upload_seconds:.2f}s)")
+    return {
+        "video_url": url,
+        "video_key": key,
+        "size": size,
+        "sha256": file_sha256(video_path),
+        "upload_seconds": round(upload_seconds, 3),
+    }
+
+class OutputRetention:
+    """Keeps delivered output files under a size/age budget.
+
+    Files are registered as they are delivered, so enforcing the budget never has to
+    list the output directory; the directory is only scanned once at startup to pick up
+    leftovers from a previous worker.
+    """
+    
+    def __init__(self, directory: str, max_bytes: int, max_age: float, archive_dir: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # path -> (size, delivered_at), oldest first
+        self.total_bytes = 0
+        self.stats = {"removed": 0, "archived": 0}
+        if os.path.isdir(directory):
+            leftovers = []
+            for root, _, names in os.walk(directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    leftovers.append((stat.st_mtime, path, stat.st_size))
+            for mtime, path, size in sorted(leftovers):
+                self.files[path] = (size, mtime)
+                self.total_bytes += size
+    
+    def add(self, paths: list):
+        """Register delivered files and enforce the budget"""
+        now = time.time()
+        with self.lock:
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if path in self.files:
+                    self.total_bytes -= self.files.pop(path)[0]
+                self.files[path] = (size, now)
+                self.total_bytes += size
+            self._enforce(now)
+    
+    def _enforce(self, now: float):
+        while self.files:
+            path, (size, delivered_at) = next(iter(self.files.items()))
+            if self.total_bytes <= self.max_bytes and now - delivered_at <= self.max_age:
+                break
+            self.files.pop(path)
+            self.total_bytes -= size
+            try:
+                if self.archive_dir:
+                    target = os.path.join(self.archive_dir, os.path.relpath(path, self.directory))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                    self.stats["archived"] += 1
+                else:
+                    os.remove(path)
+                    self.stats["removed"] += 1
+            except OSError as e:
+                log.warning(f"⚠️ Could not clean up output {path}: {e}")
+
+OUTPUT_RETENTION = OutputRetention(OUTPUT_DIR, OUTPUT_RETENTION_MAX_BYTES, OUTPUT_RETENTION_MAX_AGE, OUTPUT_ARCHIVE_DIR)
+
+def output_files_from_history(outputs: Dict, workflow: Dict) -> tuple:
+    """Resolve (video_path, all_output_paths) from a prompt's history outputs.
+
+    VHS_VideoCombine reports its files under "gifs"; the video node of our own workflow
+    is preferred, but any node that produced an mp4 is accepted.
+    """
+    video_path = None
+    all_paths = []
+    video_nodes = [node_id for node_id, node in workflow.items()
+                   if isinstance(node, dict) and node.get("class_type") == "VHS_VideoCombine"]
+    ordered = video_nodes + [node_id for node_id in outputs if node_id not in video_nodes]
+    
+    for node_id in ordered:
+        for kind in ("gifs", "videos", "images"):
+            for entry in outputs.get(node_id, {}).get(kind, []):
+                if not isinstance(entry, dict) or "filename" not in entry or entry.get("type", "output") != "output":
+                    continue
+                path = entry.get("fullpath") or os.path.join(OUTPUT_DIR, entry.get("subfolder", ""), entry["filename"])
+                all_paths.append(path)
+                if video_path is None and path.endswith(".mp4"):
+                    video_path = path
+    
+    return video_path, all_paths
+
+def encode_file_base64(path: str) -> str:
+    """Base64 of a file, encoded chunk by chunk from a memory map.
+
+    Chunks land in one preallocated buffer and their pages are dropped once encoded, so
+    peak memory is the buffer plus the final string rather than the whole file plus two
+    encoded copies.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return ""
+    encoded = bytearray(4 * ((size + 2) // 3))
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for offset in range(0, size, OUTPUT_ENCODE_CHUNK_BYTES):
+            chunk = base64.b64encode(mapped[offset:offset + OUTPUT_ENCODE_CHUNK_BYTES])
+            encoded[offset // 3 * 4:offset // 3 * 4 + len(chunk)] = chunk
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_DONTNEED, offset, min(OUTPUT_ENCODE_CHUNK_BYTES, size - offset))
+    return encoded.decode("ascii")
+
+def build_video_response(video_path: str, settings: Dict[str, Any], elapsed: int, debug_info: Dict,
+                         timer: Optional["StageTimer"] = None) -> Dict:
+    """Deliver a finished video (uploaded or inline base64) and build the success response"""
+    response = {
+        "success": True,
+        "filename": os.path.basename(video_path),
+        "resolution": settings.get('resolution', 'Unknown'),
+        "duration": elapsed,
+        "debug": debug_info
+    }
+    
+    # Renditions encode on the ffmpeg pool while the video itself is delivered
+    renditions = start_renditions(video_path, settings.get("renditions") or [])
+    
+    size = os.path.getsize(video_path)
+    if output_mode_for(size) == "s3":
+        try:
+            with (timer.stage("upload") if timer else contextlib.nullcontext()):
+                response.update(upload_video(video_path, debug_info.get("job_id", "unknown")))
+            response["output_mode"] = "s3"
+        except Exception as e:
+            if size > OUTPUT_INLINE_MAX_BYTES:
+                raise RuntimeError(f"Upload failed and video is too large to inline ({size} bytes): {e}")
+            log.warning(f"⚠️ Upload failed, returning base64 instead: {e}")
+            debug_info["upload_error"] = str(e)
+    
+    if "output_mode" not in response:
+        with (timer.stage("output_read_encode") if timer else contextlib.nullcontext()):
+            response["video_base64"] = encode_file_base64(video_path)
+        response["output_mode"] = "base64"
+        response["size"] = size
+    if renditions:
+        with (timer.stage("renditions") if timer else contextlib.nullcontext()):
+            response["renditions"] = finish_renditions(renditions, debug_info.get("job_id", "unknown"))
+    return response
+
+def output_mode_for(size: int) -> str:
+    """Delivery mode for a file of `size` bytes under OUTPUT_MODE ("s3" or "base64")"""
+    if OUTPUT_MODE == "auto":
+        return "base64" if size <= OUTPUT_INLINE_MAX_BYTES else "s3"
+    return OUTPUT_MODE
+
+RENDITION_FORMATS = {
+    # codec -> (file extension, content type)
+    "h264": ("mp4", "video/mp4"),
+    "webm": ("webm", "video/webm"),
+    "webp": ("webp", "image/webp"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "png": ("png", "image/png"),
+}
+STILL_CODECS = ("jpeg", "png")
+
+def parse_renditions(specs) -> list:
+    """Normalize settings["renditions"]; raises ValueError naming the first bad entry.
+
+    Each entry is a codec name or a dict with "codec" and optionally "name", "crf"
+    (h264/webm), "quality" (webp/jpeg, 0-100), "scale" (a width, keeping the aspect
+    ratio, or "WxH"), "fps" (h264/webm/webp) and "frame" (poster frame index for
+    jpeg/png, default 0).
+    """
+    if not specs:
+        return []
+    if not isinstance(specs, list):
+        raise ValueError("renditions must be a list")
+    if len(specs) > RENDITIONS_MAX:
+        raise ValueError(f"too many renditions: {len(specs)} (max {RENDITIONS_MAX})")
+    renditions = []
+    for index, spec in enumerate(specs):
+        spec = {"codec": spec} if isinstance(spec, str) else spec
+        if not isinstance(spec, dict) or spec.get("codec") not in RENDITION_FORMATS:
+            raise ValueError(f"rendition {index}: codec must be one of {', '.join(RENDITION_FORMATS)}")
+        codec = spec["codec"]
+        name = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(spec.get("name") or f"{codec}_{index}"))
+        if any(rendition["name"] == name for rendition in renditions):
+            raise ValueError(f"rendition {index}: duplicate name {name!r}")
+        rendition = {"name": name, "codec": codec}
+        if spec.get("scale") is not None:
+            width, _, height = str(spec["scale"]).partition("x")
+            if not width.isdigit() or int(width) == 0 or (height and (not height.isdigit() or int(height) == 0)):
+                raise ValueError(f"rendition {index}: scale must be a width or WxH")
+            rendition["scale"] = (int(width), int(height) if height else None)
+        for key, low, high in (("crf", 0, 63), ("quality", 0, 100), ("fps", 1, 120), ("frame", 0, 100000)):
+            value = spec.get(key)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+                raise ValueError(f"rendition {index}: {key} must be a number from {low} to {high}")
+            rendition[key] = value if key == "fps" else int(value)
+        renditions.append(rendition)
+    return renditions
+
+def rendition_command(source: str, output: str, rendition: Dict) -> tuple:
+    """(ffmpeg arguments, stream copy?) for one rendition of source.
+
+    An h264 rendition that changes nothing (no crf, scale or fps) is remuxed with
+    +faststart instead of re-encoded; everything else is decoded from the mp4 once.
+    """
+    codec = rendition["codec"]
+    filters = []
+    if codec in STILL_CODECS:
+        filters.append(f"select=eq(n\\,{rendition.get('frame', 0)})")
+    elif "fps" in rendition:
+        filters.append(f"fps={rendition['fps']}")
+    if "scale" in rendition:
+        width, height = rendition["scale"]
+        if codec in STILL_CODECS:
+            filters.append(f"scale={width}:{height or -1}")
+        else:  # yuv420p needs even dimensions
+            filters.append(f"scale={width // 2 * 2}:{height // 2 * 2 if height else -2}")
+    
+    command = [FFMPEG_PATH, "-y", "-nostdin", "-loglevel", "error", "-i", source, "-an"]
+    if codec == "h264" and not filters and "crf" not in rendition:
+        return command + ["-c", "copy", "-movflags", "+faststart", output], True
+    if filters:
+        command += ["-vf", ",".join(filters)]
+    command += ["-threads", str(RENDITION_THREADS)]
+    if codec == "h264":
+        command += ["-c:v", "libx264", "-preset", "veryfast", "-crf", str(rendition.get("crf", 23)),
+                    "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+    elif codec == "webm":
+        command += ["-c:v", "libvpx-vp9", "-crf", str(rendition.get("crf", 36)), "-b:v", "0",
+                    "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1", "-pix_fmt", "yuv420p"]
+    elif codec == "webp":
+        command += ["-c:v", "libwebp", "-loop", "0", "-quality", str(rendition.get("quality", 75))]
+    elif codec == "jpeg":
+        command += ["-frames:v", "1", "-update", "1", "-q:v", str(round(2 + (100 - rendition.get("quality", 85)) * 0.29))]
+    else:
+        command += ["-frames:v", "1", "-update", "1"]
+    return command + [output], False
+
+def encode_rendition(source: str, output: str, rendition: Dict) -> Dict:
+    """Run one rendition's ffmpeg (on the rendition pool); returns its timing fields"""
+    command, stream_copy = rendition_command(source, output, rendition)
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {completed.stderr.strip()[-500:]}")
+        if not os.path.exists(output) or os.path.getsize(output) == 0:
+            raise RuntimeError("ffmpeg produced no output (poster frame past the end?)")
+    finally:
+        OUTPUT_RETENTION.add([output])
+    return {"stream_copy": stream_copy, "encode_seconds": round(time.perf_counter() - start, 3)}
+
+RENDITION_EXECUTOR = ThreadPoolExecutor(max_workers=RENDITION_WORKERS, thread_name_prefix="rendition")
+
+def start_renditions(video_path: str, renditions: list) -> list:
+    """Queue renditions of video_path on the shared ffmpeg pool; returns (rendition, output path, future)s"""
+    stem = f"{os.path.splitext(os.path.basename(video_path))[0]}_{uuid.uuid4().hex[:6]}"
+    pending = []
+    for rendition in renditions:
+        extension = RENDITION_FORMATS[rendition["codec"]][0]
+        output = os.path.join(OUTPUT_DIR, f"{stem}_{rendition['name']}.{extension}")
+        pending.append((rendition, output, RENDITION_EXECUTOR.submit(encode_rendition, video_path, output, rendition)))
+    return pending
+
+def finish_renditions(pending: list, job_id: str) -> list:
+    """Wait for each rendition in turn and deliver it like the main video (later ones keep encoding).
+
+    A failed rendition is reported in its slot with an "error" instead of failing the job.
+    """
+    results = []
+    for rendition, path, future in pending:
+        entry = {"name": rendition["name"], "codec": rendition["codec"], "filename": os.path.basename(path)}
+        try:
+            entry.update(future.result())
+            entry["size"] = size = os.path.getsize(path)
+            content_type = RENDITION_FORMATS[rendition["codec"]][1]
+            if output_mode_for(size) == "s3":
+                try:
+                    uploaded = upload_video(path, f"{job_id}/renditions", content_type)
+                    entry.update(output_mode="s3", url=uploaded["video_url"], key=uploaded["video_key"],
+                                 sha256=uploaded["sha256"])
+                except Exception as e:
+                    if size > OUTPUT_INLINE_MAX_BYTES:
+                        raise RuntimeError(f"Upload failed and rendition is too large to inline ({size} bytes): {e}")
+                    log.warning(f"⚠️ Rendition upload failed, returning base64 instead: {e}")
+            if "output_mode" not in entry:
+                entry.update(output_mode="base64", content_type=content_type, base64=encode_file_base64(path))
+        except Exception as e:
+            log.warning(f"⚠️ Rendition {rendition['name']} failed: {e}")
+            entry["error"] = str(e)
+        results.append(entry)
+    return results
+
+def history_error(result: Dict) -> Optional[str]:
+    """Error message for a failed prompt's history entry, or None if it succeeded"""
+    status = result.get("status", {})
+    if status.get("status_str") != "error":
+        return None
+    error_msg = "Workflow failed"
+    if "messages" in status:
+        for msg in status["messages"]:
+            if msg[0] == "execution_error":
+                error_msg = f"Node {msg[1]['node_id']} ({msg[1]['node_type']}): {msg[1]['exception_message']}"
+                break
+    return error_msg
+
+def execution_failed(result: Dict) -> bool:
+    """True if a node raised while running the prompt (an interrupted prompt is not a failure)"""
+    messages = result.get("status", {}).get("messages", [])
+    return any(message[0] == "execution_error" for message in messages)
+
+def segment_plan(workflow: Dict, settings: Dict[str, Any]) -> Optional[list]:
+    """Frame counts of the segments a generated workflow is split into, or None to render it in one go.
+
+    settings["segmented"] forces segmenting on or off; otherwise videos longer than
+    SEGMENT_THRESHOLD_SECONDS are split into equal segments of about SEGMENT_SECONDS.
+    """
+    forced = settings.get("segmented")
+    if forced is False or SEGMENT_SECONDS <= 0:
+        return None
+    length = workflow["8"]["inputs"]["length"]
+    fps = workflow["11"]["inputs"]["frame_rate"]
+    if not forced and length <= SEGMENT_THRESHOLD_SECONDS * fps:
+        return None
+    count = math.ceil(length / snap_frame_count(int(SEGMENT_SECONDS * fps)))
+    if count < 2:
+        return None
+    return [snap_frame_count(math.ceil(length / count))] * count
+
+def add_last_frame_output(workflow: Dict, frames: int):
+    """Save a segment's last decoded frame as a lossless PNG to seed the next segment"""
+    workflow["12"] = {
+        "inputs": {"image": ["10", 0], "batch_index": frames - 1, "length": 1},
+        "class_type": "ImageFromBatch"
+    }
+    workflow["13"] = {
+        "inputs": {"images": ["12", 0], "filename_prefix": "runpod_segment_frame"},
+        "class_type": "SaveImage"
+    }
+
+def concat_videos(paths: list, output_path: str):
+    """Join same-codec mp4 segments with ffmpeg's concat demuxer (stream copy, no re-encode)"""
+    list_path = f"{output_path}.txt"
+    with open(list_path, "w") as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        completed = subprocess.run([
+            FFMPEG_PATH, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c", "copy", "-movflags", "+faststart", output_path
+        ], capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"ffmpeg concat failed: {completed.stderr.strip()[-500:]}")
+    finally:
+        os.remove(list_path)
+
+def collect_images(job_input: Dict) -> list:
+    """(image_data, image_name) for every image in the job, from the images array or the old direct fields"""
+    images_array = job_input.get("images", [])
+    if images_array:
+        log.debug(f"🔍 Using new format: images array with {len(images_array)} images")
+        return [(image.get("image_data", ""), image.get("image_name", "input_image.png")) for image in images_array]
+    # Fallback for old format
+    log.debug("🔍 Using old format: direct image fields")
+    return [(job_input.get("image_data", job_input.get("image", "")), job_input.get("image_name", "input_image.png"))]
+
+def comfyui_unavailable(debug_info: Dict, timer: "StageTimer") -> Optional[Dict]:
+    """Readiness gate, passed right before a job first needs ComfyUI (result cache hits never do).
+
+    Returns the error response if ComfyUI could not be started, otherwise None.
+    """
+    # Wait for the background startup (no per-job server probe once ready)
+    with timer.stage("startup_wait"):
+        comfyui_ready = wait_for_comfyui()
+    if comfyui_ready:
+        return None
+    return {"error": "Failed to start ComfyUI server", "debug": {**debug_info, "comfyui_process": SUPERVISOR.report()}}
+
+def run_job(job, cancel_event: Optional[threading.Event] = None):
+    """Process one job end to end; runs on a worker thread so several jobs can overlap.
+
+    Every entry of the images array gets its own prompt. Setting cancel_event (RunPod
+    cancelled the job) stops waiting and interrupts whatever is still running.
+    """
+    job_succeeded = False
+    debug_info = {}
+    timer = StageTimer()
+    job_start = time.perf_counter()
+    # One ordered channel for every progress update of this job (all images and segments)
+    progress_sender = ProgressSender.open(job) if os.environ.get("RUNPOD_WEBHOOK_POST_OUTPUT") else None
+    try:
+        log.debug("🚀 Handler starting...")
         
         # Collect debug info to return in response
         debug_info = {"handler_version": "2025-01-07", "job_id": job.get("id", "unknown")}
+        debug_info["cold_start"] = dict(COLD_START)
         
-        # Models are now on network storage at /runpod-volume/
-        required_models = {
-            "wan_model": "/runpod-volume/checkpoints/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors",
-            # VAE is built into the checkpoint, no separate file needed
-            "clip_vision": "/runpod-volume/clip_vision/clip_vision_vit_h.safetensors"
-        }
-        
-        # Check models
-        missing_models = []
-        for model_name, model_path in required_models.items():
-            if not os.path.exists(model_path):
-                missing_models.append(f"{model_name} ({model_path})")
-                debug_info[f"{model_name}_status"] = "NOT FOUND"
-                print(f"❌ Missing model: {model_path}")
-            else:
-                file_size = os.path.getsize(model_path)
-                debug_info[f"{model_name}_status"] = f"OK ({file_size / (1024**3):.2f} GB)"
-                print(f"✅ Found {model_name} ({file_size / (1024**3):.2f} GB)")
-        
+        # Models are staged (or linked from the volume) once; later jobs hit the cached result
+        with timer.stage("startup_wait"):
+            missing_models = ensure_models()
+        debug_info.update({f"{name}_status": status for name, status in MODEL_STATUS.items()})
         if missing_models:
             return {
                 "error": f"Missing required models: {', '.join(missing_models)}",
                 "debug": debug_info
             }
         
-        # Create symlinks so ComfyUI can find models in default locations
-        print("🔗 Creating symlinks for ComfyUI...")
-        try:
-            # Ensure target directories exist
-            os.makedirs("/ComfyUI/models/checkpoints", exist_ok=True)
-            os.makedirs("/ComfyUI/models/clip_vision", exist_ok=True)
-            
-            # Create symlink for WAN model
-            wan_target = "/ComfyUI/models/checkpoints/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"
-            wan_source = "/runpod-volume/checkpoints/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"
-            if not os.path.exists(wan_target):
-                os.symlink(wan_source, wan_target)
-                print(f"✅ Created symlink: {wan_target} -> {wan_source}")
-            
-            # Create symlink for CLIP model  
-            clip_target = "/ComfyUI/models/clip_vision/clip_vision_vit_h.safetensors"
-            clip_source = "/runpod-volume/clip_vision/clip_vision_vit_h.safetensors"
-            if not os.path.exists(clip_target):
-                os.symlink(clip_source, clip_target)
-                print(f"✅ Created symlink: {clip_target} -> {clip_source}")
-                
-        except Exception as e:
-            print(f"⚠️ Warning: Could not create symlinks: {e}")
-            # Continue anyway - handler validation already confirmed files exist
-        
-        # Start ComfyUI if not running
-        if not start_comfyui():
-            return {"error": "Failed to start ComfyUI server", "debug": debug_info}
-        
-        # Log detailed model information for debugging
-        print("📊 MODEL INFO:")
-        try:
-            import torch
-            
-            # Check WAN model details
-            wan_path = "/runpod-volume/checkpoints/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors"
-            print(f"🔍 WAN Model: {os.path.basename(wan_path)}")
-            print(f"📏 WAN Size: {os.path.getsize(wan_path) / (1024**3):.2f} GB")
-            
-            # Check CLIP model details  
-            clip_path = "/runpod-volume/clip_vision/clip_vision_vit_h.safetensors"
-            print(f"🔍 CLIP Model: {os.path.basename(clip_path)}")
-            print(f"📏 CLIP Size: {os.path.getsize(clip_path) / (1024**3):.2f} GB")
-            
-            # Log key workflow settings
-            print("⚙️ WORKFLOW SETTINGS:")
-            if workflow:
-                # Check checkpoint loader settings
-                if "2" in workflow and "inputs" in workflow["2"]:
-                    ckpt_name = workflow["2"]["inputs"].get("ckpt_name", "unknown")
-                    print(f"🎯 Checkpoint: {ckpt_name}")
-                
-                # Check sampling settings
-                if "9" in workflow and "inputs" in workflow["9"]:
-                    sampler_info = workflow["9"]["inputs"]
-                    print(f"🎲 Seed: {sampler_info.get('seed', 'unknown')}")
-                    print(f"📈 Steps: {sampler_info.get('steps', 'unknown')}")
-                    print(f"🎚️ CFG: {sampler_info.get('cfg', 'unknown')}")
-                    print(f"🔧 Sampler: {sampler_info.get('sampler_name', 'unknown')}")
-                    print(f"📅 Scheduler: {sampler_info.get('scheduler', 'unknown')}")
-                    print(f"🎭 Denoise: {sampler_info.get('denoise', 'unknown')}")
-                
-                # Check model shift settings
-                if "7" in workflow and "inputs" in workflow["7"]:
-                    shift = workflow["7"]["inputs"].get("shift", "unknown")
-                    print(f"↔️ Model Shift: {shift}")
-                    
-                # Check video settings
-                if "8" in workflow and "inputs" in workflow["8"]:
-                    video_info = workflow["8"]["inputs"]
-                    print(f"📐 Resolution: {video_info.get('width', '?')}x{video_info.get('height', '?')}")
-                    print(f"⏱️ Length: {video_info.get('length', '?')} frames")
-                    
-        except Exception as e:
-            print(f"⚠️ Could not log model info: {e}")
-        
         # Extract job input from our Video Generator App
         job_input = job.get("input", {})
-        
-        # Get image data and settings from our app
-        # Handle both old format (direct fields) and new format (images array)
-        images_array = job_input.get("images", [])
-        if images_array and len(images_array) > 0:
-            print(f"🔍 Using new format: images array with {len(images_array)} images")
-            first_image = images_array[0]
-            image_data = first_image.get("image_data", "")
-            image_name = first_image.get("image_name", "input_image.png")
-            print(f"📷 Handler debug: image_data length: {len(image_data)}, image_name: {image_name}")
-        else:
-            # Fallback for old format
-            print("🔍 Using old format: direct image fields")
-            image_data = job_input.get("image_data", job_input.get("image", ""))
-            image_name = job_input.get("image_name", "input_image.png")
+        images = collect_images(job_input)
         
         # Get workflow and settings
         workflow = job_input.get("workflow")
         settings = job_input.get("settings", {})
+        if "renditions" in settings:
+            try:
+                settings["renditions"] = parse_renditions(settings["renditions"])
+            except ValueError as e:
+                return {"error": f"Invalid renditions: {e}", "debug": debug_info}
         
+        if len(images) == 1:
+            response = run_image(job, images[0], workflow, settings, debug_info, timer, job_start, cancel_event)
+        elif len(images) > MAX_IMAGES_PER_JOB:
+            return {"error": f"Too many images: {len(images)} (max {MAX_IMAGES_PER_JOB})", "debug": debug_info}
+        else:
+            response = run_images(job, images, workflow, settings, debug_info, timer, job_start, cancel_event)
+        job_succeeded = bool(response.get("success"))
+        return response
+    
+    except Exception as e:
+        return {"error": f"Handler error: {str(e)}"}
+    finally:
+        if progress_sender is not None:
+            with timer.stage("progress_flush"):
+                progress_sender.close()
+        timer.add("total", time.perf_counter() - job_start)
+        debug_info["timings"] = timer.summary()
+        METRICS.observe_job(timer.stages, job_succeeded)
+        if METRICS_FILE:
+            try:
+                METRICS.dump(METRICS_FILE)
+            except OSError as e:
+                log.warning(f"⚠️ Could not write metrics file: {e}")
+
+def run_images(job, images: list, workflow: Optional[Dict], settings: Dict[str, Any], debug_info: Dict,
+               timer: "StageTimer", job_start: float, cancel_event: Optional[threading.Event]) -> Dict:
+    """Run a multi-image job and collect per-image results.
+
+    Each image gets a thread that stores its input and queues its prompt as soon as the
+    image is on disk, so all prompts sit back to back in ComfyUI's queue and the GPU never
+    waits on us; results are encoded/uploaded while later prompts are still generating.
+    A failed image is reported in its slot of "results" without failing the others.
+    """
+    image_timers = [StageTimer() for _ in images]
+    admission = JobAdmission(len(images))  # the job is admitted as a whole, not image by image
+    image_debug = [{"job_id": debug_info["job_id"], "image_index": index} for index in range(len(images))]
+    with ThreadPoolExecutor(max_workers=len(images), thread_name_prefix="image") as pool:
+        futures = [
+            pool.submit(run_image, job, image, copy.deepcopy(workflow), dict(settings), image_debug[index],
+                        image_timers[index], job_start, cancel_event, index, admission)
+            for index, image in enumerate(images)
+        ]
+        results = [future.result() for future in futures]
+    
+    # Per-image timings go into each result; the job's metrics get the sum per stage
+    for image_timer, debug in zip(image_timers, image_debug):
+        debug["timings"] = image_timer.summary()
+        for name, seconds in image_timer.stages.items():
+            timer.add(name, seconds)
+    
+    failed = sum(1 for result in results if not result.get("success"))
+    response = {
+        "success": failed < len(results),
+        "results": results,
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "debug": debug_info
+    }
+    if failed:
+        log.warning(f"⚠️ {failed}/{len(results)} images failed")
+    if failed == len(results):
+        response["error"] = f"All {len(results)} images failed"
+    return response
+
+def run_image(job, image: tuple, workflow: Optional[Dict], settings: Dict[str, Any], debug_info: Dict,
+              timer: "StageTimer", job_start: float, cancel_event: Optional[threading.Event] = None,
+              image_index: Optional[int] = None, admission: Optional[JobAdmission] = None) -> Dict:
+    """Generate and deliver the video for one input image; returns its response dict"""
+    admission = admission or JobAdmission(1)
+    image_data, image_name = image
+    prompt_id = None
+    result = None
+    predicted_seconds = None
+    cost_registered = False
+    residency_key = None
+    residency_warm = False
+    job_succeeded = False
+    execution_error = False
+    stored_name = None
+    try:
+        log.debug(f"📷 Handler debug: image_data length: {len(image_data)}, image_name: {image_name}")
         if not image_data:
             return {"error": "No image data provided", "debug": debug_info}
         
-        # Save image to ComfyUI input directory
-        input_dir = "/ComfyUI/input"
-        if os.path.exists(input_dir):
-            shutil.rmtree(input_dir)
-            os.makedirs(input_dir)
-            print("🧹 Cleared ComfyUI input directory")
-        else:
-            os.makedirs(input_dir, exist_ok=True)
-            
-        # Decode and save image
+        # Save image to the content-addressed input store
         try:
-            if image_data.startswith('data:image'):
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            image_path = os.path.join(input_dir, image_name)
-            
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
-            
-            print(f"📷 Saved image: {image_name} ({len(image_bytes)} bytes)")
+            stored_name, image_path, image_size, input_cached = INPUT_STORE.put(image_data, image_name, timer, pin=True)
+            debug_info["input_image"] = {"stored_as": stored_name, "bytes": image_size, "cached": input_cached}
+            log.debug(f"📷 {'Reused' if input_cached else 'Saved'} image: {image_name} -> {stored_name} ({image_size} bytes)")
             
         except Exception as e:
             return {"error": f"Failed to save image: {str(e)}", "debug": debug_info}
         
         # Use provided workflow or create fallback
+        build_start = time.perf_counter()
+        workflow_is_client = bool(workflow)
         if workflow:
-            print(f"✅ Using client-provided workflow with {len(workflow)} nodes")
+            log.debug(f"✅ Using client-provided workflow with {len(workflow)} nodes")
+            point_load_images_at(workflow, stored_name)
         else:
             # Auto-calculate resolution for fallback
             if settings.get('resolution') == 'auto':
                 try:
-                    from PIL import Image
-                    import io
-                    img = Image.open(io.BytesIO(image_bytes))
-                    calculated_width, calculated_height = calculate_optimal_resolution(img.width, img.height)
+                    # Header only; PIL (also lazy, but a heavy import) covers formats we don't parse
+                    size = read_image_size(image_path)
+                    if size is None:
+                        from PIL import Image
+                        with Image.open(image_path) as img:
+                            size = img.size
+                    image_width, image_height = size
+                    calculated_width, calculated_height = calculate_optimal_resolution(image_width, image_height)
                     calculated_resolution = f"{calculated_width}x{calculated_height}"
                     settings['resolution'] = calculated_resolution
                     debug_info['calculated_resolution'] = calculated_resolution
-                    print(f"🎯 Auto-calculated resolution: {calculated_resolution} for {img.width}x{img.height} input")
+                    log.debug(f"🎯 Auto-calculated resolution: {calculated_resolution} for {image_width}x{image_height} input")
                 except Exception as e:
-                    print(f"⚠️ Failed to auto-calculate resolution: {e}")
+                    log.warning(f"⚠️ Failed to auto-calculate resolution: {e}")
                     settings['resolution'] = "768x512"  # Fallback
             
             # Create workflow as fallback
-            workflow = create_comfyui_workflow(image_name, settings)
+            workflow = create_comfyui_workflow(stored_name, settings)
+            
+            if RESOLUTION_BUCKETING:
+                video_inputs = workflow["8"]["inputs"]
+                bucket = f"{video_inputs['width']}x{video_inputs['height']}"
+                debug_info["resolution_bucket"] = {"requested": settings.get('resolution'), "bucket": bucket, "frames": video_inputs["length"]}
+                settings['resolution'] = bucket
+                log.debug(f"🪣 Resolution bucket: {bucket}, {video_inputs['length']} frames")
+        timer.add("workflow_build", time.perf_counter() - build_start)
         
-        client_id = str(uuid.uuid4())
+        # Long generated videos are rendered segment by segment
+        plan = None if workflow_is_client else segment_plan(workflow, settings)
+        if plan:
+            return run_segments(job, plan, stored_name, settings, debug_info, timer, job_start, cancel_event, image_index,
+                                admission)
+        
+        # Serve repeated deterministic jobs from the result cache without touching ComfyUI
+        # (a workflow that produced a cached video has already passed validation)
+        with timer.stage("result_cache_lookup"):
+            cache_key = None
+            if workflow_is_client or 'seed' in settings:
+                cache_key = ResultCache.make_key(os.path.splitext(stored_name)[0], workflow)
+            cached_video = RESULT_CACHE.get(cache_key) if cache_key else None
+        debug_info["result_cache"] = {"cacheable": cache_key is not None, "hit": cached_video is not None, **RESULT_CACHE.summary()}
+        if cached_video is not None:
+            log.info(f"♻️ Result cache hit: {cache_key[:12]}")
+            admission.withdraw(image_index or 0)  # Don't hold the job's other images back while delivering
+            try:
+                return build_video_response(cached_video, settings, 0, debug_info, timer)
+            finally:
+                RESULT_CACHE.release(cached_video)
         
-        # Queue workflow to ComfyUI
-        print("📤 Queuing workflow...")
-        queue_response = requests.post("http://localhost:8188/prompt", json={
-            "prompt": workflow,
-            "client_id": client_id
-        })
+        unavailable = comfyui_unavailable(debug_info, timer)
+        if unavailable:
+            return unavailable
         
-        if not queue_response.ok:
+        # Reject broken client workflows here rather than after they reach the GPU queue
+        if workflow_is_client and WORKFLOW_VALIDATION:
+            with timer.stage("workflow_validate"):
+                workflow_errors = COMFY.validate_workflow(workflow)
+            if workflow_errors:
+                return {"error": f"Invalid workflow: {'; '.join(workflow_errors[:10])}", "debug": debug_info}
+        
+        # Admission control: refuse work the cost model says can't finish within the budget,
+        # counting the predicted work already queued ahead of it on this worker
+        work_units = CostModel.work_units(workflow)
+        predicted_seconds = COST_MODEL.predict(work_units)
+        budget = JOB_TIME_BUDGET - (time.perf_counter() - job_start)
+        admitted, backlog, job_predicted = admission.submit(image_index or 0, predicted_seconds, budget)
+        cost_registered = admitted
+        debug_info["cost_model"] = {
+            "work_units": round(work_units, 4) if work_units else None,
+            "predicted_seconds": round(predicted_seconds, 1) if predicted_seconds is not None else None,
+            "backlog_seconds": round(backlog, 1),
+            **COST_MODEL.summary(),
+        }
+        if not admitted:
             return {
-                "error": f"Failed to queue workflow: {queue_response.text}",
+                "error": f"Job rejected: predicted {job_predicted:.0f}s behind {backlog:.0f}s of queued work "
+                         f"exceeds the remaining {budget:.0f}s budget",
                 "debug": debug_info
             }
         
-        # Get prompt ID and wait for completion
-        queue_result = queue_response.json()
-        prompt_id = queue_result.get("prompt_id")
-        print(f"✅ Queued with prompt_id: {prompt_id}")
+        # Note whether this job's models are already resident in ComfyUI
+        residency_key, residency_warm = MODEL_RESIDENCY.acquire(workflow)
+        residency_start = time.time()
+        debug_info["model_residency"] = "warm" if residency_warm else "cold"
+        log.debug(f"{'🔥' if residency_warm else '🧊'} Models {debug_info['model_residency']}")
         
-        if not prompt_id:
-            return {"error": "No prompt_id returned", "debug": debug_info}
+        # Deadline: the prediction for this job plus the work queued ahead of it, with headroom.
+        # Cold runs (model loading isn't modelled) and uncalibrated models get the whole budget.
+        max_wait_time = budget
+        # Other images of the job are queued alongside, so allow for all of them
+        if job_predicted is not None and residency_warm:
+            max_wait_time = min(budget, max(DEADLINE_MIN_SECONDS, (backlog + job_predicted) * DEADLINE_FACTOR))
+        debug_info["cost_model"]["deadline_seconds"] = round(max_wait_time, 1)
         
-        # Poll for completion with intelligent timeout and error handling
-        max_wait_time = 600  # 10 minutes maximum
         start_time = time.time()
-        check_interval = 3
-        last_progress_time = start_time
+        progress = ProgressReporter(job, {"image_index": image_index} if image_index is not None else None)
+        node_listener = chain_listeners(timer.node_listener(workflow), progress.listener(workflow))
+        try:
+            with timer.stage("comfyui_total"):
+                prompt_id, result = queue_and_wait(workflow, max_wait_time, on_event=node_listener,
+                                                   cancel_event=cancel_event)
+        except ComfyUIExited as e:
+            log.error(f"❌ {e}")
+            return {"error": str(e), "debug": {**debug_info, "comfyui_process": SUPERVISOR.report()}}
+        except RuntimeError as e:
+            return {"error": str(e), "debug": debug_info}
+        elapsed = int(time.time() - start_time)
         
-        while time.time() - start_time < max_wait_time:
-            elapsed = int(time.time() - start_time)
-            
-            # Check job status in history
+        if result is None:
+            if cancel_event is not None and cancel_event.is_set():
+                return {"error": "Job cancelled", "debug": debug_info}
+            return {
+                "error": f"Video generation timed out after {int(max_wait_time)} seconds",
+                "debug": debug_info
+            }
+        
+        # Check for errors
+        error_msg = history_error(result)
+        if error_msg:
+            log.error(f"❌ {error_msg}")
+            execution_error = execution_failed(result)
+            return {"error": error_msg, "debug": debug_info}
+        job_succeeded = True
+        # Calibrate on execution time only (no queue wait, which is only known from the websocket)
+        if work_units and residency_warm and "comfyui_queue_wait" in timer.stages:
+            COST_MODEL.observe(work_units, timer.stages["comfyui_total"] - timer.stages["comfyui_queue_wait"])
+        progress.send({"stage": "delivering"}, force=True)
+        debug_info["progress_updates"] = progress.sent
+        
+        outputs = result.get("outputs", {})
+        log.debug(f"✅ Job completed - checking for video...")
+        
+        # Resolve the exact output file from the history entry
+        with timer.stage("output_lookup"):
+            video_path, output_paths = output_files_from_history(outputs, workflow)
+        if video_path is None or not os.path.exists(video_path):
+            log.error(f"❌ No video generated. Outputs: {outputs}")
+            return {
+                "error": "No video file generated",
+                "debug": {**debug_info, "outputs": outputs}
+            }
+        log.debug(f"✅ Found video: {os.path.basename(video_path)}")
+        
+        if cache_key is not None:
             try:
-                history_response = requests.get(f"http://localhost:8188/history/{prompt_id}", timeout=10)
-                if history_response.ok:
-                    history = history_response.json()
-                    if prompt_id in history:
-                        # Job completed - process results
-                        result = history[prompt_id]
-                        # Check for errors
-                        status = result.get("status", {})
-                        if status.get("status_str") == "error":
-                            error_msg = "Workflow failed"
-                            if "messages" in status:
-                                for msg in status["messages"]:
-                                    if msg[0] == "execution_error":
-                                        error_msg = f"Node {msg[1]['node_id']} ({msg[1]['node_type']}): {msg[1]['exception_message']}"
-                                        break
-                            print(f"❌ {error_msg}")
-                            return {"error": error_msg, "debug": debug_info}
-                        
-                        outputs = result.get("outputs", {})
-                        print(f"✅ Job completed - checking for video...")
-                        
-                        # Get the newest .mp4 file  
-                        try:
-                            mp4_files = glob.glob("/ComfyUI/output/*.mp4")
-                            
-                            if mp4_files:
-                                video_path = max(mp4_files, key=os.path.getmtime)
-                                print(f"✅ Found video: {os.path.basename(video_path)}")
-                                
-                                with open(video_path, "rb") as f:
-                                    video_base64 = base64.b64encode(f.read()).decode()
-                                
-                                return {
-                                    "success": True,
-                                    "video_base64": video_base64,
-                                    "filename": os.path.basename(video_path),
-                                    "resolution": settings.get('resolution', 'Unknown'),
-                                    "duration": elapsed,
-                                    "debug": debug_info
-                                }
-                            else:
-                                all_files = os.listdir("/ComfyUI/output/")
-                                print(f"❌ No video generated. Files: {all_files}")
-                                return {
-                                    "error": "No video file generated",
-                                    "debug": {**debug_info, "output_files": all_files}
-                                }
-                                
-                        except Exception as e:
-                            return {
-                                "error": f"Could not read output directory: {str(e)}",
-                                "debug": debug_info
-                            }
-                        
-            except requests.exceptions.RequestException as e:
-                print(f"⚠️ Error checking job status: {e}")
-            
-            # Print progress every 30 seconds
-            if elapsed > 0 and elapsed % 30 == 0:
-                print(f"⏳ Generating... ({elapsed}s)")
-                
-            time.sleep(check_interval)
+                with timer.stage("result_cache_store"):
+                    RESULT_CACHE.put(cache_key, video_path)
+            except OSError as e:
+                log.warning(f"⚠️ Could not cache result: {e}")
         
-        return {
-            "error": f"Video generation timed out after {max_wait_time} seconds",
-            "debug": debug_info
-        }
+        try:
+            return build_video_response(video_path, settings, elapsed, debug_info, timer)
+        except Exception as e:
+            return {"error": f"Failed to deliver video: {str(e)}", "debug": debug_info}
+        finally:
+            OUTPUT_RETENTION.add(output_paths)
     
     except Exception as e:
-        return {"error": f"Handler error: {str(e)}"}
+        return {"error": f"Handler error: {str(e)}", "debug": debug_info}
     finally:
-        # Always cleanup after job completion or failure
+        # Always cleanup after job completion or failure; the job's other images may be waiting on admission
+        admission.withdraw(image_index or 0)
         try:
-            print("🧹 Performing cleanup after job...")
-            # Clear ComfyUI queue
-            requests.post("http://localhost:8188/queue", json={"clear": True}, timeout=5)
-            # Free GPU memory
-            requests.post("http://localhost:8188/free", json={"unload_models": True, "free_memory": True}, timeout=5)
-            print("✅ Cleanup completed")
+            log.debug("🧹 Performing cleanup after job...")
+            # Stop this job's prompt if it never finished: interrupt it if it is running,
+            # otherwise drop it from the queue (other jobs share the queue)
+            if prompt_id is not None and result is None:
+                debug_info["cancellation"] = cancel_prompt(prompt_id)
+            if cost_registered:
+                COST_MODEL.end(predicted_seconds)
+            # Models stay loaded for the next job unless the residency policy says otherwise
+            if residency_key is not None:
+                MODEL_RESIDENCY.release(residency_key, residency_warm, time.time() - residency_start, job_succeeded,
+                                        execution_error)
+                debug_info["residency_stats"] = MODEL_RESIDENCY.summary()
+            # The prompt no longer reads the input, so the store may evict it again
+            if stored_name is not None:
+                INPUT_STORE.unpin(stored_name)
+            log.debug("✅ Cleanup completed")
         except:
             pass  # Cleanup failures are not critical
 
-# Preload models during container startup
-print("🔥 Container starting - preloading models for instant job processing...")
-preload_models()
+def run_segments(job, plan: list, stored_name: str, settings: Dict[str, Any], debug_info: Dict,
+                 timer: "StageTimer", job_start: float, cancel_event: Optional[threading.Event] = None,
+                 image_index: Optional[int] = None, admission: Optional[JobAdmission] = None) -> Dict:
+    """Generate a long video as a chain of segments, one prompt each.
+
+    Segment i + 1 starts from segment i's last frame, so only one segment's latents are
+    ever on the GPU however long the video is. Finished segments are uploaded (unless the
+    output mode is base64) and announced as progress updates on a background thread while
+    the next segment generates, then joined without re-encoding. The seam frame appears
+    at the end of one segment and the start of the next; dropping it would need a re-encode.
+    """
+    admission = admission or JobAdmission(1)
+    progress = ProgressReporter(job, {"image_index": image_index} if image_index is not None else None)
+    delivery = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segment")
+    deliveries = []
+    segment_paths = []
+    output_paths = []
+    pinned_frames = []  # Last frames stored as the next segment's input
+    predicted_seconds = None
+    cost_registered = False
+    prompt_id = None
+    result = None
+    residency_key = None
+    residency_warm = False
+    succeeded = False
+    execution_error = False
+    base_seed = settings.get('seed', random.randint(0, 1000000))
+    debug_info["segments"] = {"count": len(plan), "frames_each": plan[0], "completed": 0}
+    
+    def deliver_segment(index: int, path: str) -> Dict:
+        info = {"segment": index, "segments": len(plan), "filename": os.path.basename(path), "size": os.path.getsize(path)}
+        if OUTPUT_MODE != "base64":
+            try:
+                with timer.stage("segment_upload"):
+                    info.update(upload_video(path, f"{debug_info.get('job_id', 'unknown')}/segments"))
+            except Exception as e:
+                log.warning(f"⚠️ Segment {index} upload failed: {e}")
+        progress.send({"stage": "segment_done", **info}, force=True)
+        return info
+    
+    try:
+        unavailable = comfyui_unavailable(debug_info, timer)
+        if unavailable:
+            return unavailable
+        
+        workflows = []
+        for index, frames in enumerate(plan):
+            workflow = create_comfyui_workflow(stored_name, {**settings, "frames": frames, "seed": base_seed + index})
+            add_last_frame_output(workflow, frames)
+            workflows.append(workflow)
+        
+        # Admission on the whole chain: segments run back to back, behind the queued work
+        predictions = [COST_MODEL.predict(CostModel.work_units(workflow)) for workflow in workflows]
+        if all(p is not None for p in predictions):
+            predicted_seconds = sum(predictions)
+        budget = JOB_TIME_BUDGET - (time.perf_counter() - job_start)
+        admitted, backlog, job_predicted = admission.submit(image_index or 0, predicted_seconds, budget)
+        cost_registered = admitted
+        if not admitted:
+            return {
+                "error": f"Job rejected: predicted {job_predicted:.0f}s behind {backlog:.0f}s of queued work "
+                         f"exceeds the remaining {budget:.0f}s budget",
+                "debug": debug_info
+            }
+        others = job_predicted - predicted_seconds if job_predicted is not None else 0.0
+        
+        residency_key, residency_warm = MODEL_RESIDENCY.acquire(workflows[0])
+        residency_start = time.time()
+        debug_info["model_residency"] = "warm" if residency_warm else "cold"
+        start_time = time.time()
+        start_image = stored_name
+        
+        for index, workflow in enumerate(workflows):
+            point_load_images_at(workflow, start_image)
+            remaining = JOB_TIME_BUDGET - (time.perf_counter() - job_start)
+            max_wait_time = remaining
+            if predictions[index] is not None and (residency_warm or index > 0):
+                # Any segment may wait behind the job's other images, the first also behind the
+                # work that was queued when the job was admitted
+                expected = predictions[index] + others + (backlog if index == 0 else 0.0)
+                max_wait_time = min(remaining, max(DEADLINE_MIN_SECONDS, expected * DEADLINE_FACTOR))
+            
+            log.info(f"🎞️ Segment {index + 1}/{len(plan)} ({plan[index]} frames)")
+            node_listener = chain_listeners(timer.node_listener(workflow), progress.listener(workflow))
+            prompt_id, result = None, None
+            try:
+                with timer.stage("comfyui_total"):
+                    prompt_id, result = queue_and_wait(workflow, max(1, max_wait_time), on_event=node_listener,
+                                                       cancel_event=cancel_event)
+            except ComfyUIExited as e:
+                log.error(f"❌ Segment {index + 1}: {e}")
+                return {"error": f"Segment {index + 1}: {e}", "debug": {**debug_info, "comfyui_process": SUPERVISOR.report()}}
+            if result is None:
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                return {
+                    "error": "Job cancelled" if cancelled else f"Segment {index + 1} timed out after {int(max_wait_time)} seconds",
+                    "debug": debug_info
+                }
+            error_msg = history_error(result)
+            if error_msg:
+                log.error(f"❌ Segment {index + 1}: {error_msg}")
+                execution_error = execution_failed(result)
+                return {"error": f"Segment {index + 1}: {error_msg}", "debug": debug_info}
+            
+            outputs = result.get("outputs", {})
+            video_path, paths = output_files_from_history(outputs, workflow)
+            output_paths.extend(paths)
+            frame_path = next((path for path in paths if not path.endswith(".mp4")), None)
+            if video_path is None or not os.path.exists(video_path):
+                return {"error": f"Segment {index + 1} produced no video", "debug": {**debug_info, "outputs": outputs}}
+            segment_paths.append(video_path)
+            debug_info["segments"]["completed"] = index + 1
+            deliveries.append(delivery.submit(deliver_segment, index, video_path))
+            
+            if index + 1 < len(workflows):
+                if frame_path is None or not os.path.exists(frame_path):
+                    return {"error": f"Segment {index + 1} produced no last frame", "debug": debug_info}
+                start_image = INPUT_STORE.put_file(frame_path, pin=True)[0]
+                pinned_frames.append(start_image)
+        
+        with timer.stage("segment_concat"):
+            final_path = os.path.join(os.path.dirname(segment_paths[0]), f"runpod_video_{uuid.uuid4().hex[:12]}.mp4")
+            concat_videos(segment_paths, final_path)
+        output_paths.append(final_path)
+        debug_info["segments"]["delivered"] = [future.result() for future in deliveries]
+        succeeded = True
+        progress.send({"stage": "delivering"}, force=True)
+        debug_info["progress_updates"] = progress.sent
+        return build_video_response(final_path, settings, int(time.time() - start_time), debug_info, timer)
+    
+    except Exception as e:
+        return {"error": f"Segmented generation failed: {str(e)}", "debug": debug_info}
+    finally:
+        admission.withdraw(image_index or 0)
+        delivery.shutdown(wait=True)
+        if prompt_id is not None and result is None:
+            debug_info["cancellation"] = cancel_prompt(prompt_id)
+        for frame in pinned_frames:
+            INPUT_STORE.unpin(frame)
+        if cost_registered:
+            COST_MODEL.end(predicted_seconds)
+        if residency_key is not None:
+            MODEL_RESIDENCY.release(residency_key, residency_warm, time.time() - residency_start, succeeded,
+                                    execution_error)
+        OUTPUT_RETENTION.add(output_paths)
+
+class StageTimer:
+    """Per-job stage durations (seconds)"""
+    
+    # ComfyUI node classes -> pipeline stage, for timings taken from websocket events
+    NODE_STAGES = {
+        "CheckpointLoaderSimple": "model_load",
+        "CLIPVisionLoader": "model_load",
+        "LoadImage": "load_image",
+        "CLIPVisionEncode": "clip_vision_encode",
+        "CLIPTextEncode": "text_encode",
+        "WanImageToVideo": "latent_setup",
+        "KSampler": "sampling",
+        "VAEDecode": "vae_decode",
+        "VHS_VideoCombine": "video_combine",
+    }
+    
+    def __init__(self):
+        self.stages = {}
+    
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+    
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def node_listener(self, workflow: Dict) -> Callable:
+        """on_event callback that times ComfyUI's queue wait and each node stage"""
+        queued_at = time.perf_counter()
+        current = {"node": None, "start": None}
+        
+        def close_node(now):
+            if current["node"] is not None:
+                class_type = workflow.get(current["node"], {}).get("class_type")
+                self.add(self.NODE_STAGES.get(class_type, "other_nodes"), now - current["start"])
+                current["node"] = None
+        
+        def on_event(event_type, data):
+            now = time.perf_counter()
+            if event_type == "execution_start":
+                self.add("comfyui_queue_wait", now - queued_at)
+            elif event_type == "executing":
+                close_node(now)
+                if data.get("node") is not None:
+                    current["node"], current["start"] = data["node"], now
+            elif event_type in ("execution_success", "execution_error", "execution_interrupted"):
+                close_node(now)
+        
+        return on_event
+    
+    def summary(self) -> Dict[str, float]:
+        return {name: round(seconds, 4) for name, seconds in self.stages.items()}
+
+class Metrics:
+    """Worker-lifetime latency aggregation with p50/p95/p99 over a sliding window"""
+    
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self, window: int):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}  # stage -> deque of recent durations
+        self.totals = {}  # stage -> [count, sum]
+        self.jobs = {"success": 0, "error": 0}
+    
+    def observe_job(self, stages: Dict[str, float], success: bool):
+        with self.lock:
+            self.jobs["success" if success else "error"] += 1
+            for stage, seconds in stages.items():
+                self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+                total = self.totals.setdefault(stage, [0, 0.0])
+                total[0] += 1
+                total[1] += seconds
+    
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            snapshot = {stage: sorted(values) for stage, values in self.samples.items()}
+        result = {}
+        for stage, values in snapshot.items():
+            result[stage] = {
+                f"p{int(q * 100)}": values[min(len(values) - 1, int(q * len(values)))] for q in self.QUANTILES
+            }
+        return result
+    
+    def prometheus(self) -> str:
+        """Render metrics in Prometheus text exposition format"""
+        percentiles = self.percentiles()
+        lines = [
+            "# HELP handler_stage_seconds Handler pipeline stage latency",
+            "# TYPE handler_stage_seconds summary",
+        ]
+        with self.lock:
+            totals = {stage: list(total) for stage, total in self.totals.items()}
+            jobs = dict(self.jobs)
+        for stage in sorted(totals):
+            for q in self.QUANTILES:
+                value = percentiles[stage][f"p{int(q * 100)}"]
+                lines.append(f'handler_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'handler_stage_seconds_sum{{stage="{stage}"}} {totals[stage][1]:.6f}')
+            lines.append(f'handler_stage_seconds_count{{stage="{stage}"}} {totals[stage][0]}')
+        lines += ["# HELP handler_jobs_total Jobs processed by outcome", "# TYPE handler_jobs_total counter"]
+        for outcome, count in jobs.items():
+            lines.append(f'handler_jobs_total{{outcome="{outcome}"}} {count}')
+        return "\n".join(lines) + "\n"
+    
+    def dump(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+METRICS = Metrics(METRICS_WINDOW)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = METRICS.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the worker log
+
+def start_metrics_server(port: int):
+    """Serve /metrics on a background thread"""
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"📈 Metrics on :{port}/metrics")
+    return server
+
+def send_progress_update(job: Dict, payload: Dict):
+    """POST one IN_PROGRESS update to RunPod and wait for the reply"""
+    async def send():
+        async with AsyncClientSession() as session:
+            await send_result(session, {"status": "IN_PROGRESS", "output": payload}, job)
+    
+    asyncio.run(send())
+
+class ProgressSender:
+    """Sends one job's progress updates in order, one request at a time.
 
-# Initialize RunPod serverless
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    runpod.serverless.progress_update starts a thread per update, so updates sent close
+    together (a preview and the last sampler step, "delivering" and a segment) can reach
+    RunPod in any order. Every reporter of a job instead queues its updates here, for a
+    single sender thread; close() waits for the queue to drain so all of them land
+    before the job's result. Senders are registered per job id while the job runs.
+    """
+    
+    active = {}  # job id -> ProgressSender
+    active_lock = threading.Lock()
+    
+    def __init__(self, job: Dict):
+        self.job = job
+        self.queue = SimpleQueue()
+        self.stats = {"sent": 0, "failed": 0}
+        self.thread = threading.Thread(target=self._run, name=f"progress-{job.get('id', 'unknown')}", daemon=True)
+        self.thread.start()
+    
+    @classmethod
+    def open(cls, job: Dict) -> "ProgressSender":
+        sender = cls(job)
+        with cls.active_lock:
+            cls.active[job.get("id")] = sender
+        return sender
+    
+    @classmethod
+    def for_job(cls, job: Dict) -> Optional["ProgressSender"]:
+        with cls.active_lock:
+            return cls.active.get(job.get("id"))
+    
+    def submit(self, payload: Dict):
+        self.queue.put(payload)
+    
+    def close(self, timeout: float = PROGRESS_FLUSH_TIMEOUT):
+        """Send what is queued (waiting at most timeout seconds) and unregister"""
+        with self.active_lock:
+            if self.active.get(self.job.get("id")) is self:
+                self.active.pop(self.job.get("id"))
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            log.warning(f"⚠️ Progress updates still queued after {timeout:.0f}s, returning the result anyway")
+    
+    def _run(self):
+        while True:
+            payload = self.queue.get()
+            if payload is None:
+                return
+            try:
+                send_progress_update(self.job, payload)
+                self.stats["sent"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                log.warning(f"⚠️ Progress update failed: {e}")
+
+class ProgressReporter:
+    """Streams a job's sampler progress and latent previews to the client.
+
+    Updates go to RunPod through the job's ProgressSender, so clients polling /status
+    see them, in order, in the job's output while it is IN_PROGRESS. Step updates are
+    throttled to PROGRESS_MIN_INTERVAL and previews to PREVIEW_MIN_INTERVAL; the final
+    sampler step and its preview are always sent.
+    """
+    
+    STAGE_NAMES = {"KSampler": "sampling", "VAEDecode": "decoding", "VHS_VideoCombine": "encoding"}
+    
+    def __init__(self, job: Dict, extra: Optional[Dict] = None):
+        self.job = job
+        self.extra = extra or {}  # merged into every update (e.g. image_index for multi-image jobs)
+        self.enabled = bool(os.environ.get("RUNPOD_WEBHOOK_POST_OUTPUT"))  # Only set on real workers
+        self.sender = ProgressSender.for_job(job) if self.enabled else None
+        self.sent = 0
+        self.last_sent = 0.0
+        self.last_preview = 0.0
+        self.sampling_done = False
+    
+    def send(self, payload: Dict, force: bool = False):
+        now = time.time()
+        if not force and now - self.last_sent < PROGRESS_MIN_INTERVAL:
+            return
+        self.last_sent = now
+        self.sent += 1
+        payload = {**self.extra, **payload}
+        if self.sender is not None:
+            self.sender.submit(payload)
+        elif self.enabled:
+            send_progress_update(self.job, payload)  # No sender open for this job: send inline, still in order
+        log.debug(f"📶 Progress: { {k: v for k, v in payload.items() if k != 'image_base64'} }")
+    
+    def listener(self, workflow: Dict) -> Callable:
+        """on_event callback translating ComfyUI events into progress updates"""
+        def on_event(event_type, data):
+            if event_type == "execution_start":
+                self.send({"stage": "started"}, force=True)
+            elif event_type == "executing" and data.get("node") is not None:
+                class_type = workflow.get(data["node"], {}).get("class_type")
+                if class_type in self.STAGE_NAMES:
+                    self.send({"stage": self.STAGE_NAMES[class_type]}, force=True)
+            elif event_type == "progress":
+                step, steps = data.get("value", 0), data.get("max", 1)
+                last_step = step >= steps
+                self.sampling_done = self.sampling_done or last_step
+                self.send({"stage": "sampling", "step": step, "steps": steps,
+                           "percent": round(100 * step / max(steps, 1), 1)}, force=last_step)
+            elif event_type == "preview":
+                now = time.time()
+                # The preview arriving with the last step is the closest thing to the decoded video
+                if now - self.last_preview < PREVIEW_MIN_INTERVAL and not self.sampling_done:
+                    return
+                self.last_preview = now
+                self.send({"stage": "preview", "format": data["format"],
+                           "image_base64": base64.b64encode(data["image"]).decode()}, force=True)
+        return on_event
+
+def chain_listeners(*listeners: Optional[Callable]) -> Callable:
+    """Combine several on_event callbacks into one"""
+    active = [listener for listener in listeners if listener is not None]
+    
+    def on_event(event_type, data):
+        for listener in active:
+            listener(event_type, data)
+    
+    return on_event
+
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_CONCURRENCY, thread_name_prefix="job")
+
+async def handler(job):
+    """RunPod serverless handler for Video Generator App"""
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    try:
+        return await loop.run_in_executor(JOB_EXECUTOR, run_job, job, cancel_event)
+    except asyncio.CancelledError:
+        # The worker thread can't be killed; tell it to stop waiting and interrupt the prompt
+        log.warning(f"🛑 Job {job.get('id', 'unknown')} cancelled")
+        cancel_event.set()
+        raise
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Let RunPod hand this worker up to JOB_CONCURRENCY jobs at once"""
+    return JOB_CONCURRENCY
+
+if __name__ == "__main__":
+    # Preload models in the background so the worker starts taking jobs immediately
+    log.info("🔥 Container starting - preloading models in the background...")
+    threading.Thread(target=preload_models, name="preload", daemon=True).start()
+    
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    
+    # Initialize RunPod serverless
+    runpod.serverless.start({"handler": handler, "concurrency_modifier": concurrency_modifier})
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""The handler under test talks to an in-process fake ComfyUI (benchmarks/fake_comfyui.py).
+
+handler.py reads its configuration from the environment at import time, so it is
+imported once per session, after the fake server is up and the environment points
+at throwaway directories.
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import replay  # noqa: E402
+from fake_comfyui import FakeComfyUI  # noqa: E402
+
+FAKE_DEFAULTS = {"gpu_seconds": 0.05, "gpu_seconds_per_gpx": 0.0, "video_bytes": 1024, "fail_rate": 0.0,
+                 "reject_rate": 0.0, "drop_ws_rate": 0.0}
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("handler"))
+
+
+@pytest.fixture(scope="session")
+def fake_server(workdir):
+    server = FakeComfyUI(output_dir=os.path.join(workdir, "output"), **FAKE_DEFAULTS)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def fake_comfyui(fake_server):
+    """The session's fake server, with its simulation settings reset after the test"""
+    yield fake_server
+    for name, value in FAKE_DEFAULTS.items():
+        setattr(fake_server, name, value)
+
+
+@pytest.fixture(scope="session")
+def handler(fake_server, workdir):
+    replay.configure_handler_env(fake_server.url, fake_server.output_dir, workdir,
+                                 argparse.Namespace(concurrency=3, log_level="WARNING"))
+    sys.path.insert(0, replay.SRC_DIR)
+    import handler as module
+
+    assert module.start_comfyui()
+    return module
+
+
+@pytest.fixture
+def png_image() -> str:
+    """Base64 of a header-only 64x64 PNG (enough for the input store and size lookup)"""
+    import base64
+    import struct
+    import zlib
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    data = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 64, 64, 8, 2, 0, 0, 0)) + chunk(b"IEND", b"")
+    return base64.b64encode(data).decode()
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def predicted(handler, monkeypatch):
+    """Every prompt is predicted to take 30 s of a 100 s budget"""
+    monkeypatch.setattr(handler.COST_MODEL, "predict", lambda units: 30.0 if units else None)
+    monkeypatch.setattr(handler, "JOB_TIME_BUDGET", 100.0)
+    in_flight = handler.COST_MODEL.in_flight
+    yield
+    handler.COST_MODEL.in_flight = in_flight
+
+
+def run_job(handler, png_image, images: int = 1, **settings) -> dict:
+    job = {"id": f"admission-{uuid.uuid4().hex[:8]}", "input": {
+        "images": [{"image_data": png_image, "image_name": f"admission{index}.png"} for index in range(images)],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": uuid.uuid4().int % 2**32, **settings},
+    }}
+    return asyncio.run(handler.handler(job))
+
+
+def test_job_within_budget_is_admitted(handler, fake_comfyui, png_image, predicted):
+    handler.COST_MODEL.in_flight = 60.0  # 60 + 30 fits in 100
+    response = run_job(handler, png_image)
+    assert response.get("success"), response.get("error")
+    assert response["debug"]["cost_model"]["backlog_seconds"] == 60.0
+    assert handler.COST_MODEL.in_flight == 60.0
+
+
+def test_job_behind_backlog_is_rejected(handler, fake_comfyui, png_image, predicted):
+    handler.COST_MODEL.in_flight = 80.0  # 30 alone fits, 80 + 30 does not
+    prompts = fake_comfyui.stats["prompts"]
+
+    response = run_job(handler, png_image)
+
+    assert "Job rejected" in response["error"]
+    assert "80s of queued work" in response["error"]
+    assert fake_comfyui.stats["prompts"] == prompts
+    assert handler.COST_MODEL.in_flight == 80.0  # The rejected job's prediction was withdrawn
+
+
+def test_segmented_job_is_admitted_on_its_whole_chain(handler, fake_comfyui, png_image, predicted):
+    handler.COST_MODEL.in_flight = 20.0  # Three 5 s segments: 90 s alone fits, 20 + 90 does not
+    prompts = fake_comfyui.stats["prompts"]
+
+    response = run_job(handler, png_image, duration=15, fps=16)
+
+    assert "predicted 90s behind 20s" in response["error"]
+    assert fake_comfyui.stats["prompts"] == prompts
+    assert handler.COST_MODEL.in_flight == 20.0
+
+
+def test_multi_image_job_is_admitted_on_its_total(handler, fake_comfyui, png_image, predicted):
+    handler.COST_MODEL.in_flight = 20.0  # Each 30 s image fits alone, the 90 s job does not
+    prompts = fake_comfyui.stats["prompts"]
+
+    response = run_job(handler, png_image, images=3)
+
+    assert response["failed"] == 3
+    assert all("predicted 90s behind 20s" in result["error"] for result in response["results"])
+    assert fake_comfyui.stats["prompts"] == prompts
+    assert handler.COST_MODEL.in_flight == 20.0
+
+
+def test_images_that_never_queue_are_left_out_of_the_total(handler, fake_comfyui, png_image, predicted):
+    handler.COST_MODEL.in_flight = 20.0  # Two 30 s images fit behind it, three would not
+    job = {"id": f"admission-{uuid.uuid4().hex[:8]}", "input": {
+        "images": [{"image_data": png_image, "image_name": "a.png"}, {"image_data": "", "image_name": "empty.png"},
+                   {"image_data": png_image, "image_name": "b.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": uuid.uuid4().int % 2**32},
+    }}
+
+    response = asyncio.run(handler.handler(job))
+
+    assert [result.get("success", False) for result in response["results"]] == [True, False, True]
+    assert response["results"][0]["debug"]["cost_model"]["backlog_seconds"] == 20.0
+    assert handler.COST_MODEL.in_flight == 20.0
+
+
+def test_cost_model_saves_through_unique_temp_files(handler, tmp_path, monkeypatch):
+    # Workers sharing the volume all run as PID 1, so a pid-based temp name collides
+    path = str(tmp_path / "cost_model.json")
+    models = [handler.CostModel(path, 1, 1.0) for _ in range(2)]
+    temp_names = []
+    replace = os.replace
+    monkeypatch.setattr(handler.os, "replace", lambda src, dst: temp_names.append(src) or replace(src, dst))
+
+    for model in models:
+        model.observe(1.0, 10.0)
+    assert len(set(temp_names)) == 2
+    assert handler.CostModel(path, 1, 1.0).samples == 1
+    assert os.listdir(tmp_path) == ["cost_model.json"]
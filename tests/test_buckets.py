@@ -0,0 +1,65 @@
+import pytest
+
+BUCKETS = [(512, 512), (640, 640), (768, 512), (512, 768), (832, 480), (480, 832), (1024, 1024), (1280, 720),
+           (720, 1280)]
+
+
+def test_parse_buckets(handler):
+    assert handler.parse_buckets("512x512, 832x480,1280x720") == [(512, 512), (832, 480), (1280, 720)]
+    assert handler.parse_buckets("512x512,,junk") == [(512, 512)]
+    assert handler.parse_buckets("") == []
+    with pytest.raises(ValueError):
+        handler.parse_buckets("512xwide")
+
+
+@pytest.mark.parametrize("size, bucket", [
+    ((512, 512), (512, 512)),        # exact bucket
+    ((500, 520), (512, 512)),        # near-square stays square
+    ((1920, 1080), (1280, 720)),     # 16:9 goes to the 16:9 bucket, not the closer pixel count
+    ((1080, 1920), (720, 1280)),
+    ((800, 460), (832, 480)),
+    ((760, 500), (768, 512)),        # 3:2
+    ((2048, 2048), (1024, 1024)),    # larger than any bucket
+    ((64, 64), (512, 512)),          # smaller than any bucket
+])
+def test_snap_to_bucket(handler, size, bucket):
+    assert handler.snap_to_bucket(*size, buckets=BUCKETS) == bucket
+
+
+def test_snap_to_bucket_defaults_to_configured_table(handler, monkeypatch):
+    monkeypatch.setattr(handler, "BUCKET_TABLE", [(256, 256)])
+    assert handler.snap_to_bucket(1920, 1080) == (256, 256)
+
+
+@pytest.mark.parametrize("frames, snapped", [
+    (1, 1), (5, 5), (81, 81),        # already 4k + 1
+    (80, 81), (82, 81), (84, 85),    # nearest valid length
+    (120, 121), (0, 1), (-3, 1),     # never below one frame
+])
+def test_snap_frame_count(handler, frames, snapped):
+    assert handler.snap_frame_count(frames) == snapped
+    assert (snapped - 1) % handler.WAN_TEMPORAL_STRIDE == 0
+
+
+def test_workflow_uses_snapped_shape(handler, monkeypatch):
+    monkeypatch.setattr(handler, "RESOLUTION_BUCKETING", True)
+    monkeypatch.setattr(handler, "BUCKET_TABLE", BUCKETS)
+    workflow = handler.create_comfyui_workflow("in.png", {"resolution": "1920x1080", "duration": 5, "fps": 16})
+    node = next(node for node in workflow.values() if node["class_type"] == "WanImageToVideo")
+    assert (node["inputs"]["width"], node["inputs"]["height"], node["inputs"]["length"]) == (1280, 720, 81)
+
+
+def test_prewarm_runs_every_bucket_at_real_frame_counts(handler, monkeypatch):
+    monkeypatch.setattr(handler, "RESOLUTION_BUCKETING", True)
+    monkeypatch.setattr(handler, "BUCKET_TABLE", [(256, 256), (512, 256)])
+    monkeypatch.setattr(handler, "RESOLUTION_BUCKET_PREWARM_FRAMES", "120, 81")
+    shapes = []
+
+    def queue_and_wait(workflow, max_wait_time):
+        inputs = workflow["8"]["inputs"]
+        shapes.append((inputs["width"], inputs["height"], inputs["length"]))
+        return "prewarm", None
+
+    monkeypatch.setattr(handler, "queue_and_wait", queue_and_wait)
+    handler.prewarm_buckets()
+    assert shapes == [(256, 256, 81), (256, 256, 121), (512, 256, 81), (512, 256, 121)]
@@ -0,0 +1,24 @@
+import time
+
+import pytest
+
+
+def small_workflow(handler):
+    return handler.create_comfyui_workflow("completion.png", {"resolution": "256x256", "duration": 1, "steps": 2})
+
+
+def test_completion_returns_within_100ms(handler, fake_comfyui):
+    pytest.importorskip("websocket")
+    latencies = []
+    for _ in range(5):
+        prompt_id, result = handler.queue_and_wait(small_workflow(handler), 30)
+        returned = time.perf_counter()
+        assert result["status"]["status_str"] == "success"
+        latencies.append(returned - fake_comfyui.completed_at[prompt_id])
+    assert max(latencies) < 0.1, latencies
+
+
+def test_dropped_websocket_falls_back_to_polling(handler, fake_comfyui):
+    fake_comfyui.drop_ws_rate = 1.0
+    _, result = handler.queue_and_wait(small_workflow(handler), 30)
+    assert result["status"]["status_str"] == "success"
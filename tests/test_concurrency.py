@@ -0,0 +1,60 @@
+import asyncio
+import base64
+import os
+import time
+import uuid
+
+
+def job(index: int, image_data: str) -> dict:
+    return {"id": f"concurrency-{index}", "input": {
+        "images": [{"image_data": image_data, "image_name": f"concurrency{index}.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": uuid.uuid4().int % 2**32},
+    }}
+
+
+def test_concurrency_modifier_allows_job_concurrency(handler):
+    assert handler.concurrency_modifier(1) == handler.JOB_CONCURRENCY
+
+
+def test_cpu_stages_overlap_the_gpu(handler, fake_comfyui, png_image, monkeypatch):
+    """While one job samples, the next is decoded and queued, so the GPU never idles"""
+    fake_comfyui.gpu_seconds = 0.3
+    delay = 0.2
+    original_put = handler.InputImageStore.put
+
+    def slow_put(store, *args, **kwargs):
+        time.sleep(delay)  # Stands in for decoding and writing a large input
+        return original_put(store, *args, **kwargs)
+
+    monkeypatch.setattr(handler.InputImageStore, "put", slow_put)
+
+    async def run_all():
+        return await asyncio.gather(*(handler.handler(job(index, png_image)) for index in range(3)))
+
+    start = time.perf_counter()
+    responses = asyncio.run(run_all())
+    wall = time.perf_counter() - start
+
+    assert all(response.get("success") for response in responses), [r.get("error") for r in responses]
+    # Sequential jobs would take 3 * (0.2 + 0.3) s; pipelined ones about 0.2 + 3 * 0.3 s
+    assert wall < 3 * (delay + 0.3) - 0.2, wall
+
+
+def test_concurrent_jobs_keep_their_own_inputs_and_outputs(handler, fake_comfyui):
+    images = [base64.b64encode(os.urandom(256) + bytes([index])).decode() for index in range(3)]
+
+    async def run_all():
+        return await asyncio.gather(*(handler.handler(job(index, image)) for index, image in enumerate(images)))
+
+    responses = asyncio.run(run_all())
+
+    stored = [response["debug"]["input_image"]["stored_as"] for response in responses]
+    assert len(set(stored)) == 3
+    assert len({response["filename"] for response in responses}) == 3
+    for response, name in zip(responses, stored):
+        # The video returned is the one produced by the prompt that loaded this job's image
+        entry = next(entry for entry in fake_comfyui.history.values()
+                     if any(node.get("class_type") == "LoadImage" and node["inputs"]["image"] == name
+                            for node in entry["prompt"][2].values()))
+        produced = [item["filename"] for output in entry["outputs"].values() for item in output.get("gifs", [])]
+        assert produced == [response["filename"]]
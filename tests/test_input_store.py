@@ -0,0 +1,34 @@
+import base64
+import os
+
+
+def payload(byte: int, size: int = 1000) -> str:
+    return base64.b64encode(bytes([byte]) * size).decode()
+
+
+def test_pinned_input_survives_eviction(handler, tmp_path):
+    store = handler.InputImageStore(str(tmp_path), max_bytes=2500)
+    pinned, pinned_path, _, _ = store.put(payload(1), "a.png", pin=True)
+    for byte in range(2, 6):
+        store.put(payload(byte), f"{byte}.png")
+    assert os.path.exists(pinned_path)
+    assert pinned in store.entries
+
+    store.unpin(pinned)
+    store.put(payload(6), "6.png")
+    assert not os.path.exists(pinned_path)
+    assert store.total_bytes <= store.max_bytes
+
+
+def test_pins_are_counted_per_job(handler, tmp_path):
+    store = handler.InputImageStore(str(tmp_path), max_bytes=1500)
+    name, path, _, _ = store.put(payload(1), "a.png", pin=True)
+    assert store.put(payload(1), "a.png", pin=True)[3]  # Second job reuses the same file
+
+    store.unpin(name)
+    store.put(payload(2), "b.png")
+    store.put(payload(3), "c.png")
+    assert os.path.exists(path)
+
+    store.unpin(name)
+    assert not os.path.exists(path)
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def small_chunks(handler, monkeypatch):
+    # Odd sizes so chunks, buffers and the file end never line up
+    monkeypatch.setattr(handler, "MODEL_STAGING_CHUNK_BYTES", 300_000)
+    monkeypatch.setattr(handler, "MODEL_STAGING_BUFFER_BYTES", 70_000)
+    monkeypatch.setattr(handler, "MODEL_STAGING_WORKERS", 3)
+
+
+def test_copy_and_verify_copies_and_hashes(handler, small_chunks, tmp_path):
+    data = os.urandom(1_234_567)
+    source, target = tmp_path / "model.safetensors", tmp_path / "staged.safetensors"
+    source.write_bytes(data)
+    expected = hashlib.sha256(data).hexdigest()
+
+    assert handler.copy_and_verify(str(source), str(target), len(data), expected) == expected
+    assert target.read_bytes() == data
+    assert not os.path.exists(f"{target}.partial")
+
+
+def test_copy_and_verify_rejects_checksum_mismatch(handler, small_chunks, tmp_path):
+    source, target = tmp_path / "model.safetensors", tmp_path / "staged.safetensors"
+    source.write_bytes(os.urandom(500_000))
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        handler.copy_and_verify(str(source), str(target), 500_000, "0" * 64)
+    assert not target.exists() and not os.path.exists(f"{target}.partial")
+
+
+def test_copy_and_verify_rejects_short_source(handler, small_chunks, tmp_path):
+    source, target = tmp_path / "model.safetensors", tmp_path / "staged.safetensors"
+    source.write_bytes(os.urandom(400_000))
+
+    with pytest.raises(IOError, match="shorter than expected"):
+        handler.copy_and_verify(str(source), str(target), 900_000, None)
+    assert not target.exists() and not os.path.exists(f"{target}.partial")
+
+
+def test_ensure_models_fails_on_checksum_mismatch(handler, small_chunks, tmp_path, monkeypatch):
+    source = tmp_path / "volume" / "model.safetensors"
+    source.parent.mkdir()
+    source.write_bytes(os.urandom(500_000))
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([{"name": "wan_model", "path": str(source), "sha256": "0" * 64,
+                                     "comfy_path": "checkpoints/model.safetensors"}]))
+    monkeypatch.setattr(handler, "MODEL_MANIFEST", str(manifest))
+    monkeypatch.setattr(handler, "MODEL_STAGING_DIR", str(tmp_path / "staged"))
+    monkeypatch.setattr(handler, "COMFYUI_MODELS_DIR", str(tmp_path / "models"))
+    monkeypatch.setattr(handler, "MODELS_READY", False)
+    monkeypatch.setattr(handler, "MODEL_STATUS", {})
+    copies = []
+    copy_and_verify = handler.copy_and_verify
+    monkeypatch.setattr(handler, "copy_and_verify", lambda *args: copies.append(args) or copy_and_verify(*args))
+
+    missing = handler.ensure_models()
+    assert len(missing) == 1 and missing[0].startswith("wan_model")
+    assert handler.MODEL_STATUS["wan_model"] == "INVALID"
+    assert len(copies) == 2  # one re-copy, then give up
+    assert not (tmp_path / "models" / "checkpoints" / "model.safetensors").exists()
+    assert not handler.MODELS_READY
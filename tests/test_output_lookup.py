@@ -0,0 +1,59 @@
+import asyncio
+import glob
+import os
+import statistics
+
+import pytest
+
+
+def run_job(handler, png_image, index: int) -> dict:
+    job = {"id": f"lookup-{index}", "input": {
+        "images": [{"image_data": png_image, "image_name": "lookup.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": index},
+    }}
+    response = asyncio.run(handler.handler(job))
+    assert response.get("success"), response.get("error")
+    return response
+
+
+def fill_output_dir(directory: str, count: int):
+    for index in range(count):
+        with open(os.path.join(directory, f"stale_{index:05}.mp4"), "wb") as f:
+            f.write(b"\0")
+
+
+def lookup_seconds(handler, png_image, runs: int, offset: int) -> float:
+    return statistics.median(run_job(handler, png_image, offset + run)["debug"]["timings"]["output_lookup"]
+                             for run in range(runs))
+
+
+@pytest.fixture
+def output_dir(handler, fake_comfyui, tmp_path, monkeypatch):
+    """A fresh output directory shared by the fake and the handler"""
+    directory = str(tmp_path / "output")
+    os.makedirs(directory)
+    monkeypatch.setattr(fake_comfyui, "output_dir", directory)
+    monkeypatch.setattr(handler, "OUTPUT_DIR", directory)
+    return directory
+
+
+def test_lookup_does_not_scan_output_dir(handler, output_dir, png_image, monkeypatch):
+    fill_output_dir(output_dir, 500)
+    listed = []
+    for module, name in ((os, "scandir"), (os, "listdir"), (glob, "glob"), (glob, "iglob")):
+        original = getattr(module, name)
+        monkeypatch.setattr(module, name, lambda *args, _original=original, **kwargs:
+                            listed.append(args) or _original(*args, **kwargs))
+
+    response = run_job(handler, png_image, 0)
+
+    assert not [args for args in listed if args and str(args[0]).startswith(output_dir)]
+    assert not response["filename"].startswith("stale_")
+
+
+def test_lookup_cost_is_flat_in_output_dir_size(handler, output_dir, png_image):
+    empty = lookup_seconds(handler, png_image, 5, 100)
+    fill_output_dir(output_dir, 5000)
+    full = lookup_seconds(handler, png_image, 5, 200)
+    # A directory scan over 5000 files costs milliseconds; the history lookup stays in microseconds
+    assert full < empty * 3 + 0.001, (empty, full)
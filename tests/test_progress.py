@@ -0,0 +1,61 @@
+import asyncio
+import random
+import threading
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def recorded_updates(handler, monkeypatch):
+    """Progress updates as RunPod receives them, each request taking a random 0-30 ms"""
+    monkeypatch.setenv("RUNPOD_WEBHOOK_POST_OUTPUT", "http://runpod.invalid/progress")
+    monkeypatch.setattr(handler, "PROGRESS_MIN_INTERVAL", 0.0)
+    monkeypatch.setattr(handler, "PREVIEW_MIN_INTERVAL", 0.0)
+    received = []
+    lock = threading.Lock()
+    jitter = random.Random(7)
+
+    def send_progress_update(job, payload):
+        with lock:
+            delay = jitter.uniform(0, 0.03)
+        time.sleep(delay)
+        with lock:
+            received.append(payload)
+
+    monkeypatch.setattr(handler, "send_progress_update", send_progress_update)
+    return received
+
+
+def run_job(handler, png_image, steps: int) -> dict:
+    job = {"id": f"progress-{uuid.uuid4().hex[:8]}", "input": {
+        "images": [{"image_data": png_image, "image_name": "progress.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": steps, "seed": uuid.uuid4().int % 2**32},
+    }}
+    return asyncio.run(handler.handler(job))
+
+
+def test_progress_updates_arrive_in_order_before_the_result(handler, fake_comfyui, png_image, recorded_updates):
+    # Steps 10 ms apart, each with a preview: far faster than the updates can be sent
+    fake_comfyui.gpu_seconds = 0.12
+    response = run_job(handler, png_image, steps=12)
+    received_at_return = list(recorded_updates)
+
+    assert response.get("success"), response.get("error")
+    stages = [update["stage"] for update in received_at_return]
+    assert stages[0] == "started"
+    assert stages[-1] == "delivering"
+    steps = [update["step"] for update in received_at_return if update["stage"] == "sampling" and "step" in update]
+    assert steps == list(range(1, 13))
+    assert "preview" in stages
+    # Nothing trickles in after the job returned
+    time.sleep(0.1)
+    assert recorded_updates == received_at_return
+    assert response["debug"]["progress_updates"] == len(received_at_return)
+
+
+def test_sender_is_released_after_the_job(handler, fake_comfyui, png_image, recorded_updates):
+    run_job(handler, png_image, steps=2)
+    assert handler.ProgressSender.active == {}
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("progress-")]
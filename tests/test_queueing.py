@@ -0,0 +1,62 @@
+"""Concurrent jobs each get their own ComfyUI prompt, queued back to back."""
+import asyncio
+import time
+import uuid
+
+
+def job(png_image, index: int) -> dict:
+    # A fresh seed per job, so nothing is served from the result cache
+    return {"id": f"queueing-{index}", "input": {
+        "images": [{"image_data": png_image, "image_name": f"queueing{index}.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": uuid.uuid4().int % 2**32},
+    }}
+
+
+async def timed(handler, job: dict) -> tuple:
+    start = time.perf_counter()
+    response = await handler.handler(job)
+    return response, time.perf_counter() - start
+
+
+def test_concurrent_jobs_run_as_separate_back_to_back_prompts(handler, fake_comfyui, png_image):
+    fake_comfyui.gpu_seconds = 0.3
+    prompts_before = set(fake_comfyui.history)
+
+    async def run_all():
+        return await asyncio.gather(*(timed(handler, job(png_image, index)) for index in range(3)))
+
+    start = time.perf_counter()
+    results = asyncio.run(run_all())
+    wall = time.perf_counter() - start
+
+    assert all(response.get("success") for response, _ in results), [r.get("error") for r, _ in results]
+    assert len({response["filename"] for response, _ in results}) == 3
+    prompts = [entry["prompt"][2] for prompt_id, entry in fake_comfyui.history.items() if prompt_id not in prompts_before]
+    assert len(prompts) == 3
+    assert all(sum(node["class_type"] == "KSampler" for node in prompt.values()) == 1 for prompt in prompts)
+    # The first job returns after its own prompt, not after the whole group's
+    assert min(seconds for _, seconds in results) < 2 * 0.3
+    # The GPU stays busy: three prompts take about three run times end to end
+    assert wall < 3 * 0.3 + 0.5, wall
+
+
+def test_cancelled_job_interrupts_only_its_own_prompt(handler, fake_comfyui, png_image):
+    fake_comfyui.gpu_seconds = 1.0
+    interrupts = fake_comfyui.stats["interrupts"]
+
+    async def run_pair():
+        cancelled = asyncio.ensure_future(handler.handler(job(png_image, 10)))
+        while fake_comfyui.running is None:
+            await asyncio.sleep(0.01)
+        other = asyncio.ensure_future(handler.handler(job(png_image, 11)))
+        await asyncio.sleep(0.2)
+        cancelled.cancel()
+        return await other
+
+    other = asyncio.run(run_pair())
+
+    assert other.get("success"), other.get("error")
+    deadline = time.time() + 5
+    while fake_comfyui.stats["interrupts"] == interrupts and time.time() < deadline:
+        time.sleep(0.05)
+    assert fake_comfyui.stats["interrupts"] == interrupts + 1
@@ -0,0 +1,53 @@
+import pytest
+
+WORKFLOW = {"2": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "wan.safetensors"}}}
+
+
+@pytest.fixture
+def residency(handler):
+    return handler.ModelResidency(idle_ttl=0, min_free_vram_gb=0)
+
+
+def run(residency, **outcome):
+    key, warm = residency.acquire(WORKFLOW)
+    residency.release(key, warm, 1.0, **outcome)
+    return warm
+
+
+def test_models_stay_loaded_after_timeouts_and_cancellations(residency):
+    run(residency, success=True)
+    assert run(residency, success=False)  # A timed out / cancelled job
+    assert run(residency, success=False)
+    assert residency.stats["unloads"] == {}
+
+
+def test_execution_error_unloads(residency):
+    run(residency, success=True)
+    run(residency, success=False, execution_error=True)
+    assert residency.stats["unloads"] == {"execution error": 1}
+    assert not run(residency, success=True)
+
+
+def test_vram_is_probed_outside_the_lock(residency, monkeypatch):
+    held = []
+    monkeypatch.setattr(residency, "_free_vram", lambda: held.append(residency.lock.locked()) or 80 * 1024**3)
+    run(residency, success=True)
+    assert held == [False]
+
+
+def test_free_is_sent_outside_the_lock(handler, monkeypatch):
+    residency = handler.ModelResidency(idle_ttl=0, min_free_vram_gb=1)
+    held = []
+    monkeypatch.setattr(handler.SUPERVISOR, "alive", lambda: True)
+    monkeypatch.setattr(handler.COMFY, "free", lambda: held.append(residency.lock.locked()))
+    monkeypatch.setattr(residency, "_free_vram", lambda: 0.5 * 1024**3)
+
+    run(residency, success=True)  # memory threshold
+    residency.mark_loaded(WORKFLOW)
+    other = {"2": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "other.safetensors"}}}
+    key, warm = residency.acquire(other)  # checkpoint change
+    residency.release(key, warm, 1.0, success=False)
+    residency.mark_loaded(WORKFLOW)
+    residency._expire()  # idle ttl
+    assert residency.stats["unloads"] == {"memory threshold": 1, "checkpoint change": 1, "idle ttl": 1}
+    assert held == [False, False, False]
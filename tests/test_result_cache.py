@@ -0,0 +1,44 @@
+import asyncio
+import os
+import uuid
+
+
+def run_job(handler, png_image, seed: int) -> dict:
+    job = {"id": f"cache-{uuid.uuid4().hex[:8]}", "input": {
+        "images": [{"image_data": png_image, "image_name": "cache.png"}],
+        "settings": {"resolution": "256x256", "duration": 1, "steps": 2, "seed": seed},
+    }}
+    return asyncio.run(handler.handler(job))
+
+
+def test_cache_hit_does_not_wait_for_comfyui(handler, fake_comfyui, png_image, monkeypatch):
+    seed = uuid.uuid4().int % 2**32
+    assert run_job(handler, png_image, seed)["success"]
+
+    gate_calls = []
+    monkeypatch.setattr(handler, "wait_for_comfyui", lambda: gate_calls.append(1) and False)
+    hit = run_job(handler, png_image, seed)
+    assert hit["success"] and hit["debug"]["result_cache"]["hit"]
+    assert not gate_calls
+
+    miss = run_job(handler, png_image, seed + 1)
+    assert miss["error"] == "Failed to start ComfyUI server"
+    assert gate_calls
+
+
+def test_served_link_survives_eviction(handler, tmp_path):
+    cache = handler.ResultCache(str(tmp_path / "cache"), max_bytes=1500, ttl=3600)
+    first, second = tmp_path / "first.mp4", tmp_path / "second.mp4"
+    first.write_bytes(b"1" * 1000)
+    second.write_bytes(b"2" * 1000)
+    cache.put("first", str(first))
+
+    served = cache.get("first")
+    cache.put("second", str(second))  # evicts "first" while it is still being delivered
+    assert "first" not in cache.entries and not os.path.exists(cache.path("first"))
+    with open(served, "rb") as f:
+        assert f.read() == b"1" * 1000
+
+    cache.release(served)
+    assert not os.path.exists(served)
+    assert cache.get("first") is None
@@ -0,0 +1,61 @@
+import hashlib
+import os
+
+import pytest
+import requests
+
+moto_server = pytest.importorskip("moto.server")
+
+
+@pytest.fixture
+def bucket(handler, monkeypatch):
+    """A local moto S3 server with the handler's sink pointed at it"""
+    import replay
+
+    port = replay.free_port()
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    monkeypatch.setenv("BUCKET_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("BUCKET_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setattr(handler, "BUCKET_ENDPOINT_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(handler, "BUCKET_NAME", "outputs")
+    monkeypatch.setattr(handler, "_S3_CLIENT", None)
+    handler.get_s3_client().create_bucket(Bucket="outputs")
+    yield handler.get_s3_client()
+    handler._S3_CLIENT = None
+    server.stop()
+
+
+def test_multipart_upload_round_trips(handler, bucket, monkeypatch, tmp_path):
+    # Small parts so a modest file still goes through concurrent multipart upload
+    monkeypatch.setattr(handler, "S3_UPLOAD_CHUNK_BYTES", 5 * 1024**2)
+    monkeypatch.setattr(handler, "S3_UPLOAD_CONCURRENCY", 4)
+    data = os.urandom(12 * 1024**2 + 123)
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+
+    result = handler.upload_video(str(path), "job-1")
+
+    assert result["size"] == len(data)
+    assert result["sha256"] == hashlib.sha256(data).hexdigest()
+    head = bucket.head_object(Bucket="outputs", Key=result["video_key"])
+    assert head["ContentType"] == "video/mp4"
+    assert "-" in head["ETag"]  # Multipart ETags are "<md5 of part md5s>-<parts>"
+    downloaded = requests.get(result["video_url"], timeout=30)
+    assert downloaded.status_code == 200
+    assert downloaded.content == data
+
+
+def test_auto_mode_uploads_large_outputs_and_inlines_small_ones(handler, bucket, monkeypatch, tmp_path):
+    monkeypatch.setattr(handler, "OUTPUT_MODE", "auto")
+    monkeypatch.setattr(handler, "OUTPUT_INLINE_MAX_BYTES", 1024)
+    small, large = tmp_path / "small.mp4", tmp_path / "large.mp4"
+    small.write_bytes(b"\1" * 512)
+    large.write_bytes(b"\2" * 4096)
+
+    inline = handler.build_video_response(str(small), {}, 1, {"job_id": "job-2"})
+    uploaded = handler.build_video_response(str(large), {}, 1, {"job_id": "job-2"})
+
+    assert inline["output_mode"] == "base64" and "video_base64" in inline
+    assert uploaded["output_mode"] == "s3" and "video_base64" not in uploaded
+    assert bucket.head_object(Bucket="outputs", Key=uploaded["video_key"])["ContentLength"] == 4096
@@ -0,0 +1,29 @@
+"""Crash detection and restart, through benchmarks/supervisor.py.
+
+The supervisor owns module-level state (the ComfyUI process, readiness), so the
+benchmark runs in its own interpreter with the fake ComfyUI as the supervised child.
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_crash_fails_the_job_within_a_second_and_comfyui_restarts():
+    completed = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "supervisor.py"), "--gpu-seconds", "1",
+         "--restart-backoff", "0.2"],
+        capture_output=True, text=True, timeout=120, cwd=ROOT,
+    )
+    assert completed.returncode == 0, completed.stderr[-2000:]
+    report = json.loads(completed.stdout)
+
+    assert report["rounds"]
+    for round_ in report["rounds"]:
+        assert round_["detection_seconds"] < 1, round_
+        assert round_["exit"]["code"] == 1
+        assert round_["traceback_in_debug"]
+        assert "ComfyUI exited" in round_["error"]
+    assert report["job_after_restarts_ok"]